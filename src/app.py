@@ -1,28 +1,79 @@
 import asyncio
+import math
+import os
 import typing as tp
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from time import monotonic
 
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from loguru import logger
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from _logging import CONSOLE_LOGGING_CONFIG, FILE_LOGGING_CONFIG
-from dependencies import get_plot_data
+from dependencies import (
+    get_plot_data,
+    load_comparison_series,
+    load_plot_series,
+    load_rollup_rows,
+    parse_plot_options,
+    parse_sampling_options,
+    parse_time_boundaries,
+)
 from mastodon_meter.Account import Account
-from mastodon_meter.Gatherer import Gatherer
+from mastodon_meter.AccountCache import AccountCache
+from mastodon_meter.AccountState import AccountState
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Downsampling import SamplingOptions
+from mastodon_meter.Export import ExportUnavailable, MeteringExport, negotiate_compression
+from mastodon_meter.Gatherer import Gatherer, GatheringSummary
+from mastodon_meter.Importer import ImportSummary
 from mastodon_meter.Metering import Metering
-from mastodon_meter.Plotting import Plotter
-from mastodon_meter.Reporter import Reporter
-from mastodon_meter.Types import FileOrError, GraphData, ResponsePayload
-from mastodon_meter.database import MongoDbWrapper
+from mastodon_meter.Metrics import (
+    ACCOUNT_CACHE_LOOKUPS,
+    HTTP_REQUEST_DURATION,
+    HTTP_REQUESTS,
+    INSTANCE_CIRCUIT_OPEN,
+    WRITE_BUFFER_DOCUMENTS,
+    WRITE_BUFFER_DROPPED,
+    WRITE_BUFFER_FLUSH_SECONDS,
+    WRITE_BUFFER_FLUSHES,
+    render_metrics,
+    watch_event_loop_lag,
+)
+from mastodon_meter.PlotCache import CachedPlot, PlotCache
+from mastodon_meter.Plotting import PlotOptions, Plotter
+from mastodon_meter.Profiler import SamplingProfiler
+from mastodon_meter.Rendering import RenderPool, RenderQueueFull
+from mastodon_meter.Reporter import Reporter, ReportVersion
+from mastodon_meter.Rollups import ROLLUP_TIER_NAMES, RollupTier
+from mastodon_meter.Scheduler import Scheduler
+from mastodon_meter.Series import MeteringSeries
+from mastodon_meter.Types import Document, FileOrError, GraphData, ResponsePayload
+from mastodon_meter.database import get_database
 from mastodon_meter.models import (
     AccountRawData,
+    AccountStats,
     AddAccountRequest,
     AddAccountResponse,
+    CacheStatsResponse,
+    ComparisonRequest,
     DeleteAccountRequest,
+    ExportRequest,
     GetReportRequest,
     GetReportResponse,
+    ImportAccountsRequest,
+    ImportAccountsResponse,
+    InstanceStatsResponse,
+    ProfileResponse,
+    ProfilerStartRequest,
+    RawDataRequest,
     ResponseBase,
+    SetMeteringIntervalRequest,
+    StatsRequest,
     TrackedAccountList,
 )
 
@@ -32,6 +83,20 @@ logger.configure(handlers=[CONSOLE_LOGGING_CONFIG, FILE_LOGGING_CONFIG])
 # global variables
 app = FastAPI()
 
+# page size limits for the raw data endpoint
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# the number of handles accepted by one import
+MAX_IMPORT_HANDLES = 10000
+
+# the number of accounts one comparison graph can show
+MAX_COMPARED_ACCOUNTS = 100
+
+# limits for the stats window and forecast horizon, in days
+MAX_STATS_WINDOW = 365
+MAX_STATS_HORIZON = 365
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -41,25 +106,136 @@ app.add_middleware(
 )
 
 
+def _get_route_path(scope: Scope) -> str:
+    """get the path template of the route serving the request, so that the metrics don't grow with the account ids"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return str(getattr(route, "path", "unknown"))
+    return "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """
+    observe the duration and the status of the API requests by route. Unlike the "http" middleware decorator,
+    it passes the response through as is, so the streamed responses are only produced as fast as they are sent
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app: ASGIApp = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route: str = _get_route_path(scope)
+        status: int = 500
+        t0: float = monotonic()
+
+        async def _send(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            HTTP_REQUEST_DURATION.observe(monotonic() - t0, method=scope["method"], route=route)
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status)
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
 @app.on_event("startup")
 async def startup_event() -> None:
     """tasks to do at server startup"""
-    MongoDbWrapper()
+    await get_database().ensure_indexes()
+    RenderPool()
+    PlotCache()
+    asyncio.create_task(get_database().backfill_rollups())
+    asyncio.create_task(get_database().backfill_account_states())
+    Scheduler().start()
+    asyncio.create_task(watch_event_loop_lag())
     asyncio.create_task(Gatherer().start_metering_daemon())
 
 
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    """tasks to do at server shutdown"""
+    await Gatherer().close()
+    await Scheduler().stop()
+    await get_database().close()
+    RenderPool().shutdown()
+
+
+def _is_not_modified(request: Request, plot: CachedPlot) -> bool:
+    """check if the client already has the current version of the plot"""
+    if_none_match: tp.Optional[str] = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return plot.etag in (tag.strip() for tag in if_none_match.split(","))
+
+    if_modified_since: tp.Optional[str] = request.headers.get("if-modified-since")
+    if if_modified_since is not None and plot.last_modified is not None:
+        try:
+            return plot.last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since).replace(
+                tzinfo=None
+            )
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+async def _get_plot_response(
+    request: Request, graph_data: GraphData, plot_type: str, field: str, draw_function: tp.Callable[..., bytes]
+) -> Response:
+    """serve the plot from the cache, rendering it if the underlying data has changed"""
+    account, (since, to), latest, options, sampling = graph_data
+    cache: PlotCache = PlotCache()
+
+    async def _render() -> bytes:
+        series: MeteringSeries = await load_plot_series(graph_data, field)
+        return await RenderPool().render(draw_function, series, account, options)
+
+    key: str = cache.make_key(account.internal_id, plot_type, since, to, latest, options, sampling)
+    last_modified: tp.Optional[datetime] = latest.timestamp if latest else None
+    plot, content = await cache.get_or_render(key, account.internal_id, options.media_type, last_modified, _render)
+    return _make_plot_response(request, plot, content)
+
+
+def _make_plot_response(request: Request, plot: CachedPlot, content: bytes) -> Response:
+    """serve the plot with its validators, or tell the client its copy is still current"""
+    headers: tp.Dict[str, str] = {"ETag": plot.etag, "Cache-Control": "no-cache"}
+    if plot.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(plot.last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+
+    if _is_not_modified(request, plot):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content, media_type=plot.media_type, headers=headers)
+
+
 @app.post("/api/accounts/add", response_model=tp.Union[AddAccountResponse, ResponseBase])  # type: ignore
 async def add_tracked_account(account_data: AddAccountRequest) -> ResponsePayload:
     """add an account to the list of tracked"""
     logger.info("Adding account into the list of tracked")
 
     try:
+        if account_data.metering_interval is not None and account_data.metering_interval <= 0:
+            raise ValueError("Metering interval must be a positive number of seconds")
+
         account: Account = Account(
             username=account_data.username,
             instance=account_data.instance,
             id=account_data.instance_id,
+            metering_interval=account_data.metering_interval,
         )
-        await MongoDbWrapper().add_tracked_account(account)
+        await get_database().add_tracked_account(account)
+        AccountCache().invalidate()
+        Reporter().invalidate_reports()
 
         message: str = f"Added account {account.internal_id} to the list of tracked"
         logger.info(message)
@@ -77,19 +253,52 @@ async def add_tracked_account(account_data: AddAccountRequest) -> ResponsePayloa
         return {"status": False, "message": message}
 
 
+@app.post("/api/accounts/import", response_model=tp.Union[ImportAccountsResponse, ResponseBase])  # type: ignore
+async def import_tracked_accounts(import_data: ImportAccountsRequest) -> ResponsePayload:
+    """add many accounts to the list of tracked by their handles, metering each of them once"""
+    logger.info(f"Importing {len(import_data.handles)} accounts into the list of tracked")
+
+    try:
+        if import_data.metering_interval is not None and import_data.metering_interval <= 0:
+            raise ValueError("Metering interval must be a positive number of seconds")
+        if len(import_data.handles) > MAX_IMPORT_HANDLES:
+            raise ValueError(f"At most {MAX_IMPORT_HANDLES} handles can be imported at once")
+
+        summary: ImportSummary = await Gatherer().import_accounts(import_data.handles, import_data.metering_interval)
+
+        response: ResponsePayload = {
+            "status": True,
+            "message": f"Imported {len(summary.imported)} of {len(import_data.handles)} accounts",
+            "imported": {handle: account.internal_id for handle, account in summary.imported.items()},
+            "skipped": summary.skipped,
+            "not_found": summary.not_found,
+            "invalid": summary.invalid,
+            "failed": summary.failed,
+        }
+        return response
+
+    except Exception as e:
+        message = f"An error occurred while importing the accounts: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
 @app.post("/api/accounts/remove", response_model=ResponseBase)
 async def remove_tracked_account(account_data: DeleteAccountRequest) -> ResponsePayload:
     """remove an account from the list of tracked"""
     logger.info(f"Deleting account {account_data.account_internal_id} from the list of tracked")
 
     try:
-        await MongoDbWrapper().delete_tracked_account(account_data.account_internal_id)
+        await get_database().delete_tracked_account(account_data.account_internal_id)
+        AccountCache().invalidate()
+        Reporter().invalidate_reports()
         message: str = f"Removed account {account_data.account_internal_id} from the list of tracked"
         logger.info(message)
 
         if account_data.remove_associated_data:
             logger.info(f"Removing meterings associated with account {account_data.account_internal_id}")
-            await MongoDbWrapper().delete_meterings_for_account(account_data.account_internal_id)
+            await get_database().delete_meterings_for_account(account_data.account_internal_id)
+            PlotCache().invalidate_accounts([account_data.account_internal_id])
             logger.info(f"Removed all meterings associated with account {account_data.account_internal_id}")
 
         response: ResponsePayload = {
@@ -104,13 +313,40 @@ async def remove_tracked_account(account_data: DeleteAccountRequest) -> Response
         return {"status": False, "message": message}
 
 
+@app.post("/api/accounts/schedule", response_model=ResponseBase)
+async def set_metering_interval(schedule_data: SetMeteringIntervalRequest) -> ResponsePayload:
+    """change the metering interval of a tracked account"""
+    logger.info(f"Setting metering interval of account {schedule_data.account_internal_id}")
+
+    try:
+        interval: tp.Optional[int] = schedule_data.metering_interval
+        if interval is not None and interval <= 0:
+            raise ValueError("Metering interval must be a positive number of seconds")
+
+        await get_database().set_metering_interval(schedule_data.account_internal_id, interval)
+        AccountCache().invalidate()
+        message: str = (
+            f"Set metering interval of account {schedule_data.account_internal_id} to "
+            f"{f'{interval} s.' if interval else 'the default one'}"
+        )
+        logger.info(message)
+        return {"status": True, "message": message}
+
+    except Exception as e:
+        message = f"An error occurred while setting the metering interval: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
 @app.get("/api/accounts/tracked", response_model=tp.Union[TrackedAccountList, ResponseBase])  # type: ignore
 async def get_tracked_accounts() -> ResponsePayload:
     """return the list of tracked accounts"""
     logger.info("Gathering tracked accounts")
 
     try:
-        tracked_accounts: tp.List[Account] = await MongoDbWrapper().get_tracked_accounts()
+        tracked_accounts: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]] = (
+            await get_database().get_account_states()
+        )
         response: ResponsePayload = {
             "status": True,
             "message": f"Gathered {len(tracked_accounts)} tracked accounts.",
@@ -121,8 +357,15 @@ async def get_tracked_accounts() -> ResponsePayload:
                     "instance": account.instance,
                     "instance_id": account.id,
                     "added_on": str(account.added_on),
+                    "metering_interval": account.metering_interval,
+                    "toot_count": state.toot_count if state else None,
+                    "subscribers_count": state.subscribers_count if state else None,
+                    "toot_count_delta": state.toot_count_delta if state else None,
+                    "subscribers_count_delta": state.subscribers_count_delta if state else None,
+                    "last_metered_on": str(state.timestamp) if state else None,
+                    "last_checked_on": str(state.last_checked) if state and state.last_checked else None,
                 }
-                for account in tracked_accounts
+                for account, state in tracked_accounts
             ],
         }
         return response
@@ -134,17 +377,26 @@ async def get_tracked_accounts() -> ResponsePayload:
 
 
 @app.get("/api/{account_internal_id}/data", response_model=tp.Union[AccountRawData, ResponseBase])  # type: ignore
-async def get_account_data(account_internal_id: str) -> ResponsePayload:
-    """get raw data for an account"""
+async def get_account_data(account_internal_id: str, page: tp.Optional[RawDataRequest] = None) -> ResponsePayload:
+    """get a page of raw data for an account"""
     logger.info(f"Gathering raw data for account {account_internal_id}")
 
     try:
-        meterings: tp.List[Metering] = await MongoDbWrapper().get_all_meterings(account_internal_id)
-        response: ResponsePayload = {
-            "status": True,
-            "message": f"Gathered raw data for account {account_internal_id}",
-            "account_internal_id": account_internal_id,
-            "data": [
+        page = page or RawDataRequest()
+        limit: int = min(page.limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        after: tp.Optional[datetime] = datetime.fromisoformat(page.cursor) if page.cursor else None
+        since, to = parse_time_boundaries(page.since, page.to)
+        next_cursor: tp.Optional[datetime]
+        data: tp.List[Document]
+
+        if page.resolution is not None and page.resolution in ROLLUP_TIER_NAMES:
+            tier: RollupTier = ROLLUP_TIER_NAMES[page.resolution]
+            data, next_cursor = await load_rollup_rows(account_internal_id, tier, limit, after, since, to)
+        else:
+            meterings, next_cursor = await get_database().get_meterings_page(
+                account_internal_id, limit, after, since, to
+            )
+            data = [
                 {
                     "toot_count": int(m.toot_count),
                     "subscribers_count": int(m.subscribers_count),
@@ -152,7 +404,14 @@ async def get_account_data(account_internal_id: str) -> ResponsePayload:
                     "timestamp": str(m.timestamp),
                 }
                 for m in meterings
-            ],
+            ]
+
+        response: ResponsePayload = {
+            "status": True,
+            "message": f"Gathered {len(data)} records for account {account_internal_id}",
+            "account_internal_id": account_internal_id,
+            "next_cursor": next_cursor.isoformat() if next_cursor else None,
+            "data": data,
         }
         return response
 
@@ -162,14 +421,183 @@ async def get_account_data(account_internal_id: str) -> ResponsePayload:
         return {"status": False, "message": message}
 
 
+@app.get("/api/export")
+async def export_meterings(request: Request, export_request: tp.Optional[ExportRequest] = None) -> FileOrError:
+    """stream the meterings of many accounts as NDJSON, CSV or Parquet, compressed if requested"""
+    logger.info("Exporting meterings")
+
+    try:
+        export_request = export_request or ExportRequest()
+        since, to = parse_time_boundaries(export_request.since, export_request.to)
+        compression: tp.Optional[str] = export_request.compression or negotiate_compression(
+            request.headers.get("accept-encoding")
+        )
+        export: MeteringExport = MeteringExport(
+            export_request.format or "ndjson", compression if compression != "identity" else None
+        )
+        meterings: tp.AsyncIterator[Metering] = get_database().iter_meterings_for_accounts(
+            export_request.accounts, since, to
+        )
+        return StreamingResponse(export.stream(meterings), media_type=export.media_type, headers=export.headers)
+
+    except ExportUnavailable as e:
+        logger.warning(str(e))
+        return JSONResponse({"status": False, "message": str(e)}, status_code=501)
+
+    except Exception as e:
+        message: str = f"An error occurred while exporting meterings: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
+def _collect_component_metrics() -> None:
+    """copy the stats kept by the components of this worker into the metrics"""
+    write_stats: tp.Dict[str, tp.Any] = Gatherer().get_write_stats()
+    WRITE_BUFFER_FLUSHES.set(write_stats["flushes"] - write_stats["failures"], result="ok")
+    WRITE_BUFFER_FLUSHES.set(write_stats["failures"], result="failed")
+    WRITE_BUFFER_DOCUMENTS.set(write_stats["documents"])
+    WRITE_BUFFER_DROPPED.set(write_stats["dropped"])
+    WRITE_BUFFER_FLUSH_SECONDS.set(write_stats["latency_ms"]["total"] / 1000)
+
+    for instance, stats in Gatherer().get_instance_stats().items():
+        INSTANCE_CIRCUIT_OPEN.set(int(stats["circuit"] != "closed"), instance=instance)
+
+    cache_stats: tp.Dict[str, tp.Any] = AccountCache().get_stats()
+    ACCOUNT_CACHE_LOOKUPS.set(cache_stats["hits"], result="hit")
+    ACCOUNT_CACHE_LOOKUPS.set(cache_stats["misses"], result="miss")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """get the metrics of this worker in the Prometheus text format"""
+    _collect_component_metrics()
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def _check_profiler_enabled() -> None:
+    if os.getenv("PROFILER_ENABLED", default="").lower() not in ("1", "true", "yes"):
+        raise PermissionError("Profiler is disabled, set $PROFILER_ENABLED to enable it")
+
+
+@app.post("/api/profiler/start", response_model=ResponseBase)
+async def start_profiler(profiler_request: tp.Optional[ProfilerStartRequest] = None) -> ResponsePayload:
+    """start sampling the event loop of this worker"""
+    try:
+        _check_profiler_enabled()
+        interval_ms: float = (profiler_request.interval_ms if profiler_request else None) or 10
+        SamplingProfiler().start(min(max(interval_ms, 1), 1000) / 1000)
+        return {"status": True, "message": f"Started profiling worker {Scheduler().worker_id}"}
+
+    except Exception as e:
+        message: str = f"An error occurred while starting the profiler: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
+@app.post("/api/profiler/stop", response_model=tp.Union[ProfileResponse, ResponseBase])  # type: ignore
+async def stop_profiler() -> ResponsePayload:
+    """stop sampling the event loop of this worker and get the profile"""
+    try:
+        _check_profiler_enabled()
+        profile: tp.Dict[str, tp.Any] = SamplingProfiler().stop()
+        response: ResponsePayload = {
+            "status": True,
+            "message": f"Collected {profile['samples']} samples from worker {Scheduler().worker_id}",
+            "profile": profile,
+        }
+        return response
+
+    except Exception as e:
+        message: str = f"An error occurred while stopping the profiler: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
+@app.get("/api/accounts/cache", response_model=tp.Union[CacheStatsResponse, ResponseBase])  # type: ignore
+async def get_account_cache_stats() -> ResponsePayload:
+    """get hit and miss counters of the tracked accounts cache of this worker"""
+    logger.info("Gathering account cache stats")
+
+    try:
+        response: ResponsePayload = {
+            "status": True,
+            "message": "Gathered account cache stats.",
+            "worker_id": Scheduler().worker_id,
+            "account_cache": AccountCache().get_stats(),
+        }
+        return response
+
+    except Exception as e:
+        message: str = f"An error occurred while gathering account cache stats: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
+@app.get("/api/instances/stats", response_model=tp.Union[InstanceStatsResponse, ResponseBase])  # type: ignore
+async def get_instance_stats() -> ResponsePayload:
+    """get request stats and circuit breaker states of the Mastodon instances polled by this worker"""
+    logger.info("Gathering instance stats")
+
+    try:
+        instances: tp.Dict[str, tp.Dict[str, tp.Any]] = Gatherer().get_instance_stats()
+        response: ResponsePayload = {
+            "status": True,
+            "message": f"Gathered stats for {len(instances)} instances.",
+            "worker_id": Scheduler().worker_id,
+            "instances": instances,
+        }
+        return response
+
+    except Exception as e:
+        message: str = f"An error occurred while gathering instance stats: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
+@app.get("/api/{account_internal_id}/stats", response_model=tp.Union[AccountStats, ResponseBase])  # type: ignore
+async def get_account_stats(
+    account_internal_id: str, stats_request: tp.Optional[StatsRequest] = None
+) -> ResponsePayload:
+    """get growth stats for an account, computed from its daily rollups"""
+    logger.info(f"Computing stats for account {account_internal_id}")
+
+    try:
+        stats_request = stats_request or StatsRequest()
+        since, to = parse_time_boundaries(stats_request.since, stats_request.to)
+        window: int = min(max(stats_request.window or 7, 1), MAX_STATS_WINDOW)
+        horizon: int = min(max(stats_request.horizon or 30, 1), MAX_STATS_HORIZON)
+
+        database: DatabaseWrapper = get_database()
+        await AccountCache().get_account(account_internal_id)
+        series: MeteringSeries = await database.get_rollup_series(
+            account_internal_id, ROLLUP_TIER_NAMES["daily"], since, to
+        )
+        snapshot: tp.Optional[Document] = await database.get_stats_snapshot()
+
+        response: ResponsePayload = {
+            "status": True,
+            "message": f"Computed stats over {len(series)} days for account {account_internal_id}",
+            "account_internal_id": account_internal_id,
+            "stats": Reporter().get_account_stats(series, snapshot, window, horizon),
+        }
+        return response
+
+    except Exception as e:
+        message: str = f"An error occurred while computing stats: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
 @app.get("/api/gather-data", response_model=ResponseBase)
 async def gather_data() -> ResponsePayload:
     """get meterings for all the tracked accounts and save them to the DB"""
     try:
-        metering_count, execution_time = await Gatherer().gather_meterings()
+        summary: GatheringSummary = await Gatherer().gather_meterings()
         return {
             "status": True,
-            "message": f"Gathered {metering_count} meterings for the tracked accounts in {execution_time} s.",
+            "message": f"Gathered {summary.metering_count} meterings for the tracked accounts in "
+            f"{summary.execution_time} s. ({summary.rate} accounts/s., {summary.unchanged_count} unchanged, "
+            f"{summary.failed_count} failed).",
         }
 
     except Exception as e:
@@ -179,14 +607,19 @@ async def gather_data() -> ResponsePayload:
 
 
 @app.get("/api/{account_internal_id}/graph/subscribers")
-async def get_subscribers_graph(graph_data: GraphData = Depends(get_plot_data)) -> FileOrError:
+async def get_subscribers_graph(request: Request, graph_data: GraphData = Depends(get_plot_data)) -> FileOrError:
     """get subscribers graph for an account"""
-    meterings, account = graph_data
+    account, *_ = graph_data
     logger.info(f"Plotting subscribers for account {account.internal_id}")
 
     try:
-        plot_path: str = Plotter().draw_subscribers_plot(meterings, account)
-        return FileResponse(plot_path)
+        return await _get_plot_response(
+            request, graph_data, "subscribers", "subscribers_count", Plotter().draw_subscribers_plot
+        )
+
+    except RenderQueueFull as e:
+        logger.warning(str(e))
+        return JSONResponse({"status": False, "message": str(e)}, status_code=503)
 
     except Exception as e:
         message: str = f"An error occurred while generating plot: {e}"
@@ -195,14 +628,17 @@ async def get_subscribers_graph(graph_data: GraphData = Depends(get_plot_data))
 
 
 @app.get("/api/{account_internal_id}/graph/toots")
-async def get_toots_graph(graph_data: GraphData = Depends(get_plot_data)) -> FileOrError:
+async def get_toots_graph(request: Request, graph_data: GraphData = Depends(get_plot_data)) -> FileOrError:
     """get toots graph for an account"""
-    meterings, account = graph_data
+    account, *_ = graph_data
     logger.info(f"Plotting statuses for account {account.internal_id}")
 
     try:
-        plot_path: str = Plotter().draw_statuses_plot(meterings, account)
-        return FileResponse(plot_path)
+        return await _get_plot_response(request, graph_data, "statuses", "toot_count", Plotter().draw_statuses_plot)
+
+    except RenderQueueFull as e:
+        logger.warning(str(e))
+        return JSONResponse({"status": False, "message": str(e)}, status_code=503)
 
     except Exception as e:
         message: str = f"An error occurred while generating plot: {e}"
@@ -211,14 +647,95 @@ async def get_toots_graph(graph_data: GraphData = Depends(get_plot_data)) -> Fil
 
 
 @app.get("/api/{account_internal_id}/graph/common")
-async def get_common_graph(graph_data: GraphData = Depends(get_plot_data)) -> FileOrError:
+async def get_common_graph(request: Request, graph_data: GraphData = Depends(get_plot_data)) -> FileOrError:
     """get common (toots and subscribers) graph for an account"""
-    meterings, account = graph_data
+    account, *_ = graph_data
     logger.info(f"Plotting statuses and subscribers for account {account.internal_id}")
 
     try:
-        plot_path: str = Plotter().draw_common_plot(meterings, account)
-        return FileResponse(plot_path)
+        return await _get_plot_response(request, graph_data, "common", "subscribers_count", Plotter().draw_common_plot)
+
+    except RenderQueueFull as e:
+        logger.warning(str(e))
+        return JSONResponse({"status": False, "message": str(e)}, status_code=503)
+
+    except Exception as e:
+        message: str = f"An error occurred while generating plot: {e}"
+        logger.error(message)
+        return {"status": False, "message": message}
+
+
+@app.get("/api/graph/compare")
+async def get_comparison_graph(request: Request, comparison: ComparisonRequest) -> FileOrError:
+    """
+    get a graph comparing a counter of many accounts: overlaid on one plot, as growth since the start
+    of the time range if normalized, or on a grid of small plots. The series are loaded in one query
+    """
+    logger.info(f"Plotting a comparison of {len(comparison.accounts)} accounts")
+
+    try:
+        account_internal_ids: tp.List[str] = list(dict.fromkeys(comparison.accounts))
+        if not account_internal_ids or len(account_internal_ids) > MAX_COMPARED_ACCOUNTS:
+            raise ValueError(f"From 1 to {MAX_COMPARED_ACCOUNTS} accounts can be compared")
+
+        states: tp.Dict[str, tp.Tuple[Account, tp.Optional[AccountState]]] = {
+            account.internal_id: (account, state)
+            for account, state in await get_database().get_account_states(account_internal_ids)
+        }
+        unknown: tp.List[str] = [i for i in account_internal_ids if i not in states]
+        if unknown:
+            raise ValueError(f"Accounts are not tracked: {', '.join(unknown)}")
+
+        account_states: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]] = [
+            states[i] for i in account_internal_ids
+        ]
+        accounts: tp.List[Account] = [account for account, _ in account_states]
+        field: str = "toot_count" if comparison.metric == "toots" else "subscribers_count"
+        layout: str = comparison.layout or "overlay"
+        normalize: bool = bool(comparison.normalize)
+        columns: int = min(max(comparison.columns or math.ceil(math.sqrt(len(accounts))), 1), 10)
+        since, to = parse_time_boundaries(comparison.since, comparison.to)
+        options: PlotOptions = parse_plot_options(comparison)
+        sampling: SamplingOptions = parse_sampling_options(comparison)
+
+        async def _render() -> bytes:
+            series: tp.List[MeteringSeries] = await load_comparison_series(account_states, since, to, sampling, field)
+            if layout == "grid":
+                return await RenderPool().render(
+                    Plotter().draw_small_multiples, accounts, series, field, normalize, options, columns
+                )
+            return await RenderPool().render(
+                Plotter().draw_comparison_plot, accounts, series, field, normalize, options
+            )
+
+        # the plot is addressed by the latest metering of every account, the states hold them
+        latest: tp.List[tp.Optional[tp.Tuple[datetime, int, int]]] = [
+            (state.timestamp, state.toot_count, state.subscribers_count) if state else None
+            for _, state in account_states
+        ]
+        key: str = PlotCache.make_key(
+            ",".join(account_internal_ids),
+            f"compare-{field}",
+            since,
+            to,
+            None,
+            layout,
+            normalize,
+            columns,
+            options,
+            sampling,
+            latest,
+        )
+        last_modified: tp.Optional[datetime] = max(
+            (state.timestamp for _, state in account_states if state), default=None
+        )
+        # comparisons aren't dropped along with the plots of one account, the key changes along with the data though
+        plot, content = await PlotCache().get_or_render(key, "", options.media_type, last_modified, _render)
+        return _make_plot_response(request, plot, content)
+
+    except RenderQueueFull as e:
+        logger.warning(str(e))
+        return JSONResponse({"status": False, "message": str(e)}, status_code=503)
 
     except Exception as e:
         message: str = f"An error occurred while generating plot: {e}"
@@ -232,16 +749,17 @@ async def get_text_report(payload_data: GetReportRequest) -> ResponsePayload:
     logger.info("Generating a simple text report for all the tracked accounts")
 
     try:
-        accounts: tp.List[Account] = await MongoDbWrapper().get_tracked_accounts()
-        if payload_data.accounts is not None:
-            target_accounts: tp.Set[str] = set(payload_data.accounts)
-            accounts = list(filter(lambda a: a.internal_id in target_accounts, accounts))
+        reporter: Reporter = Reporter()
+        version: ReportVersion = await reporter.get_data_version()
+        report: tp.Optional[str] = reporter.get_cached_report(version, payload_data.accounts)
 
-        account_data: tp.List[tp.Tuple[Account, tp.List[Metering]]] = [
-            (acc, await MongoDbWrapper().get_all_meterings(acc.internal_id)) for acc in accounts
-        ]
+        if report is None:
+            account_data: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]] = (
+                await get_database().get_account_states(payload_data.accounts)
+            )
+            report = reporter.get_simple_text_report(account_data)
+            reporter.cache_report(version, payload_data.accounts, report)
 
-        report: str = Reporter().get_simple_text_report(account_data)
         return {"status": True, "message": "Generated a simple text report for requested accounts", "report": report}
 
     except Exception as e:
@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import typing as tp
+from dataclasses import asdict, replace
+from datetime import datetime
+from time import monotonic
+
+from .datasets import DATASET_PRESETS, DatasetOptions
+from .fake_mastodon import FakeMastodonOptions, FakeMastodonServer
+from .runner import SCENARIOS, MemoryWatcher, ScenarioResult
+
+
+def _get_revision() -> tp.Optional[str]:
+    """get the commit the benchmarks run on, marking uncommitted changes"""
+    try:
+        revision: str = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty: bool = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True))
+        return f"{revision}-dirty" if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _configure_environment(args: argparse.Namespace, directory: str) -> None:
+    """point the app to the stand-in database, it reads the environment when its components are first used"""
+    os.environ["DATABASE_BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = os.path.join(directory, "benchmark.sqlite3")
+    os.environ["MONGO_DATABASE"] = args.mongo_database
+    # plots and reports are rendered on every request, unless the cache is asked for explicitly
+    os.environ.setdefault("PLOT_CACHE_MEMORY_MB", "0")
+    # the fake instances enforce their own rate limits, the client side throttling is not the subject here
+    os.environ.setdefault("INSTANCE_RATE_LIMIT", "1000")
+
+
+async def _drop_mongo_database(name: str) -> None:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    await AsyncIOMotorClient(os.getenv("MONGO_CONNECTION_URL")).drop_database(name)
+
+
+async def _run_benchmarks(
+    args: argparse.Namespace, dataset: DatasetOptions, server: FakeMastodonServer
+) -> tp.Dict[str, tp.Any]:
+    # the app is only imported once the environment is set up
+    from loguru import logger
+
+    import app
+    from mastodon_meter.Gatherer import Gatherer
+    from mastodon_meter.Rendering import RenderPool
+    from mastodon_meter.database import get_database
+
+    from .datasets import populate_database
+    from .runner import BenchmarkRunner
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO" if args.verbose else "ERROR")
+
+    if args.backend == "mongodb":
+        await _drop_mongo_database(args.mongo_database)
+
+    try:
+        await get_database().ensure_indexes()
+        print(f"Generating {dataset.meterings} meterings for {dataset.accounts} accounts", file=sys.stderr)
+        with MemoryWatcher() as memory:
+            t0: float = monotonic()
+            accounts = await populate_database(get_database(), dataset, server.base_url)
+            duration: float = monotonic() - t0
+        populate: ScenarioResult = ScenarioResult("populate", "meterings", dataset.meterings, 0, duration, [duration])
+        populate.peak_rss, populate.rss_growth = memory.peak_rss, memory.peak_rss - memory.start_rss
+
+        runner: BenchmarkRunner = BenchmarkRunner(app.app, accounts, args.requests, args.concurrency, dataset.seed)
+        results: tp.Dict[str, ScenarioResult] = {"populate": populate}
+        for scenario in args.scenarios:
+            print(f"Running {scenario}", file=sys.stderr)
+            results.update(await runner.run([scenario], args.gather_runs))
+
+        await Gatherer().close()
+        return {name: result.as_dict() for name, result in results.items()}
+
+    finally:
+        await get_database().close()
+        RenderPool().shutdown()
+        if args.backend == "mongodb":
+            await _drop_mongo_database(args.mongo_database)
+
+
+def run(args: argparse.Namespace) -> None:
+    dataset: DatasetOptions = DATASET_PRESETS[args.dataset]
+    dataset = replace(
+        dataset,
+        **{
+            name: value
+            for name, value in (
+                ("accounts", args.accounts),
+                ("days", args.days),
+                ("interval_hours", args.interval_hours),
+                ("instances", args.instances),
+                ("seed", args.seed),
+            )
+            if value is not None
+        },
+    )
+    instances: FakeMastodonOptions = FakeMastodonOptions(
+        latency_ms=args.latency_ms,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="mastodon-meter-benchmark-") as directory:
+        _configure_environment(args, directory)
+        with FakeMastodonServer(instances) as server:
+            results: tp.Dict[str, tp.Any] = asyncio.run(_run_benchmarks(args, dataset, server))
+
+    report: tp.Dict[str, tp.Any] = {
+        "revision": _get_revision(),
+        "created_on": datetime.utcnow().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": args.backend,
+        },
+        "dataset": {**asdict(dataset), "meterings": dataset.meterings},
+        "instances": asdict(instances),
+        "load": {"requests": args.requests, "concurrency": args.concurrency, "gather_runs": args.gather_runs},
+        "results": results,
+    }
+
+    output: str = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+    _print_summary(results)
+
+
+def _print_summary(results: tp.Dict[str, tp.Any]) -> None:
+    print(
+        f"{'scenario':<20}{'throughput':>22}{'p50 ms':>12}{'p99 ms':>12}{'errors':>8}{'peak MB':>10}", file=sys.stderr
+    )
+    for name, result in results.items():
+        throughput: str = f"{result['throughput']} {result['throughput_unit']}"
+        print(
+            f"{name:<20}{throughput:>22}{result['latency_ms']['p50']:>12}{result['latency_ms']['p99']:>12}"
+            f"{result['errors']:>8}{result['peak_rss_mb']:>10}",
+            file=sys.stderr,
+        )
+
+
+def _get_change(base: tp.Optional[float], new: tp.Optional[float]) -> tp.Optional[float]:
+    return (new - base) / base if base and new is not None else None
+
+
+def compare(args: argparse.Namespace) -> None:
+    """compare two benchmark reports, failing if anything got slower than the threshold allows"""
+    reports: tp.List[tp.Dict[str, tp.Any]] = []
+    for path in (args.base, args.new):
+        with open(path) as file:
+            reports.append(json.load(file))
+    base, new = reports
+
+    print(f"{base.get('revision')} -> {new.get('revision')}")
+    print(f"{'scenario':<20}{'throughput':>12}{'p50':>10}{'p99':>10}{'peak memory':>14}")
+    regressions: tp.List[str] = []
+
+    for name, result in new["results"].items():
+        if name not in base["results"]:
+            continue
+
+        previous: tp.Dict[str, tp.Any] = base["results"][name]
+        changes: tp.Dict[str, tp.Optional[float]] = {
+            "throughput": _get_change(previous["throughput"], result["throughput"]),
+            "p50": _get_change(previous["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            "p99": _get_change(previous["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+            "peak memory": _get_change(previous["peak_rss_mb"], result["peak_rss_mb"]),
+        }
+        print(
+            f"{name:<20}"
+            + "".join(
+                f"{'n/a' if change is None else f'{change:+.1%}':>{width}}"
+                for change, width in zip(changes.values(), (12, 10, 10, 14))
+            )
+        )
+
+        for metric, change in changes.items():
+            # throughput is the only metric that is better when it grows
+            if change is not None and (-change if metric == "throughput" else change) > args.threshold:
+                regressions.append(f"{name} {metric} {change:+.1%}")
+
+    if regressions:
+        print(f"Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mastodon meter benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks against fake instances and a stand-in database")
+    run_parser.add_argument("--dataset", choices=list(DATASET_PRESETS), default="small", help="dataset preset")
+    run_parser.add_argument("--accounts", type=int, help="number of tracked accounts, overrides the preset")
+    run_parser.add_argument("--days", type=int, help="days of metering history, overrides the preset")
+    run_parser.add_argument("--interval-hours", type=float, help="hours between the meterings, overrides the preset")
+    run_parser.add_argument("--instances", type=int, help="number of fake instances, overrides the preset")
+    run_parser.add_argument("--seed", type=int, help="seed of the synthetic data, overrides the preset")
+    run_parser.add_argument("--backend", choices=("sqlite", "mongodb"), default="sqlite", help="database backend")
+    run_parser.add_argument(
+        "--mongo-database",
+        default="mastodon-meter-benchmark",
+        help="MongoDB database to use, it is dropped before and after the run",
+    )
+    run_parser.add_argument("--latency-ms", type=float, default=50, help="mean latency of the fake instances")
+    run_parser.add_argument("--error-rate", type=float, default=0.0, help="share of failed instance responses")
+    run_parser.add_argument("--rate-limit", type=int, default=0, help="requests per window per instance, 0 is none")
+    run_parser.add_argument("--rate-limit-window", type=float, default=300, help="rate limit window in seconds")
+    run_parser.add_argument("--requests", type=int, default=50, help="requests per endpoint scenario")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests per endpoint scenario")
+    run_parser.add_argument("--gather-runs", type=int, default=3, help="gathering runs in the gather scenario")
+    run_parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), help="scenarios to run"
+    )
+    run_parser.add_argument("--output", help="file to write the JSON report to instead of the standard output")
+    run_parser.add_argument("--verbose", action="store_true", help="show the logs of the app")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two reports, e.g. of two commits")
+    compare_parser.add_argument("base", help="report of the baseline")
+    compare_parser.add_argument("new", help="report to compare with the baseline")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative change considered a regression (0.1 is 10%%)"
+    )
+    compare_parser.set_defaults(handler=compare)
+
+    args: argparse.Namespace = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import random
+import typing as tp
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from mastodon_meter.Account import Account
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Metering import Metering
+
+from .fake_mastodon import get_instance_url
+
+
+@dataclass(frozen=True)
+class DatasetOptions:
+    """Describes the synthetic dataset the benchmarks run on"""
+
+    accounts: int
+    days: int
+    interval_hours: float = 24
+    instances: int = 20
+    seed: int = 0
+
+    @property
+    def meterings_per_account(self) -> int:
+        return int(self.days * 24 / self.interval_hours)
+
+    @property
+    def meterings(self) -> int:
+        return self.accounts * self.meterings_per_account
+
+
+DATASET_PRESETS: tp.Dict[str, DatasetOptions] = {
+    "tiny": DatasetOptions(accounts=100, days=30),
+    "small": DatasetOptions(accounts=1000, days=365),
+    "medium": DatasetOptions(accounts=10000, days=365),
+    "large": DatasetOptions(accounts=100000, days=365),
+}
+
+
+def generate_accounts(options: DatasetOptions, base_url: str, now: datetime) -> tp.List[Account]:
+    """make the accounts spread over the fake instances, tracked since the start of the dataset"""
+    added_on: datetime = now - timedelta(days=options.days)
+    return [
+        Account(
+            username=f"user{i}",
+            instance=get_instance_url(base_url, i % options.instances),
+            id=str(i),
+            internal_id=f"{i:032x}",
+            added_on=added_on,
+        )
+        for i in range(options.accounts)
+    ]
+
+
+def generate_meterings(
+    account: Account, options: DatasetOptions, now: datetime, rng: random.Random
+) -> tp.List[Metering]:
+    """make the history of an account: subscribers follow a random walk with a trend, statuses only grow"""
+    count: int = options.meterings_per_account
+    step: timedelta = timedelta(hours=options.interval_hours)
+    start: datetime = now - step * count
+
+    subscribers: float = rng.lognormvariate(5, 2)
+    # the trend is linear, so that long histories stay within realistic counts
+    trend: float = subscribers * rng.gauss(0.001, 0.002) * options.interval_hours / 24
+    toots: int = rng.randint(0, 5000)
+    toots_rate: float = rng.expovariate(1 / 3)
+    meterings: tp.List[Metering] = []
+
+    for i in range(count):
+        subscribers = max(subscribers + trend + rng.gauss(0, 1 + subscribers * 0.001), 0)
+        toots += int(rng.expovariate(1 / toots_rate)) if toots_rate else 0
+        meterings.append(Metering(toots, int(subscribers), account.internal_id, start + step * (i + 1)))
+
+    return meterings
+
+
+async def populate_database(
+    database: DatabaseWrapper, options: DatasetOptions, base_url: str, batch_size: int = 50000
+) -> tp.List[Account]:
+    """
+    fill the database with the synthetic dataset: the tracked accounts, their meterings, rollups and states.
+    The meterings are made and written a batch at a time, so that large datasets don't have to fit into memory
+    """
+    now: datetime = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    rng: random.Random = random.Random(options.seed)
+    accounts: tp.List[Account] = generate_accounts(options, base_url, now)
+
+    for i in range(0, len(accounts), 500):
+        end: int = i + 500
+        await asyncio.gather(*(database.add_tracked_account(account) for account in accounts[i:end]))
+
+    accounts_per_batch: int = max(batch_size // max(options.meterings_per_account, 1), 1)
+    for i in range(0, len(accounts), accounts_per_batch):
+        end = i + accounts_per_batch
+        histories: tp.List[tp.List[Metering]] = [
+            generate_meterings(account, options, now, rng) for account in accounts[i:end]
+        ]
+        meterings: tp.List[Metering] = [metering for history in histories for metering in history]
+        if not meterings:
+            continue
+
+        await database.add_meterings(meterings)
+        await database.update_rollups(meterings)
+        await database.update_account_states([metering for history in histories for metering in history[-2:]])
+
+    return accounts
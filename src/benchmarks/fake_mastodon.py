@@ -0,0 +1,177 @@
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import typing as tp
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from time import monotonic, sleep
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+# the account entity carries much more than the counters, the padding makes the responses realistically sized
+NOTE_PADDING: str = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 20 + "</p>"
+
+
+@dataclass(frozen=True)
+class FakeMastodonOptions:
+    """Describes how the fake instances behave"""
+
+    latency_ms: float = 50
+    error_rate: float = 0.0
+    rate_limit: int = 0  # requests per window per instance, 0 means unlimited
+    rate_limit_window: float = 300
+
+
+def get_instance_url(base_url: str, index: int) -> str:
+    """all the fake instances are served by one server, each under its own path prefix"""
+    return f"{base_url}/instance-{index}"
+
+
+class FakeMastodon:
+    """
+    serves the account endpoints of the Mastodon API (https://docs.joinmastodon.org/methods/accounts/)
+    for any number of instances, with the latency, failures and rate limits of real ones
+    """
+
+    def __init__(self, options: FakeMastodonOptions, seed: int = 0) -> None:
+        self.options: FakeMastodonOptions = options
+        self._random: random.Random = random.Random(seed)
+        self._requests: tp.Dict[str, int] = {}
+        self._windows: tp.Dict[str, tp.Tuple[float, int]] = {}
+
+    def _get_account(self, account_id: str) -> tp.Dict[str, tp.Any]:
+        """build the account entity, its counters grow with every request so that every metering sees a change"""
+        requests: int = self._requests.get(account_id, 0) + 1
+        self._requests[account_id] = requests
+        base: int = int(account_id) % 100000
+        return {
+            "id": account_id,
+            "username": f"user{account_id}",
+            "acct": f"user{account_id}",
+            "display_name": f"User {account_id}",
+            "locked": False,
+            "bot": False,
+            "created_at": "2020-01-01T00:00:00.000Z",
+            "note": NOTE_PADDING,
+            "url": f"https://example.com/@user{account_id}",
+            "avatar": "https://example.com/avatars/original/missing.png",
+            "header": "https://example.com/headers/original/missing.png",
+            "followers_count": base + requests,
+            "following_count": base // 2,
+            "statuses_count": base * 3 + requests // 2,
+            "last_status_at": "2021-09-01",
+            "emojis": [],
+            "fields": [],
+        }
+
+    def _check_rate_limit(self, instance: str) -> tp.Tuple[bool, tp.Dict[str, str]]:
+        """count the request in the window of the instance, getting the headers Mastodon sends"""
+        if not self.options.rate_limit:
+            return True, {}
+
+        now: float = monotonic()
+        started_at, count = self._windows.get(instance, (now, 0))
+        if now - started_at >= self.options.rate_limit_window:
+            started_at, count = now, 0
+
+        count += 1
+        self._windows[instance] = started_at, count
+        reset: datetime = datetime.now(timezone.utc) + timedelta(
+            seconds=started_at + self.options.rate_limit_window - now
+        )
+        headers: tp.Dict[str, str] = {
+            "X-RateLimit-Limit": str(self.options.rate_limit),
+            "X-RateLimit-Remaining": str(max(self.options.rate_limit - count, 0)),
+            "X-RateLimit-Reset": reset.isoformat(),
+        }
+        return count <= self.options.rate_limit, headers
+
+    async def _respond(self, instance: str, get_payload: tp.Callable[[], tp.Any]) -> Response:
+        if self.options.latency_ms:
+            await asyncio.sleep(self._random.expovariate(1000 / self.options.latency_ms))
+
+        allowed, headers = self._check_rate_limit(instance)
+        if not allowed:
+            return Response(json.dumps({"error": "Too many requests"}), 429, headers, "application/json")
+
+        if self._random.random() < self.options.error_rate:
+            return Response(json.dumps({"error": "Service Unavailable"}), 503, headers, "application/json")
+
+        return Response(json.dumps(get_payload()), 200, headers, "application/json")
+
+    async def get_account(self, request: Request) -> Response:
+        account_id: str = request.path_params["account_id"]
+        return await self._respond(request.path_params["instance"], lambda: self._get_account(account_id))
+
+    async def get_accounts(self, request: Request) -> Response:
+        account_ids: tp.List[str] = request.query_params.getlist("id[]")
+        return await self._respond(
+            request.path_params["instance"], lambda: [self._get_account(account_id) for account_id in account_ids]
+        )
+
+    def get_app(self) -> Starlette:
+        return Starlette(
+            routes=[
+                Route("/{instance}/api/v1/accounts/{account_id}", self.get_account),
+                Route("/{instance}/api/v1/accounts", self.get_accounts),
+            ]
+        )
+
+
+def _get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def _serve(options: tp.Dict[str, tp.Any], port: int) -> None:
+    app: Starlette = FakeMastodon(FakeMastodonOptions(**options)).get_app()
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+class FakeMastodonServer:
+    """runs the fake instances in a separate process, so that serving them doesn't load the measured event loop"""
+
+    def __init__(self, options: FakeMastodonOptions) -> None:
+        self.options: FakeMastodonOptions = options
+        self.port: int = _get_free_port()
+        self._process: tp.Optional[multiprocessing.process.BaseProcess] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, timeout: float = 10) -> None:
+        context = multiprocessing.get_context("spawn")
+        self._process = context.Process(target=_serve, args=(asdict(self.options), self.port), daemon=True)
+        self._process.start()
+
+        deadline: float = monotonic() + timeout
+        while monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.1).close()
+                return
+            except OSError:
+                sleep(0.05)
+
+        self.stop()
+        raise RuntimeError(f"Fake Mastodon server did not start in {timeout} s.")
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> "FakeMastodonServer":
+        self.start()
+        return self
+
+    def __exit__(self, *_: tp.Any) -> None:
+        self.stop()
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import random
+import resource
+import threading
+import typing as tp
+from dataclasses import dataclass, field
+from time import monotonic
+
+import httpx
+import numpy as np
+
+from mastodon_meter.Account import Account
+from mastodon_meter.Gatherer import Gatherer, GatheringSummary
+from mastodon_meter.Reporter import Reporter
+
+MEGABYTE: int = 1024 * 1024
+SCENARIOS: tp.Tuple[str, ...] = ("gather", "graph_subscribers", "graph_toots", "graph_common", "raw_data", "report")
+
+
+def get_rss() -> int:
+    """get the resident set size of the process in bytes, or the peak one where the current one is unknown"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS, the latter has no /proc though
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemoryWatcher:
+    """samples the resident set size in a background thread to find its peak while a scenario runs"""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self._interval: float = interval
+        self._stopped: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(target=self._watch, name="memory-watcher", daemon=True)
+        self.start_rss: int = get_rss()
+        self.peak_rss: int = self.start_rss
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.peak_rss = max(self.peak_rss, get_rss())
+
+    def __enter__(self) -> "MemoryWatcher":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_: tp.Any) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, get_rss())
+
+
+@dataclass
+class ScenarioResult:
+    """Stores the measurements of one benchmark scenario"""
+
+    name: str
+    unit: str
+    items: int = 0
+    errors: int = 0
+    duration: float = 0
+    latencies: tp.List[float] = field(default_factory=list)
+    peak_rss: int = 0
+    rss_growth: int = 0
+    details: tp.Dict[str, tp.Any] = field(default_factory=dict)
+
+    def as_dict(self) -> tp.Dict[str, tp.Any]:
+        latencies: np.ndarray = np.array(self.latencies or [0.0]) * 1000
+        return {
+            "operations": len(self.latencies),
+            "errors": self.errors,
+            "duration": round(self.duration, 3),
+            "throughput": round(self.items / self.duration, 2) if self.duration else None,
+            "throughput_unit": f"{self.unit}/s",
+            "latency_ms": {
+                "p50": round(float(np.percentile(latencies, 50)), 2),
+                "p99": round(float(np.percentile(latencies, 99)), 2),
+                "mean": round(float(latencies.mean()), 2),
+                "max": round(float(latencies.max()), 2),
+            },
+            "peak_rss_mb": round(self.peak_rss / MEGABYTE, 1),
+            "rss_growth_mb": round(self.rss_growth / MEGABYTE, 1),
+            **self.details,
+        }
+
+
+class BenchmarkRunner:
+    """runs the scenarios against the app in process, so that nothing but the app itself is measured"""
+
+    def __init__(self, app: tp.Any, accounts: tp.List[Account], requests: int, concurrency: int, seed: int = 0) -> None:
+        self._app: tp.Any = app
+        self._accounts: tp.List[Account] = accounts
+        self._requests: int = requests
+        self._concurrency: int = concurrency
+        self._random: random.Random = random.Random(seed)
+
+    async def _run_requests(
+        self, result: ScenarioResult, send: tp.Callable[[httpx.AsyncClient, int], tp.Awaitable[bool]]
+    ) -> ScenarioResult:
+        """send the requests with the set concurrency, each reporting whether it succeeded"""
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self._concurrency)
+        transport: httpx.ASGITransport = httpx.ASGITransport(app=self._app)
+
+        async def _timed(client: httpx.AsyncClient, i: int) -> None:
+            async with semaphore:
+                t0: float = monotonic()
+                try:
+                    succeeded: bool = await send(client, i)
+                except Exception:
+                    succeeded = False
+                result.latencies.append(monotonic() - t0)
+                result.errors += not succeeded
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            with MemoryWatcher() as memory:
+                t0: float = monotonic()
+                await asyncio.gather(*(_timed(client, i) for i in range(self._requests)))
+                result.duration = monotonic() - t0
+
+        result.items = self._requests
+        result.peak_rss, result.rss_growth = memory.peak_rss, memory.peak_rss - memory.start_rss
+        return result
+
+    def _pick_accounts(self) -> tp.List[Account]:
+        """pick an account for every request, different ones as long as there are enough not to hit the caches"""
+        if self._requests <= len(self._accounts):
+            return self._random.sample(self._accounts, self._requests)
+        return [self._random.choice(self._accounts) for _ in range(self._requests)]
+
+    async def run_gather(self, runs: int) -> ScenarioResult:
+        """gather meterings for all the tracked accounts from the fake instances"""
+        result: ScenarioResult = ScenarioResult("gather", "accounts")
+        summaries: tp.List[GatheringSummary] = []
+
+        with MemoryWatcher() as memory:
+            for _ in range(runs):
+                t0: float = monotonic()
+                summary: GatheringSummary = await Gatherer().gather_meterings(self._accounts)
+                result.latencies.append(monotonic() - t0)
+                summaries.append(summary)
+
+        result.duration = sum(result.latencies)
+        result.items = len(self._accounts) * runs
+        result.errors = sum(summary.failed_count for summary in summaries)
+        result.peak_rss, result.rss_growth = memory.peak_rss, memory.peak_rss - memory.start_rss
+        result.details = {
+            "metered": sum(summary.metering_count for summary in summaries),
+            "unchanged": sum(summary.unchanged_count for summary in summaries),
+            "retries": sum(stats["retries"] for stats in Gatherer().get_instance_stats().values()),
+        }
+        return result
+
+    async def run_graph(self, plot: str) -> ScenarioResult:
+        """render the plots of the whole history of the accounts"""
+        accounts: tp.List[Account] = self._pick_accounts()
+
+        async def _send(client: httpx.AsyncClient, i: int) -> bool:
+            response: httpx.Response = await client.request(
+                "GET", f"/api/{accounts[i].internal_id}/graph/{plot}", json={}
+            )
+            return response.status_code == 200 and response.headers["content-type"].startswith("image/")
+
+        return await self._run_requests(ScenarioResult(f"graph_{plot}", "requests"), _send)
+
+    async def run_raw_data(self) -> ScenarioResult:
+        """get the first page of the raw meterings of the accounts"""
+        accounts: tp.List[Account] = self._pick_accounts()
+
+        async def _send(client: httpx.AsyncClient, i: int) -> bool:
+            response: httpx.Response = await client.request(
+                "GET", f"/api/{accounts[i].internal_id}/data", json={"limit": 1000}
+            )
+            return response.status_code == 200 and bool(response.json()["status"])
+
+        return await self._run_requests(ScenarioResult("raw_data", "requests"), _send)
+
+    async def run_report(self) -> ScenarioResult:
+        """make the text report on all the tracked accounts, bypassing the report cache"""
+
+        async def _send(client: httpx.AsyncClient, i: int) -> bool:
+            Reporter().invalidate_reports()
+            response: httpx.Response = await client.request("GET", "/api/report", json={"accounts": None})
+            return response.status_code == 200 and bool(response.json()["status"])
+
+        return await self._run_requests(ScenarioResult("report", "requests"), _send)
+
+    async def run(self, scenarios: tp.Iterable[str], gather_runs: int) -> tp.Dict[str, ScenarioResult]:
+        results: tp.Dict[str, ScenarioResult] = {}
+        for scenario in scenarios:
+            if scenario == "gather":
+                results[scenario] = await self.run_gather(gather_runs)
+            elif scenario.startswith("graph_"):
+                results[scenario] = await self.run_graph(scenario.split("_", 1)[1])
+            elif scenario == "raw_data":
+                results[scenario] = await self.run_raw_data()
+            elif scenario == "report":
+                results[scenario] = await self.run_report()
+            else:
+                raise ValueError(f"Unknown scenario '{scenario}', expected one of: {', '.join(SCENARIOS)}")
+        return results
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import sys
+import typing as tp
+
+from dependencies import parse_time_boundaries
+from mastodon_meter.Export import EXPORT_COMPRESSIONS, EXPORT_FORMATS, MeteringExport
+from mastodon_meter.Gatherer import Gatherer
+from mastodon_meter.Importer import ImportSummary
+from mastodon_meter.Types import Document
+from mastodon_meter.database import MongoDbWrapper, get_database
+
+
+def _format_size(size: float) -> str:
+    """format the size in bytes for humans"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+async def print_storage_stats() -> None:
+    """print the number of meterings and the space they take in each storage"""
+    stats: tp.Dict[str, Document] = await MongoDbWrapper().get_meterings_storage_stats()
+
+    for storage, storage_stats in stats.items():
+        print(
+            f"{storage}: {storage_stats['count']} meterings, "
+            f"data {_format_size(storage_stats['size'])}, "
+            f"on disk {_format_size(storage_stats['storage_size'])}, "
+            f"indexes {_format_size(storage_stats['index_size'])}"
+        )
+
+
+async def migrate_meterings(args: argparse.Namespace) -> None:
+    """copy the meterings into the time-series storage"""
+    copied: int = await MongoDbWrapper().migrate_meterings(args.batch_size)
+    print(f"Copied {copied} meterings into the time-series storage")
+    await print_storage_stats()
+
+
+async def storage_stats(args: argparse.Namespace) -> None:
+    await print_storage_stats()
+
+
+async def export_meterings(args: argparse.Namespace) -> None:
+    """stream the meterings into the file or to the standard output"""
+    export: MeteringExport = MeteringExport(args.format, args.compression)
+    since, to = parse_time_boundaries(args.since, args.to)
+    output: tp.BinaryIO = open(args.output, "wb") if args.output else sys.stdout.buffer
+
+    try:
+        async for chunk in export.stream(get_database().iter_meterings_for_accounts(args.accounts, since, to)):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+        await get_database().close()
+
+
+async def import_accounts(args: argparse.Namespace) -> None:
+    """add the accounts listed in the file (or the standard input) to the list of tracked, a handle per line"""
+    source: tp.TextIO = open(args.input) if args.input else sys.stdin
+    with source:
+        handles: tp.List[str] = [line.strip() for line in source if line.strip() and not line.startswith("#")]
+
+    try:
+        await get_database().ensure_indexes()
+        summary: ImportSummary = await Gatherer().import_accounts(handles, args.metering_interval)
+    finally:
+        await get_database().close()
+
+    print(
+        f"Imported {len(summary.imported)} of {len(handles)} accounts: {len(summary.skipped)} tracked already, "
+        f"{len(summary.not_found)} not found, {len(summary.invalid)} invalid, {len(summary.failed)} failed"
+    )
+    for handle in summary.not_found:
+        print(f"Not found: {handle}", file=sys.stderr)
+    for handle in summary.invalid:
+        print(f"Invalid: {handle}", file=sys.stderr)
+    for handle, error in summary.failed.items():
+        print(f"Failed: {handle}: {error}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mastodon meter maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-meterings", help="copy the meterings into the time-series storage")
+    migrate.add_argument("--batch-size", type=int, default=None, help="number of meterings copied at once")
+    migrate.set_defaults(handler=migrate_meterings)
+
+    stats = commands.add_parser("storage-stats", help="show the space taken by the meterings")
+    stats.set_defaults(handler=storage_stats)
+
+    export = commands.add_parser("export", help="export the meterings of many or all accounts")
+    export.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson", help="format of the export")
+    export.add_argument("--compression", choices=EXPORT_COMPRESSIONS, default=None, help="compress the export")
+    export.add_argument("--accounts", nargs="+", default=None, help="internal ids of the accounts, all by default")
+    export.add_argument("--since", default=None, help="start of the time range, as YYYY-MM-DD HH:MM")
+    export.add_argument("--to", default=None, help="end of the time range, as YYYY-MM-DD HH:MM")
+    export.add_argument("--output", default=None, help="file to write the export to instead of the standard output")
+    export.set_defaults(handler=export_meterings)
+
+    import_ = commands.add_parser("import-accounts", help="add accounts to the list of tracked by their handles")
+    import_.add_argument("--input", default=None, help="file with a user@instance handle per line, stdin by default")
+    import_.add_argument("--metering-interval", type=int, default=None, help="metering interval of the accounts, s.")
+    import_.set_defaults(handler=import_accounts)
+
+    args: argparse.Namespace = parser.parse_args()
+    asyncio.run(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,131 @@ import typing as tp
 from datetime import datetime
 
 from mastodon_meter.Account import Account
+from mastodon_meter.AccountCache import AccountCache
+from mastodon_meter.AccountState import AccountState
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Downsampling import SamplingOptions, lttb
 from mastodon_meter.Metering import Metering
-from mastodon_meter.Types import GraphData
-from mastodon_meter.database import MongoDbWrapper
+from mastodon_meter.Plotting import PlotOptions
+from mastodon_meter.Rollups import Rollup, RollupTier, choose_tier, get_rollup_rows
+from mastodon_meter.Series import MeteringSeries
+from mastodon_meter.Types import Document, GraphData, TimeBoundaries
+from mastodon_meter.database import get_database
 from mastodon_meter.models import GraphRequest
 
 
-def filter_metering_by_time(
-    meterings: tp.List[Metering], since: tp.Optional[str], to: tp.Optional[str]
-) -> tp.List[Metering]:
-    """filter meterings to only leave ones that are within the time boundaries"""
+def parse_time_boundaries(since: tp.Optional[str], to: tp.Optional[str]) -> TimeBoundaries:
+    """parse the time boundaries provided in a request"""
     date_format: str = "%Y-%m-%d %H:%M"
     since_: tp.Optional[datetime] = datetime.strptime(since, date_format) if since else None
     to_: tp.Optional[datetime] = datetime.strptime(to, date_format) if to else None
-    return list(filter(lambda m: m.is_within_range(since_, to_), meterings))
+    return since_, to_
 
 
-async def get_plot_data(account_internal_id: str, time_boundaries: GraphRequest) -> GraphData:
-    """gather data for drawing the plot"""
-    account: Account = await MongoDbWrapper().get_account_by_internal_id(account_internal_id)
-    meterings: tp.List[Metering] = await MongoDbWrapper().get_all_meterings(account_internal_id)
-    meterings = filter_metering_by_time(meterings, time_boundaries.since, time_boundaries.to)
-    return meterings, account
+def parse_plot_options(graph_request: GraphRequest) -> PlotOptions:
+    """get the image parameters requested, keeping them within sane limits"""
+    default: PlotOptions = PlotOptions()
+    return PlotOptions(
+        format=graph_request.format or default.format,
+        dpi=min(max(graph_request.dpi or default.dpi, 30), 300),
+        width=min(max(graph_request.width or default.width, 1.0), 20.0),
+        height=min(max(graph_request.height or default.height, 1.0), 20.0),
+    )
+
+
+def parse_sampling_options(graph_request: GraphRequest) -> SamplingOptions:
+    """get the point budget requested and the way to fit the data into it"""
+    max_points: tp.Optional[int] = max(graph_request.max_points, 3) if graph_request.max_points else None
+    return SamplingOptions(max_points=max_points, method=graph_request.downsampling or "rollup")
+
+
+async def get_plot_data(account_internal_id: str, graph_request: GraphRequest) -> GraphData:
+    """
+    gather data identifying the plot: the account, the time boundaries, the latest metering
+    within them and the image and sampling parameters. The meterings are only loaded if the plot is not cached
+    """
+    account: Account = await AccountCache().get_account(account_internal_id)
+    since, to = parse_time_boundaries(graph_request.since, graph_request.to)
+    latest: tp.Optional[Metering] = await get_database().get_latest_metering(account_internal_id, since, to)
+    return account, (since, to), latest, parse_plot_options(graph_request), parse_sampling_options(graph_request)
+
+
+async def load_plot_series(graph_data: GraphData, field: str) -> MeteringSeries:
+    """
+    load the series to draw the plot from. If a point budget is set, the finest rollup tier that fits
+    into it is used instead of raw meterings, or the data is downsampled with LTTB keeping the shape of the field
+    """
+    account, (since, to), latest, _, sampling = graph_data
+    database: DatabaseWrapper = get_database()
+
+    if sampling.max_points is None or latest is None:
+        return await database.get_metering_series(account.internal_id, since, to)
+
+    if sampling.method == "lttb":
+        series: MeteringSeries = await database.get_metering_series(account.internal_id, since, to)
+        return lttb(series, sampling.max_points, field)
+
+    raw_count: int = await database.count_meterings(account.internal_id, since, to)
+    earliest: tp.Optional[Metering] = None if since else await database.get_earliest_metering(account.internal_id)
+    start: datetime = since or (earliest.timestamp if earliest else latest.timestamp)
+    tier, oversized = choose_tier(raw_count, start, to or latest.timestamp, sampling.max_points)
+
+    if tier is None:
+        return await database.get_metering_series(account.internal_id, since, to)
+
+    series = await database.get_rollup_series(account.internal_id, tier, since, to)
+    return lttb(series, sampling.max_points, field) if oversized else series
+
+
+async def load_comparison_series(
+    account_states: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]],
+    since: tp.Optional[datetime],
+    to: tp.Optional[datetime],
+    sampling: SamplingOptions,
+    field: str,
+) -> tp.List[MeteringSeries]:
+    """
+    load the series of the accounts to compare in one query. If a point budget is set, it applies to every series:
+    the finest rollup tier covering the time range within it is used, or the data is downsampled with LTTB
+    """
+    account_internal_ids: tp.List[str] = [account.internal_id for account, _ in account_states]
+    tier: tp.Optional[RollupTier] = None
+    oversized: bool = sampling.max_points is not None and sampling.method == "lttb"
+
+    if sampling.max_points is not None and sampling.method == "rollup":
+        start: datetime = since or min(account.added_on for account, _ in account_states)
+        end: datetime = to or max((state.timestamp for _, state in account_states if state), default=start)
+        # counting the raw meterings of every account would take a query per account
+        tier, oversized = choose_tier(None, start, max(end, start), sampling.max_points)
+
+    series: tp.Dict[str, MeteringSeries] = await get_database().get_series_for_accounts(
+        account_internal_ids, tier, since, to
+    )
+    return [
+        (
+            lttb(series[account_internal_id], sampling.max_points, field)
+            if oversized and sampling.max_points
+            else series[account_internal_id]
+        )
+        for account_internal_id in account_internal_ids
+    ]
+
+
+async def load_rollup_rows(
+    account_internal_id: str,
+    tier: RollupTier,
+    limit: int,
+    after: tp.Optional[datetime],
+    since: tp.Optional[datetime],
+    to: tp.Optional[datetime],
+) -> tp.Tuple[tp.List[Document], tp.Optional[datetime]]:
+    """load a page of rollup buckets as raw data rows and the cursor pointing to the next page"""
+    database: DatabaseWrapper = get_database()
+    rollups: tp.List[Rollup] = await database.get_rollups(account_internal_id, tier, since, to, after, limit)
+    previous: tp.Optional[Rollup] = None
+
+    if rollups:
+        previous = await database.get_previous_rollup(account_internal_id, tier, rollups[0].timestamp)
+
+    next_cursor: tp.Optional[datetime] = rollups[-1].timestamp if len(rollups) == limit else None
+    return get_rollup_rows(rollups, previous), next_cursor
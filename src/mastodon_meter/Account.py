@@ -1,3 +1,4 @@
+import typing as tp
 from dataclasses import dataclass, field
 from datetime import datetime
 from uuid import uuid4
@@ -12,6 +13,7 @@ class Account:
     id: str
     internal_id: str = field(default_factory=lambda: uuid4().hex)
     added_on: datetime = field(default_factory=lambda: datetime.utcnow())
+    metering_interval: tp.Optional[int] = None
 
     @property
     def account_data_link(self) -> str:
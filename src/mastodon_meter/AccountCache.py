@@ -0,0 +1,119 @@
+import os
+import typing as tp
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+
+from loguru import logger
+
+from .Account import Account
+from .Singleton import SingletonMeta
+from .database import get_database
+
+
+@dataclass
+class CacheStats:
+    """Stores the counters of the account cache"""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def as_dict(self) -> tp.Dict[str, tp.Any]:
+        lookups: int = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class AccountCache(metaclass=SingletonMeta):
+    """
+    read-through TTL+LRU cache of the tracked accounts. Every change of the tracked accounts increments
+    a version counter in the database, the cache is dropped once the counter differs from the one it was filled at.
+    The counter is checked at most once per check interval, so changes made by other workers are picked up quickly
+    """
+
+    def __init__(self) -> None:
+        self._ttl: float = float(os.getenv("ACCOUNT_CACHE_TTL", default=300))
+        self._max_size: int = int(os.getenv("ACCOUNT_CACHE_SIZE", default=10000))
+        self._check_interval: float = float(os.getenv("ACCOUNT_CACHE_CHECK_INTERVAL", default=5))
+        self._accounts: "OrderedDict[str, tp.Tuple[float, Account]]" = OrderedDict()
+        self._tracked: tp.Optional[tp.Tuple[float, tp.Dict[str, Account]]] = None
+        self._version: tp.Optional[int] = None
+        self._checked_at: float = 0
+        self.stats: CacheStats = CacheStats()
+
+    def __len__(self) -> int:
+        return len(self._accounts) + (len(self._tracked[1]) if self._tracked else 0)
+
+    def invalidate(self) -> None:
+        """drop the cached accounts, the version counter is checked again on the next lookup"""
+        self._accounts.clear()
+        self._tracked = None
+        self._version = None
+        self._checked_at = 0
+        self.stats.invalidations += 1
+
+    async def _validate(self) -> None:
+        """drop the cache if the tracked accounts were changed since it was filled"""
+        now: float = monotonic()
+        if now - self._checked_at < self._check_interval:
+            return
+
+        version: int = await get_database().get_accounts_version()
+        if self._version is not None and version != self._version:
+            logger.debug(f"Tracked accounts changed (version {self._version} -> {version}), dropping the cache")
+            self.invalidate()
+
+        self._version, self._checked_at = version, now
+
+    async def get_tracked_accounts(self) -> tp.List[Account]:
+        """get the list of all tracked accounts"""
+        await self._validate()
+        now: float = monotonic()
+
+        if self._tracked is not None and self._tracked[0] > now:
+            self.stats.hits += 1
+            return list(self._tracked[1].values())
+
+        self.stats.misses += 1
+        accounts: tp.List[Account] = await get_database().get_tracked_accounts()
+        self._tracked = now + self._ttl, {account.internal_id: account for account in accounts}
+        return accounts
+
+    async def get_account(self, account_internal_id: str) -> Account:
+        """get the account by it's internal id"""
+        await self._validate()
+        now: float = monotonic()
+
+        # a fresh list of the tracked accounts answers the lookups of the tracked and untracked accounts alike
+        if self._tracked is not None and self._tracked[0] > now:
+            self.stats.hits += 1
+            if account_internal_id not in self._tracked[1]:
+                raise KeyError(f"Account {account_internal_id} is not tracked")
+            return self._tracked[1][account_internal_id]
+
+        entry: tp.Optional[tp.Tuple[float, Account]] = self._accounts.get(account_internal_id)
+        if entry is not None and entry[0] > now:
+            self.stats.hits += 1
+            self._accounts.move_to_end(account_internal_id)
+            return entry[1]
+
+        self.stats.misses += 1
+        account: Account = await get_database().get_account_by_internal_id(account_internal_id)
+        self._accounts[account_internal_id] = now + self._ttl, account
+        self._accounts.move_to_end(account_internal_id)
+
+        while len(self._accounts) > self._max_size:
+            self._accounts.popitem(last=False)
+            self.stats.evictions += 1
+
+        return account
+
+    def get_stats(self) -> tp.Dict[str, tp.Any]:
+        return {**self.stats.as_dict(), "size": len(self), "version": self._version}
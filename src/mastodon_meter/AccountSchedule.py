@@ -0,0 +1,181 @@
+import heapq
+import os
+import typing as tp
+from dataclasses import dataclass
+from datetime import timezone
+
+from loguru import logger
+
+from .Account import Account
+from .AccountState import AccountState
+from .Metering import Metering
+
+# ways of choosing the time of the next metering of an account
+SCHEDULE_MODES: tp.Tuple[str, ...] = ("global", "fixed", "adaptive")
+
+
+@dataclass
+class ScheduleEntry:
+    """Stores the polling state of one account"""
+
+    account: Account
+    interval: float
+    due: float
+    toot_count: tp.Optional[int] = None
+    subscribers_count: tp.Optional[int] = None
+
+
+class AccountSchedule:
+    """
+    keeps the tracked accounts in a priority queue ordered by the time their next metering is due.
+    Accounts use their own metering interval if it is set. In the adaptive mode the interval of the other
+    accounts is doubled when their counts don't change and halved when they change quickly
+    """
+
+    def __init__(self, adaptive: bool) -> None:
+        self.adaptive: bool = adaptive
+        self._default_interval: float = float(os.getenv("METERING_INTERVAL", default=0)) or 86400
+        self._min_interval: float = float(os.getenv("METERING_MIN_INTERVAL", default=900))
+        self._max_interval: float = float(os.getenv("METERING_MAX_INTERVAL", default=604800))
+        self._fast_change: int = int(os.getenv("METERING_FAST_CHANGE", default=10))
+        self._retry_delay: float = float(os.getenv("METERING_RETRY_DELAY", default=300))
+        self._entries: tp.Dict[str, ScheduleEntry] = {}
+        self._queue: tp.List[tp.Tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, account_internal_id: object) -> bool:
+        return account_internal_id in self._entries
+
+    def _push(self, entry: ScheduleEntry) -> None:
+        """queue the entry at its due time, queued items left from the previous due times are skipped later"""
+        heapq.heappush(self._queue, (entry.due, entry.account.internal_id))
+
+    def _clamp(self, interval: float) -> float:
+        return min(max(interval, self._min_interval), self._max_interval)
+
+    def _base_interval(self, account: Account) -> float:
+        return float(account.metering_interval) if account.metering_interval else self._default_interval
+
+    def sync(self, accounts: tp.List[Account], states: tp.Dict[str, AccountState], now: float) -> None:
+        """
+        make the schedule hold exactly the provided accounts. New accounts are due one interval
+        after their latest metering (right away if they were never metered)
+        """
+        accounts_by_id: tp.Dict[str, Account] = {account.internal_id: account for account in accounts}
+
+        for internal_id in set(self._entries) - set(accounts_by_id):
+            del self._entries[internal_id]
+
+        for internal_id, account in accounts_by_id.items():
+            entry: tp.Optional[ScheduleEntry] = self._entries.get(internal_id)
+
+            if entry is not None:
+                if account.metering_interval != entry.account.metering_interval:
+                    entry.interval = self._base_interval(account)
+                    entry.due = min(entry.due, now + entry.interval)
+                    self._push(entry)
+                entry.account = account
+                continue
+
+            interval: float = self._base_interval(account)
+            state: tp.Optional[AccountState] = states.get(internal_id)
+            entry = ScheduleEntry(account, interval, now)
+
+            if state is not None:
+                entry.due = state.timestamp.replace(tzinfo=timezone.utc).timestamp() + interval
+                entry.toot_count, entry.subscribers_count = state.toot_count, state.subscribers_count
+
+            self._entries[internal_id] = entry
+            self._push(entry)
+
+        # drop the stale items once they outnumber the live ones
+        if len(self._queue) > 2 * len(self._entries) + 64:
+            self._queue = [(entry.due, internal_id) for internal_id, entry in self._entries.items()]
+            heapq.heapify(self._queue)
+
+    def clear(self) -> None:
+        self._entries = {}
+        self._queue = []
+
+    def next_due(self) -> tp.Optional[float]:
+        """get the time the earliest metering is due at"""
+        while self._queue:
+            due, internal_id = self._queue[0]
+            entry: tp.Optional[ScheduleEntry] = self._entries.get(internal_id)
+
+            if entry is not None and entry.due == due:
+                return due
+
+            heapq.heappop(self._queue)
+
+        return None
+
+    def pop_due(self, now: float) -> tp.List[Account]:
+        """
+        get the accounts due for metering, provisionally rescheduling them one interval later.
+        The accounts, that fail to be metered, are retried sooner with observe_failed
+        """
+        due_accounts: tp.List[Account] = []
+
+        while True:
+            due: tp.Optional[float] = self.next_due()
+            if due is None or due > now:
+                break
+
+            _, internal_id = heapq.heappop(self._queue)
+            entry: ScheduleEntry = self._entries[internal_id]
+            entry.due = now + entry.interval
+            self._push(entry)
+            due_accounts.append(entry.account)
+
+        return due_accounts
+
+    def _adapt(self, entry: ScheduleEntry, change: int, now: float) -> None:
+        """back off if the counts of the account haven't changed, speed up if they changed quickly"""
+        if not self.adaptive or entry.account.metering_interval:
+            return
+
+        if change == 0:
+            interval: float = self._clamp(entry.interval * 2)
+        elif change >= self._fast_change:
+            interval = self._clamp(entry.interval / 2)
+        else:
+            return
+
+        if interval != entry.interval:
+            logger.debug(f"Metering interval of account {entry.account.internal_id} is now {interval} s.")
+            entry.interval = interval
+            entry.due = now + interval
+            self._push(entry)
+
+    def observe(self, metering: Metering, now: float) -> None:
+        """adjust the interval of the account according to the change of its counts"""
+        entry: tp.Optional[ScheduleEntry] = self._entries.get(metering.parent_account_internal_id)
+        if entry is None:
+            return
+
+        if entry.toot_count is not None and entry.subscribers_count is not None:
+            change: int = abs(metering.toot_count - entry.toot_count)
+            change += abs(metering.subscribers_count - entry.subscribers_count)
+            self._adapt(entry, change, now)
+
+        entry.toot_count, entry.subscribers_count = metering.toot_count, metering.subscribers_count
+
+    def observe_unchanged(self, account_internal_id: str, now: float) -> None:
+        """back off polling of the account, that the instance reported unchanged"""
+        entry: tp.Optional[ScheduleEntry] = self._entries.get(account_internal_id)
+        if entry is not None:
+            self._adapt(entry, 0, now)
+
+    def observe_failed(self, account_internal_id: str, now: float) -> None:
+        """retry the account, that failed to be metered, after a short delay instead of a whole interval"""
+        entry: tp.Optional[ScheduleEntry] = self._entries.get(account_internal_id)
+        if entry is None:
+            return
+
+        due: float = now + min(self._retry_delay, entry.interval)
+        if due < entry.due:
+            entry.due = due
+            self._push(entry)
@@ -0,0 +1,46 @@
+import typing as tp
+from dataclasses import dataclass
+from datetime import datetime
+
+from .Metering import Metering
+from .Rollups import ROLLUP_FIELDS
+from .Types import Document
+
+
+@dataclass(frozen=True)
+class AccountState:
+    """Stores the latest counts of an account, the previous ones and the changes between them"""
+
+    parent_account_internal_id: str
+    timestamp: datetime
+    toot_count: int
+    subscribers_count: int
+    previous_timestamp: tp.Optional[datetime] = None
+    previous_toot_count: tp.Optional[int] = None
+    previous_subscribers_count: tp.Optional[int] = None
+    toot_count_delta: tp.Optional[int] = None
+    subscribers_count_delta: tp.Optional[int] = None
+    last_checked: tp.Optional[datetime] = None
+
+
+def get_state_update(metering: Metering) -> tp.List[Document]:
+    """
+    make an update pipeline shifting the current counts of the account state into the previous ones
+    and setting the metering as the current one. Meterings are expected to be applied in chronological order,
+    the ones not newer than the current state change nothing, so that a retried write doesn't shift the state twice
+    """
+    shift: Document = {"previous_timestamp": "$timestamp"}
+    current: Document = {"timestamp": metering.timestamp, "last_checked": metering.timestamp}
+
+    for field in ROLLUP_FIELDS:
+        value: int = getattr(metering, field)
+        shift[f"previous_{field}"] = f"${field}"
+        current[field] = value
+        current[f"{field}_delta"] = {"$subtract": [value, f"$previous_{field}"]}
+
+    # the second stage sees the timestamp of the state before the update, as the first one keeps it
+    is_newer: Document = {"$gt": [metering.timestamp, {"$ifNull": ["$timestamp", datetime.min]}]}
+    return [
+        {"$set": {name: {"$cond": [is_newer, value, f"${name}"]} for name, value in stage.items()}}
+        for stage in (shift, current)
+    ]
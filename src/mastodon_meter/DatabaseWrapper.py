@@ -0,0 +1,280 @@
+import inspect
+import typing as tp
+from abc import ABCMeta, abstractmethod
+from datetime import datetime
+
+from .Account import Account
+from .AccountState import AccountState
+from .Fetching import Validators
+from .Metering import Metering
+from .Metrics import DB_OPERATION_DURATION, timed
+from .Rollups import ROLLUP_TIERS, Rollup, RollupTier
+from .Series import MeteringSeries
+from .Singleton import SingletonMeta
+from .Types import Document
+
+
+class DatabaseMeta(SingletonMeta, ABCMeta):
+    """metaclass of the abstract singletons"""
+
+
+class DatabaseWrapper(metaclass=DatabaseMeta):
+    """
+    The storage interface used by the application. Timestamps are naive UTC datetimes,
+    the data is returned in chronological order unless stated otherwise
+    """
+
+    def __init_subclass__(cls, **kwargs: tp.Any) -> None:
+        """time the public operations of the implementations"""
+        super().__init_subclass__(**kwargs)
+
+        for name, member in inspect.getmembers(cls, inspect.iscoroutinefunction):
+            if not name.startswith("_") and not getattr(member, "__timed__", False):
+                wrapper: tp.Any = timed(DB_OPERATION_DURATION, backend=cls.__name__, operation=name)(member)
+                wrapper.__timed__ = True
+                setattr(cls, name, wrapper)
+
+    @abstractmethod
+    async def ensure_indexes(self) -> None:
+        """create the indexes required by the queries, if they don't exist yet"""
+
+    @abstractmethod
+    async def backfill_rollups(self) -> None:
+        """build the rollups for the meterings gathered before rollups were introduced, only done once"""
+
+    @abstractmethod
+    async def backfill_account_states(self) -> None:
+        """build the states of the accounts metered before the states were introduced, only done once"""
+
+    async def close(self) -> None:
+        """release the resources held by the database connection"""
+
+    @abstractmethod
+    async def add_tracked_account(self, account: Account) -> None:
+        """add the provided account into the list of tracked accounts"""
+
+    @abstractmethod
+    async def add_tracked_accounts(self, accounts: tp.List[Account]) -> tp.List[Account]:
+        """
+        add the provided accounts into the list of tracked accounts in one bulk write, skipping
+        the ones tracked already (with the same instance and id). Returns the accounts added
+        """
+
+    @abstractmethod
+    async def delete_tracked_account(self, account_internal_id: str) -> None:
+        """delete the provided account from the list of tracked accounts"""
+
+    @abstractmethod
+    async def set_metering_interval(self, account_internal_id: str, metering_interval: tp.Optional[int]) -> None:
+        """set the metering interval of the account, None means the default one"""
+
+    @abstractmethod
+    async def get_accounts_version(self) -> int:
+        """get the counter incremented on every change of the tracked accounts"""
+
+    @abstractmethod
+    def iter_tracked_accounts(self) -> tp.AsyncIterator[Account]:
+        """stream all the tracked accounts"""
+
+    async def get_tracked_accounts(self) -> tp.List[Account]:
+        """get the list of all tracked accounts"""
+        return [account async for account in self.iter_tracked_accounts()]
+
+    @abstractmethod
+    async def get_account_by_internal_id(self, account_internal_id: str) -> Account:
+        """get the account by it's internal id"""
+
+    @abstractmethod
+    async def add_meterings(self, meterings: tp.List[Metering]) -> None:
+        """add the provided meterings into the database in any order, skipping the ones stored already"""
+
+    @abstractmethod
+    async def delete_meterings_for_account(self, account_internal_id: str) -> None:
+        """delete all the meterings for the provided account from the database"""
+
+    @abstractmethod
+    def iter_meterings(
+        self,
+        account_internal_id: str,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+        limit: int = 0,
+        batch_size: tp.Optional[int] = None,
+    ) -> tp.AsyncIterator[Metering]:
+        """
+        stream meterings for an account within the time boundaries in chronological
+        order, starting right after the provided timestamp (keyset pagination)
+        """
+
+    @abstractmethod
+    def iter_meterings_for_accounts(
+        self,
+        account_internal_ids: tp.Optional[tp.List[str]] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.AsyncIterator[Metering]:
+        """
+        stream meterings for the accounts (all the stored ones by default) within the time boundaries,
+        ordered by account and then chronologically. Only a batch of meterings is held in memory at a time
+        """
+
+    @abstractmethod
+    async def get_latest_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.Optional[Metering]:
+        """get the most recent metering for an account within the time boundaries"""
+
+    @abstractmethod
+    async def get_earliest_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.Optional[Metering]:
+        """get the oldest metering for an account within the time boundaries"""
+
+    @abstractmethod
+    async def count_meterings(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> int:
+        """count meterings for an account within the time boundaries"""
+
+    async def get_all_meterings(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.List[Metering]:
+        """get all meterings for an account within the time boundaries from the database"""
+        return [metering async for metering in self.iter_meterings(account_internal_id, since, to)]
+
+    @abstractmethod
+    async def get_metering_series(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> MeteringSeries:
+        """get the meterings for an account within the time boundaries as a columnar series"""
+
+    @abstractmethod
+    async def get_series_for_accounts(
+        self,
+        account_internal_ids: tp.List[str],
+        tier: tp.Optional[RollupTier] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.Dict[str, MeteringSeries]:
+        """
+        get the series of many accounts within the time boundaries in one query: the raw meterings,
+        or the last counts of the buckets of the tier. Accounts without data get empty series
+        """
+
+    async def get_meterings_page(
+        self,
+        account_internal_id: str,
+        limit: int,
+        after: tp.Optional[datetime] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.Tuple[tp.List[Metering], tp.Optional[datetime]]:
+        """get one page of meterings for an account and the cursor pointing to the next page"""
+        meterings: tp.List[Metering] = [
+            metering
+            async for metering in self.iter_meterings(account_internal_id, since, to, after, limit, batch_size=limit)
+        ]
+        next_cursor: tp.Optional[datetime] = meterings[-1].timestamp if len(meterings) == limit else None
+        return meterings, next_cursor
+
+    @abstractmethod
+    async def update_account_states(self, meterings: tp.List[Metering]) -> None:
+        """
+        make the provided meterings the current states of their accounts, keeping the previous ones.
+        Meterings not newer than the current state of their account are skipped
+        """
+
+    @abstractmethod
+    async def get_account_states_version(self) -> int:
+        """get the counter incremented on every change of the account states"""
+
+    @abstractmethod
+    async def mark_accounts_checked(self, account_internal_ids: tp.List[str], timestamp: datetime) -> None:
+        """record that the accounts were found unchanged at the provided time, instead of storing new meterings"""
+
+    @abstractmethod
+    async def get_account_states(
+        self, account_internal_ids: tp.Optional[tp.List[str]] = None
+    ) -> tp.List[tp.Tuple[Account, tp.Optional[AccountState]]]:
+        """get tracked accounts with their current states"""
+
+    @abstractmethod
+    async def get_validators(self, account_internal_ids: tp.List[str]) -> tp.Dict[str, Validators]:
+        """get the cache validators of the latest responses for the accounts"""
+
+    @abstractmethod
+    async def save_validators(self, validators: tp.Dict[str, Validators]) -> None:
+        """store the cache validators of the latest responses for the accounts"""
+
+    @abstractmethod
+    async def update_rollups(self, meterings: tp.List[Metering], tiers: tp.Sequence[RollupTier] = ROLLUP_TIERS) -> None:
+        """merge the provided meterings into the buckets of the rollup tiers (every one by default)"""
+
+    @abstractmethod
+    async def get_rollups(
+        self,
+        account_internal_id: str,
+        tier: RollupTier,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+        limit: int = 0,
+    ) -> tp.List[Rollup]:
+        """get the buckets of the tier covering the time boundaries in chronological order"""
+
+    @abstractmethod
+    async def get_rollup_series(
+        self,
+        account_internal_id: str,
+        tier: RollupTier,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> MeteringSeries:
+        """get the last counts of the buckets of the tier covering the time boundaries as a columnar series"""
+
+    @abstractmethod
+    async def get_rollup_changes(
+        self, account_internal_ids: tp.List[str], tier: RollupTier, since: datetime
+    ) -> tp.List[Document]:
+        """
+        get the first and the last counts of each account within the buckets of the tier starting
+        from the provided timestamp. Rows hold the account id under '_id' and '<field>_first', '<field>_last' counts
+        """
+
+    @abstractmethod
+    async def get_previous_rollup(
+        self, account_internal_id: str, tier: RollupTier, before: datetime
+    ) -> tp.Optional[Rollup]:
+        """get the bucket of the tier preceding the provided timestamp"""
+
+    @abstractmethod
+    async def save_stats_snapshot(self, snapshot: Document) -> None:
+        """replace the stats snapshot with the one made by the latest gathering run"""
+
+    @abstractmethod
+    async def get_stats_snapshot(self) -> tp.Optional[Document]:
+        """get the stats snapshot made by the latest gathering run"""
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, holder: str, ttl: int) -> bool:
+        """
+        take or renew the named lease for the provided number of seconds.
+        Fails if the lease is held by someone else and has not expired yet
+        """
+
+    @abstractmethod
+    async def release_lease(self, name: str, holder: str) -> None:
+        """give the named lease up, if it is held by the provided holder"""
+
+    @abstractmethod
+    async def register_worker(self, worker_id: str, ttl: int) -> None:
+        """report the worker alive for the provided number of seconds"""
+
+    @abstractmethod
+    async def unregister_worker(self, worker_id: str) -> None:
+        """remove the worker from the list of alive ones"""
+
+    @abstractmethod
+    async def get_alive_workers(self) -> tp.List[str]:
+        """get the identifiers of the workers, whose heartbeats have not expired yet"""
@@ -0,0 +1,53 @@
+import typing as tp
+from dataclasses import dataclass
+
+import numpy as np
+
+from .Series import MeteringSeries
+
+
+@dataclass(frozen=True)
+class SamplingOptions:
+    """Stores the number of points the client wants to get and the way to reduce the data to it"""
+
+    max_points: tp.Optional[int] = None
+    method: str = "rollup"
+
+
+def lttb(series: MeteringSeries, threshold: int, field: str = "subscribers_count") -> MeteringSeries:
+    """
+    downsample the series with the Largest-Triangle-Three-Buckets algorithm
+    (https://skemman.is/handle/1946/15343), keeping the shape of the chosen counter
+    """
+    size: int = len(series)
+    if threshold >= size or threshold < 3:
+        return series
+
+    x: np.ndarray = series.timestamps.astype(np.float64)
+    y: np.ndarray = series.column(field).astype(np.float64)
+
+    # bucket boundaries for the points between the first and the last one
+    edges: np.ndarray = (np.arange(threshold - 1) * (size - 2) / (threshold - 2)).astype(np.int64) + 1
+    edges[-1] = size - 1
+    next_edges: np.ndarray = np.append(edges[1:], size)
+
+    # the average point of the next bucket is the third vertex of the triangle
+    sums_x: np.ndarray = np.add.reduceat(x, edges)
+    sums_y: np.ndarray = np.add.reduceat(y, edges)
+    lengths: np.ndarray = np.diff(np.append(edges, size))
+    avg_x: np.ndarray = sums_x / lengths
+    avg_y: np.ndarray = sums_y / lengths
+
+    selected: np.ndarray = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    a: int = 0
+
+    for i in range(threshold - 2):
+        start, end = edges[i], next_edges[i]
+        area: np.ndarray = np.abs(
+            (x[a] - avg_x[i + 1]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y[i + 1] - y[a])
+        )
+        a = int(start + np.argmax(area))
+        selected[i + 1] = a
+
+    return series.take(selected)
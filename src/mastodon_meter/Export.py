@@ -0,0 +1,257 @@
+import csv
+import io
+import json
+import typing as tp
+import zlib
+from abc import ABC, abstractmethod
+
+from .Metering import Metering
+
+# columns of the exported meterings, in the order they are written
+EXPORT_COLUMNS: tp.Tuple[str, ...] = (
+    "account_internal_id",
+    "metering_id",
+    "timestamp",
+    "toot_count",
+    "subscribers_count",
+)
+EXPORT_COMPRESSIONS: tp.Tuple[str, ...] = ("zstd", "gzip")
+
+
+class ExportUnavailable(Exception):
+    """raised when the format or the compression requested needs a package that is not installed"""
+
+
+def _to_row(metering: Metering) -> tp.Tuple[str, str, str, int, int]:
+    return (
+        metering.parent_account_internal_id,
+        str(metering.internal_id),
+        metering.timestamp.isoformat(),
+        int(metering.toot_count),
+        int(metering.subscribers_count),
+    )
+
+
+class MeteringEncoder(ABC):
+    """base class of the export formats, turning batches of meterings into bytes"""
+
+    media_type: str = "application/octet-stream"
+    extension: str = "bin"
+    batch_size: int = 1000
+
+    def header(self) -> bytes:
+        return b""
+
+    @abstractmethod
+    def encode(self, meterings: tp.List[Metering]) -> bytes:
+        """encode a batch of meterings"""
+
+    def footer(self) -> bytes:
+        return b""
+
+
+class NdjsonEncoder(MeteringEncoder):
+    """a JSON object per line (http://ndjson.org)"""
+
+    media_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def encode(self, meterings: tp.List[Metering]) -> bytes:
+        return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, _to_row(m)))) + "\n" for m in meterings).encode()
+
+
+class CsvEncoder(MeteringEncoder):
+    """comma separated values with a header row"""
+
+    media_type = "text/csv"
+    extension = "csv"
+
+    def _write(self, rows: tp.Iterable[tp.Sequence[tp.Any]]) -> bytes:
+        buffer: io.StringIO = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+
+    def header(self) -> bytes:
+        return self._write([EXPORT_COLUMNS])
+
+    def encode(self, meterings: tp.List[Metering]) -> bytes:
+        return self._write(_to_row(m) for m in meterings)
+
+
+class _StreamSink:
+    """a file to write into, that hands out what is written once drained, while keeping the position in the stream"""
+
+    def __init__(self) -> None:
+        self._chunks: tp.List[bytes] = []
+        self._position: int = 0
+        self.closed: bool = False
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data: bytes = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ParquetEncoder(MeteringEncoder):
+    """
+    columnar Apache Parquet file compressed with zstd, written a row group at a time.
+    The file metadata goes into the footer, so the file is only readable once it is complete
+    """
+
+    media_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+    batch_size = 10000
+
+    def __init__(self) -> None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportUnavailable("Parquet export requires the pyarrow package, install the 'export' extra")
+
+        self._pyarrow: tp.Any = pyarrow
+        self._schema: tp.Any = pyarrow.schema(
+            [
+                ("account_internal_id", pyarrow.string()),
+                ("metering_id", pyarrow.string()),
+                ("timestamp", pyarrow.timestamp("us")),
+                ("toot_count", pyarrow.int64()),
+                ("subscribers_count", pyarrow.int64()),
+            ]
+        )
+        self._sink: _StreamSink = _StreamSink()
+        self._writer: tp.Any = pyarrow.parquet.ParquetWriter(self._sink, self._schema, compression="zstd")
+
+    def encode(self, meterings: tp.List[Metering]) -> bytes:
+        columns: tp.Dict[str, tp.List[tp.Any]] = {
+            "account_internal_id": [m.parent_account_internal_id for m in meterings],
+            "metering_id": [str(m.internal_id) for m in meterings],
+            "timestamp": [m.timestamp for m in meterings],
+            "toot_count": [int(m.toot_count) for m in meterings],
+            "subscribers_count": [int(m.subscribers_count) for m in meterings],
+        }
+        self._writer.write_table(self._pyarrow.Table.from_pydict(columns, schema=self._schema))
+        return self._sink.drain()
+
+    def footer(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+EXPORT_FORMATS: tp.Dict[str, tp.Type[MeteringEncoder]] = {
+    "ndjson": NdjsonEncoder,
+    "csv": CsvEncoder,
+    "parquet": ParquetEncoder,
+}
+
+
+class Compressor(tp.Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+def get_compressor(compression: str) -> Compressor:
+    """make a streaming compressor for the content encoding"""
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ExportUnavailable("zstd compression requires the zstandard package, install the 'export' extra")
+        return tp.cast(Compressor, zstandard.ZstdCompressor(level=3).compressobj())
+
+    raise ValueError(f"Unknown compression '{compression}', expected one of: {', '.join(EXPORT_COMPRESSIONS)}")
+
+
+def negotiate_compression(accept_encoding: tp.Optional[str]) -> tp.Optional[str]:
+    """choose the best supported compression the client accepts, if any"""
+    accepted: tp.Set[str] = set()
+    for value in (accept_encoding or "").split(","):
+        coding, *parameters = value.split(";")
+        weights: tp.List[str] = [p.strip()[2:] for p in parameters if p.strip().startswith("q=")]
+        try:
+            if not weights or float(weights[0]) > 0:
+                accepted.add(coding.strip().lower())
+        except ValueError:
+            continue
+
+    for compression in EXPORT_COMPRESSIONS:
+        if compression in accepted:
+            try:
+                get_compressor(compression)
+                return compression
+            except ExportUnavailable:
+                continue
+
+    return None
+
+
+class MeteringExport:
+    """
+    streams meterings in the requested format and compression. The meterings are encoded
+    and compressed a batch at a time, so memory use doesn't depend on the size of the export
+    """
+
+    def __init__(self, export_format: str = "ndjson", compression: tp.Optional[str] = None) -> None:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format '{export_format}', expected one of: {', '.join(EXPORT_FORMATS)}")
+
+        self._encoder: MeteringEncoder = EXPORT_FORMATS[export_format]()
+        self._compressor: tp.Optional[Compressor] = get_compressor(compression) if compression else None
+        self.compression: tp.Optional[str] = compression
+        self.filename: str = f"meterings.{self._encoder.extension}"
+
+    @property
+    def media_type(self) -> str:
+        return self._encoder.media_type
+
+    @property
+    def headers(self) -> tp.Dict[str, str]:
+        headers: tp.Dict[str, str] = {"Content-Disposition": f'attachment; filename="{self.filename}"'}
+        if self.compression:
+            headers["Content-Encoding"] = self.compression
+        return headers
+
+    def _compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) if self._compressor and data else data
+
+    async def stream(self, meterings: tp.AsyncIterator[Metering]) -> tp.AsyncIterator[bytes]:
+        """encode the meterings as they are read from the database"""
+        chunk: bytes = self._compress(self._encoder.header())
+        batch: tp.List[Metering] = []
+
+        async for metering in meterings:
+            batch.append(metering)
+            if len(batch) < self._encoder.batch_size:
+                continue
+
+            chunk += self._compress(self._encoder.encode(batch))
+            batch = []
+            if chunk:
+                yield chunk
+                chunk = b""
+
+        if batch:
+            chunk += self._compress(self._encoder.encode(batch))
+        chunk += self._compress(self._encoder.footer())
+        if self._compressor is not None:
+            chunk += self._compressor.flush()
+        if chunk:
+            yield chunk
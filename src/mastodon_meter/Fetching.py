@@ -0,0 +1,476 @@
+import asyncio
+import os
+import re
+import typing as tp
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from time import monotonic
+
+import httpx
+from loguru import logger
+
+from .Account import Account
+from .Metrics import FETCH_DURATION, FETCH_ERRORS
+from .Resilience import (
+    CircuitBreaker,
+    CircuitOpen,
+    InstanceStats,
+    MalformedResponse,
+    RetryPolicy,
+    get_rate_limit_delay,
+    is_retryable,
+)
+from .Types import ResponsePayload
+
+# fields of the account entity (https://docs.joinmastodon.org/entities/account/) meterings are made of
+COUNTER_FIELDS: tp.Tuple[str, ...] = ("statuses_count", "followers_count")
+
+
+@dataclass(frozen=True)
+class Validators:
+    """Stores the cache validators of the latest response for an account entity"""
+
+    etag: tp.Optional[str] = None
+    last_modified: tp.Optional[str] = None
+
+    @property
+    def headers(self) -> tp.Dict[str, str]:
+        """headers making the request conditional"""
+        headers: tp.Dict[str, str] = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+@dataclass(frozen=True)
+class FetchResult:
+    """Stores the outcome of fetching data for one account"""
+
+    account: Account
+    payload: tp.Optional[ResponsePayload] = None
+    error: tp.Optional[str] = None
+    not_modified: bool = False
+    validators: tp.Optional[Validators] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.payload is not None
+
+
+class CounterScanner:
+    """
+    incrementally scans the top level of a JSON object for the values of integer fields, skipping
+    everything else without decoding it, so that the rest of the response doesn't have to be parsed
+    """
+
+    _structural: tp.Pattern[bytes] = re.compile(rb'[{}\[\]"]')
+    _string: tp.Pattern[bytes] = re.compile(rb'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+    _number: tp.Pattern[bytes] = re.compile(rb"\s*:\s*(-?\d+)(?=[\s,}])")
+    _incomplete_number: tp.Pattern[bytes] = re.compile(rb"\s*(:\s*-?\d*)?")
+
+    def __init__(self, fields: tp.Iterable[str]) -> None:
+        self._fields: tp.Dict[bytes, str] = {field.encode(): field for field in fields}
+        self.values: tp.Dict[str, int] = {}
+        self._buffer: bytes = b""
+        self._depth: int = 0
+
+    @property
+    def done(self) -> bool:
+        return len(self.values) == len(self._fields)
+
+    def feed(self, chunk: bytes) -> bool:
+        """scan the next chunk of the document, return True once all the fields are found"""
+        buffer: bytes = self._buffer + chunk
+        position: int = 0
+
+        while not self.done:
+            match: tp.Optional[tp.Match[bytes]] = self._structural.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+
+            if match.group() != b'"':
+                self._depth += 1 if match.group() in b"{[" else -1
+                position = match.end()
+                continue
+
+            string: tp.Optional[tp.Match[bytes]] = self._string.match(buffer, match.start())
+            if string is None:
+                # the string continues in the next chunk
+                position = match.start()
+                break
+
+            position = string.end()
+            if self._depth != 1 or string.group(1) not in self._fields:
+                continue
+
+            number: tp.Optional[tp.Match[bytes]] = self._number.match(buffer, position)
+            if number is not None:
+                self.values[self._fields[string.group(1)]] = int(number.group(1))
+                position = number.end()
+            elif self._incomplete_number.fullmatch(buffer, position):
+                # the value of the field continues in the next chunk
+                position = match.start()
+                break
+
+        self._buffer = buffer[position:]
+        return self.done
+
+
+class InstanceResponse(tp.NamedTuple):
+    """a response of an instance along with its decoded payload"""
+
+    response: httpx.Response
+    payload: tp.Any
+
+
+class InstanceThrottle:
+    """
+    limits the number of simultaneous requests and the request rate towards one Mastodon instance.
+    The throttle is shared by all the runs of the worker, the asyncio primitives are made for the event loop
+    it is used in, while the rate limit state (including the pauses asked by the instance) is kept
+    """
+
+    def __init__(self, max_connections: int, requests_per_second: float) -> None:
+        self._max_connections: int = max_connections
+        self._interval: float = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._next_slot: float = 0
+        self._loop: tp.Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(max_connections)
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+    def _bind(self) -> None:
+        """make the asyncio primitives anew, when the throttle is first used in another event loop"""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self._max_connections)
+            self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """hold the requests back for the provided time, when the instance asks for it"""
+        self._next_slot = max(self._next_slot, monotonic() + seconds)
+
+    async def _wait_for_slot(self) -> None:
+        """wait until the next request is allowed by the rate limit"""
+        async with self._lock:
+            now: float = monotonic()
+            delay: float = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aenter__(self) -> None:
+        self._bind()
+        await self._semaphore.acquire()
+        try:
+            await self._wait_for_slot()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def __aexit__(self, *_: tp.Any) -> None:
+        self._semaphore.release()
+
+
+class Fetcher:
+    """performs throttled requests to Mastodon instances"""
+
+    def __init__(self) -> None:
+        self.concurrency: int = int(os.getenv("GATHERING_CONCURRENCY", default=50))
+        self._instance_connections: int = int(os.getenv("INSTANCE_CONCURRENCY", default=4))
+        self._instance_rate: float = float(os.getenv("INSTANCE_RATE_LIMIT", default=5))
+        self._timeout: float = float(os.getenv("REQUEST_TIMEOUT", default=10))
+        self._throttles: tp.Dict[str, InstanceThrottle] = {}
+        self._retry_policy: RetryPolicy = RetryPolicy()
+        self._failure_threshold: int = int(os.getenv("INSTANCE_FAILURE_THRESHOLD", default=5))
+        self._cooldown: float = float(os.getenv("INSTANCE_COOLDOWN", default=60))
+        self._breakers: tp.Dict[str, CircuitBreaker] = {}
+        self._stats: tp.Dict[str, InstanceStats] = {}
+        self.validators: tp.Dict[str, Validators] = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        """create an HTTP/2 capable client, that keeps connections to the instances alive during the run"""
+        limits = httpx.Limits(
+            max_connections=self.concurrency,
+            max_keepalive_connections=self.concurrency,
+        )
+        timeout = httpx.Timeout(self._timeout, connect=min(self._timeout, 5.0))
+        return httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+
+    def _get_throttle(self, instance: str) -> InstanceThrottle:
+        """get the throttle for the instance, creating one if needed"""
+        if instance not in self._throttles:
+            self._throttles[instance] = InstanceThrottle(self._instance_connections, self._instance_rate)
+        return self._throttles[instance]
+
+    def _get_breaker(self, instance: str) -> CircuitBreaker:
+        if instance not in self._breakers:
+            self._breakers[instance] = CircuitBreaker(self._failure_threshold, self._cooldown)
+        return self._breakers[instance]
+
+    def _get_stats(self, instance: str) -> InstanceStats:
+        if instance not in self._stats:
+            self._stats[instance] = InstanceStats()
+        return self._stats[instance]
+
+    def get_instance_stats(self) -> tp.Dict[str, tp.Dict[str, tp.Any]]:
+        """get request stats and circuit states of the instances requested by this worker"""
+        return {
+            instance: {**stats.as_dict(), "circuit": self._get_breaker(instance).state}
+            for instance, stats in sorted(self._stats.items())
+        }
+
+    def _respect_rate_limit(self, instance: str, response: httpx.Response) -> None:
+        """slow down if the instance reports its rate limit exhausted, stop requesting it if the wait is too long"""
+        delay: tp.Optional[float] = get_rate_limit_delay(response)
+        if delay is None:
+            return
+
+        if delay > self._retry_policy.max_delay:
+            logger.warning(f"Instance {instance} is rate limited for {delay:.0f} s., skipping it until then")
+            self._get_breaker(instance).open(delay)
+        else:
+            self._get_throttle(instance).pause(delay)
+
+    async def _request(self, instance: str, send: tp.Callable[[], tp.Awaitable[InstanceResponse]]) -> InstanceResponse:
+        """
+        make a throttled request to the instance, retrying temporary failures with backoff.
+        Requests to instances that keep failing are cut short by the circuit breaker
+        """
+        breaker: CircuitBreaker = self._get_breaker(instance)
+        stats: InstanceStats = self._get_stats(instance)
+
+        attempt: int = 0
+        while True:
+            try:
+                trial: bool = breaker.check()
+            except CircuitOpen:
+                stats.rejected += 1
+                FETCH_ERRORS.inc(instance=instance, error=CircuitOpen.__name__)
+                raise
+
+            t0: float = monotonic()
+            try:
+                async with self._get_throttle(instance):
+                    t0 = monotonic()
+                    result: InstanceResponse = await send()
+
+            except asyncio.CancelledError:
+                if trial:
+                    breaker.abandon_trial()
+                raise
+
+            except Exception as e:
+                response: tp.Optional[httpx.Response] = None
+                if isinstance(e, httpx.HTTPStatusError):
+                    response = e.response
+                elapsed: float = monotonic() - t0
+                stats.record(elapsed, response.status_code if response is not None else None, e)
+                FETCH_DURATION.observe(elapsed, instance=instance)
+                FETCH_ERRORS.inc(instance=instance, error=type(e).__name__)
+
+                if not is_retryable(e):
+                    # the instance is alive, the request itself is wrong
+                    breaker.record_success()
+                    raise
+
+                breaker.record_failure()
+                if response is not None:
+                    self._respect_rate_limit(instance, response)
+
+                delay: float = self._retry_policy.get_delay(attempt, e)
+                if attempt + 1 == self._retry_policy.attempts or delay > self._retry_policy.max_delay:
+                    raise
+
+                stats.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            elapsed = monotonic() - t0
+            stats.record(elapsed, result.response.status_code)
+            FETCH_DURATION.observe(elapsed, instance=instance)
+            breaker.record_success()
+            self._respect_rate_limit(instance, result.response)
+            return result
+
+    async def get_json(self, client: httpx.AsyncClient, instance: str, url: str, **kwargs: tp.Any) -> tp.Any:
+        """make a throttled GET request to the instance and return the decoded payload"""
+
+        async def _send() -> InstanceResponse:
+            response: httpx.Response = await client.get(url, **kwargs)
+            response.raise_for_status()
+            return InstanceResponse(response, response.json())
+
+        result: InstanceResponse = await self._request(instance, _send)
+        return result.payload
+
+    async def fetch_account(self, client: httpx.AsyncClient, account: Account) -> FetchResult:
+        """
+        fetch the counters of the account entity with a conditional request, never raising on failure.
+        The response is only scanned until both counters are found
+        """
+        previous: Validators = self.validators.get(account.internal_id, Validators())
+
+        async def _send() -> InstanceResponse:
+            scanner: CounterScanner = CounterScanner(COUNTER_FIELDS)
+
+            async with client.stream("GET", account.account_data_link, headers=previous.headers) as response:
+                if response.status_code == 304:
+                    return InstanceResponse(response, None)
+
+                response.raise_for_status()
+                # the rest of the body is still read, leaving the stream early would close the connection
+                async for chunk in response.aiter_bytes():
+                    if not scanner.done:
+                        scanner.feed(chunk)
+
+            if not scanner.done:
+                raise MalformedResponse(f"Counters are missing from the response, found only: {list(scanner.values)}")
+            return InstanceResponse(response, dict(scanner.values))
+
+        try:
+            result: InstanceResponse = await self._request(account.instance, _send)
+            if result.payload is None:
+                return FetchResult(account=account, not_modified=True)
+
+            headers: httpx.Headers = result.response.headers
+            validators: Validators = Validators(headers.get("etag"), headers.get("last-modified"))
+            if validators != previous:
+                self.validators[account.internal_id] = validators
+
+            return FetchResult(
+                account=account, payload=result.payload, validators=validators if validators != previous else None
+            )
+
+        except Exception as e:
+            message: str = f"{type(e).__name__}: {e}"
+            logger.warning(f"Failed to fetch data for account {account.internal_id}: {message}")
+            return FetchResult(account=account, error=message)
+
+
+FetchJob = tp.Awaitable[tp.List[FetchResult]]
+
+
+class FetchStrategy(ABC):
+    """base class for the ways of splitting the tracked accounts into fetching jobs"""
+
+    def __init__(self, fetcher: Fetcher) -> None:
+        self._fetcher: Fetcher = fetcher
+
+    async def _fetch_account(
+        self, client: httpx.AsyncClient, account: Account, limiter: asyncio.Semaphore
+    ) -> FetchResult:
+        """fetch an account with its own request, once the limiter lets it through"""
+        async with limiter:
+            return await self._fetcher.fetch_account(client, account)
+
+    @abstractmethod
+    def plan(
+        self, client: httpx.AsyncClient, accounts: tp.List[Account], limiter: asyncio.Semaphore
+    ) -> tp.List[FetchJob]:
+        """
+        get the list of jobs, that fetch data for all the provided accounts. The jobs hold
+        a slot of the limiter for every request they send, bounding the concurrency of the run
+        """
+
+
+class SingleFetchStrategy(FetchStrategy):
+    """fetches every account with its own request"""
+
+    async def _fetch_one(
+        self, client: httpx.AsyncClient, account: Account, limiter: asyncio.Semaphore
+    ) -> tp.List[FetchResult]:
+        return [await self._fetch_account(client, account, limiter)]
+
+    def plan(
+        self, client: httpx.AsyncClient, accounts: tp.List[Account], limiter: asyncio.Semaphore
+    ) -> tp.List[FetchJob]:
+        return [self._fetch_one(client, account, limiter) for account in accounts]
+
+
+class BatchedFetchStrategy(FetchStrategy):
+    """
+    fetches accounts on the same instance in batches using the multi-id lookup
+    endpoint (https://docs.joinmastodon.org/methods/accounts/#index), falling back
+    to single requests on instances that do not support it
+    """
+
+    batch_size: int = 40
+    # status codes signalling that the instance does not know the endpoint
+    _unsupported_codes: tp.FrozenSet[int] = frozenset((400, 404, 405, 410, 422, 501))
+
+    def __init__(self, fetcher: Fetcher) -> None:
+        super().__init__(fetcher)
+        self._unsupported_instances: tp.Set[str] = set()
+
+    async def _fetch_singly(
+        self, client: httpx.AsyncClient, accounts: tp.List[Account], limiter: asyncio.Semaphore
+    ) -> tp.List[FetchResult]:
+        """fetch every account in the batch with its own request, each taking its own slot of the limiter"""
+        return list(await asyncio.gather(*(self._fetch_account(client, a, limiter) for a in accounts)))
+
+    async def _fetch_batch(
+        self, client: httpx.AsyncClient, accounts: tp.List[Account], limiter: asyncio.Semaphore
+    ) -> tp.List[FetchResult]:
+        """fetch a batch of accounts hosted on the same instance with one request"""
+        instance: str = accounts[0].instance
+
+        if instance in self._unsupported_instances:
+            return await self._fetch_singly(client, accounts, limiter)
+
+        try:
+            url: str = f"{instance}/api/v1/accounts"
+            params: tp.List[tp.Tuple[str, str]] = [("id[]", account.id) for account in accounts]
+            # the slot is given back before falling back to single requests, which take their own slots
+            async with limiter:
+                payload: tp.Any = await self._fetcher.get_json(client, instance, url, params=params)
+
+            if not isinstance(payload, list):
+                raise ValueError("Expected a list of account entities")
+
+        except (httpx.HTTPStatusError, ValueError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code not in self._unsupported_codes:
+                return [FetchResult(account=account, error=f"{type(e).__name__}: {e}") for account in accounts]
+
+            logger.info(f"Instance {instance} does not support batched account lookup ({e}), falling back")
+            self._unsupported_instances.add(instance)
+            return await self._fetch_singly(client, accounts, limiter)
+
+        except Exception as e:
+            message: str = f"{type(e).__name__}: {e}"
+            logger.warning(f"Failed to fetch a batch of {len(accounts)} accounts from {instance}: {message}")
+            return [FetchResult(account=account, error=message) for account in accounts]
+
+        entities: tp.Dict[str, ResponsePayload] = {str(entity.get("id")): entity for entity in payload}
+        return [
+            (
+                FetchResult(account=account, payload=entities[account.id])
+                if account.id in entities
+                else FetchResult(account=account, error="Account is missing from the batch response")
+            )
+            for account in accounts
+        ]
+
+    def plan(
+        self, client: httpx.AsyncClient, accounts: tp.List[Account], limiter: asyncio.Semaphore
+    ) -> tp.List[FetchJob]:
+        by_instance: tp.Dict[str, tp.List[Account]] = {}
+        for account in accounts:
+            by_instance.setdefault(account.instance, []).append(account)
+
+        return [
+            self._fetch_batch(client, instance_accounts[i : i + self.batch_size], limiter)
+            for instance_accounts in by_instance.values()
+            for i in range(0, len(instance_accounts), self.batch_size)
+        ]
+
+
+FETCH_STRATEGIES: tp.Dict[str, tp.Type[FetchStrategy]] = {
+    "single": SingleFetchStrategy,
+    "batched": BatchedFetchStrategy,
+}
@@ -2,21 +2,85 @@ import asyncio
 import datetime as dt
 import os
 import typing as tp
+from dataclasses import dataclass
+from functools import partial
 from time import time
 
-import httpx
 from loguru import logger
 
 from .Account import Account
+from .AccountCache import AccountCache
+from .AccountSchedule import SCHEDULE_MODES, AccountSchedule
+from .AccountState import AccountState
+from .DatabaseWrapper import DatabaseWrapper
+from .Fetching import FETCH_STRATEGIES, Fetcher, FetchResult, FetchStrategy
+from .Importer import AccountImporter, ImportSummary
 from .Metering import Metering
+from .Metrics import GATHER_DURATION, GATHERED_ACCOUNTS
+from .PlotCache import PlotCache
+from .Reporter import Reporter
+from .Rollups import ROLLUP_TIER_NAMES, ROLLUP_TIERS
+from .Scheduler import Scheduler
 from .Singleton import SingletonMeta
-from .Types import ResponsePayload
-from .database import MongoDbWrapper
+from .Types import Document
+from .WriteBuffer import WriteBatch, WriteBuffer
+from .database import get_database
+
+
+@dataclass(frozen=True)
+class GatheringSummary:
+    """Stores the outcome of one gathering run"""
+
+    metering_count: int
+    failed_count: int
+    execution_time: float
+    unchanged_count: int = 0
+
+    @property
+    def rate(self) -> float:
+        """number of accounts fetched per second"""
+        fetched: int = self.metering_count + self.unchanged_count
+        return round(fetched / self.execution_time, 2) if self.execution_time else 0.0
 
 
 class Gatherer(metaclass=SingletonMeta):
     """Gathers data for all the tracked accounts and stores it in the database"""
 
+    def __init__(self) -> None:
+        self._fetcher: Fetcher = Fetcher()
+        self._strategy: FetchStrategy = self._get_strategy(self._fetcher)
+        self._buffer: WriteBuffer = WriteBuffer(self._store_results)
+        self._schedule: tp.Optional[AccountSchedule] = self._get_schedule()
+        # a full scan of the rollups is not worth repeating after every small scheduled run
+        self._snapshot_interval: int = int(os.getenv("STATS_SNAPSHOT_INTERVAL", default=3600))
+        self._snapshot_updated_at: float = 0
+
+    @staticmethod
+    def _get_schedule() -> tp.Optional[AccountSchedule]:
+        """get the per-account schedule selected with the $METERING_SCHEDULE environment variable, if any"""
+        mode: str = os.getenv("METERING_SCHEDULE", default="global")
+
+        if mode not in SCHEDULE_MODES:
+            message = f"Unknown metering schedule '{mode}', expected one of: {', '.join(SCHEDULE_MODES)}"
+            logger.critical(message)
+            raise ValueError(message)
+
+        logger.info(f"Using '{mode}' metering schedule")
+        return AccountSchedule(adaptive=mode == "adaptive") if mode != "global" else None
+
+    @staticmethod
+    def _get_strategy(fetcher: Fetcher) -> FetchStrategy:
+        """get the fetching strategy selected with the $GATHERING_STRATEGY environment variable"""
+        name: str = os.getenv("GATHERING_STRATEGY", default="single")
+
+        if name not in FETCH_STRATEGIES:
+            message = f"Unknown gathering strategy '{name}', expected one of: {', '.join(FETCH_STRATEGIES)}"
+            logger.critical(message)
+            raise ValueError(message)
+
+        logger.info(f"Using '{name}' gathering strategy")
+        return FETCH_STRATEGIES[name](fetcher)
+
     @staticmethod
     def _get_delay() -> int:
         """get delay time"""
@@ -40,35 +104,227 @@ class Gatherer(metaclass=SingletonMeta):
     async def start_metering_daemon(self) -> None:
         """sets a never ending task for metering"""
         logger.info("Started metering daemon")
+
+        if self._schedule is not None:
+            await self._run_account_schedule(self._schedule)
+            return
+
         while True:
             delay: int = self._get_delay()
             logger.info(f"Sleeping {delay} s. before next metering.")
             await asyncio.sleep(delay)
-            await self.gather_meterings()
+
+            try:
+                accounts: tp.Optional[tp.List[Account]] = await Scheduler().get_assigned_accounts()
+                if accounts is not None:
+                    await self.gather_meterings(accounts)
+            except Exception as e:
+                logger.error(f"An error occurred while gathering meterings: {e}")
+
+    async def _run_account_schedule(self, schedule: AccountSchedule) -> None:
+        """meter every account when it is due, refreshing the list of the accounts assigned to this worker regularly"""
+        refresh_period: float = float(os.getenv("SCHEDULE_REFRESH_PERIOD", default=60))
+
+        while True:
+            try:
+                accounts: tp.Optional[tp.List[Account]] = await Scheduler().get_assigned_accounts()
+
+                if accounts is None:
+                    schedule.clear()
+                else:
+                    new_ids: tp.List[str] = [a.internal_id for a in accounts if a.internal_id not in schedule]
+                    states: tp.Dict[str, AccountState] = {}
+                    if new_ids:
+                        account_states: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]] = (
+                            await get_database().get_account_states(new_ids)
+                        )
+                        states = {a.internal_id: state for a, state in account_states if state is not None}
+                    schedule.sync(accounts, states, time())
+
+                due_accounts: tp.List[Account] = schedule.pop_due(time())
+                if due_accounts:
+                    await self.gather_meterings(due_accounts)
+
+            except Exception as e:
+                logger.error(f"An error occurred while gathering meterings: {e}")
+
+            next_due: tp.Optional[float] = schedule.next_due()
+            delay: float = refresh_period if next_due is None else min(max(next_due - time(), 1), refresh_period)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _parse_metering(result: FetchResult) -> tp.Optional[Metering]:
+        """make a metering out of the fetched account entity"""
+        if not result.ok or result.payload is None:
+            return None
+
+        try:
+            return Metering(
+                toot_count=int(result.payload["statuses_count"]),
+                subscribers_count=int(result.payload["followers_count"]),
+                parent_account_internal_id=result.account.internal_id,
+            )
+
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Malformed account entity for account {result.account.internal_id}: {e}")
+            return None
+
+    @staticmethod
+    async def _store_results(batch: WriteBatch) -> None:
+        """
+        write a batch of meterings, their rollups and account states into the database, dropping the plots
+        and reports they make outdated. Accounts that haven't changed only get marked as checked.
+        A retried batch skips the steps done by the failed write, merging a metering into the rollups twice
+        would count it twice
+        """
+        database: DatabaseWrapper = get_database()
+        if batch.validators:
+            await database.save_validators(batch.validators)
+        if batch.unchanged:
+            await database.mark_accounts_checked(batch.unchanged, dt.datetime.utcnow())
+        if not batch.meterings:
+            return
+
+        steps: tp.List[tp.Tuple[str, tp.Callable[[tp.List[Metering]], tp.Awaitable[None]]]] = [
+            ("meterings", database.add_meterings),
+            *((f"rollups-{tier.name}", partial(database.update_rollups, tiers=[tier])) for tier in ROLLUP_TIERS),
+            ("account-states", database.update_account_states),
+        ]
+        for step, write in steps:
+            meterings: tp.List[Metering] = batch.pending(step)
+            if meterings:
+                await write(meterings)
+                batch.complete(step, meterings)
+
+        PlotCache().invalidate_accounts(m.parent_account_internal_id for m in batch.meterings)
+        Reporter().invalidate_reports()
 
     @staticmethod
-    async def gather_meterings() -> tp.Tuple[int, float]:
-        """do meterings for all the tracked accounts asynchronously"""
+    async def _update_stats_snapshot(accounts: tp.List[Account]) -> None:
+        """precompute the cross-account metrics percentile ranks are based on"""
+        try:
+            since: dt.datetime = dt.datetime.utcnow() - dt.timedelta(days=7)
+            account_internal_ids: tp.List[str] = [account.internal_id for account in accounts]
+            changes: tp.List[Document] = await get_database().get_rollup_changes(
+                account_internal_ids, ROLLUP_TIER_NAMES["daily"], since
+            )
+            await get_database().save_stats_snapshot(Reporter().get_stats_snapshot(changes))
+
+        except Exception as e:
+            logger.error(f"An error occurred while updating the stats snapshot: {e}")
+
+    async def _load_validators(self, accounts: tp.List[Account]) -> None:
+        """load the cache validators for the accounts, that were not fetched by this worker yet"""
+        missing: tp.List[str] = [a.internal_id for a in accounts if a.internal_id not in self._fetcher.validators]
+        if missing:
+            self._fetcher.validators.update(await get_database().get_validators(missing))
+
+    def get_instance_stats(self) -> tp.Dict[str, tp.Dict[str, tp.Any]]:
+        """get request stats and circuit states of the instances requested by this worker"""
+        return self._fetcher.get_instance_stats()
+
+    async def gather_meterings(self, accounts: tp.Optional[tp.List[Account]] = None) -> GatheringSummary:
+        """
+        do meterings for the provided accounts (all the tracked ones by default) concurrently,
+        storing the results as they arrive
+        """
         t0: float = time()
-        tracked_accounts: tp.List[Account] = await MongoDbWrapper().get_tracked_accounts()
-        meterings: tp.List[Metering] = []
+        tracked_accounts: tp.List[Account] = (
+            accounts if accounts is not None else await AccountCache().get_tracked_accounts()
+        )
         logger.info(f"Gathering meterings for {len(tracked_accounts)} accounts")
 
-        async with httpx.AsyncClient() as client:
-            for account in tracked_accounts:
-                response: httpx.Response = await client.get(account.account_data_link)
-                response_payload: ResponsePayload = response.json()
-                meterings.append(
-                    Metering(
-                        toot_count=response_payload["statuses_count"],
-                        subscribers_count=response_payload["followers_count"],
-                        parent_account_internal_id=account.internal_id,
-                    )
-                )
-
-        await MongoDbWrapper().add_meterings(meterings)
-
-        metering_count: int = len(meterings)
-        execution_time: float = round(time() - t0, 3)
-        logger.info(f"Gathered {metering_count} meterings in {execution_time} seconds.")
-        return metering_count, execution_time
+        await self._load_validators(tracked_accounts)
+        limiter: asyncio.Semaphore = asyncio.Semaphore(self._fetcher.concurrency)
+        flushes, flush_time = self._buffer.stats.flushes, self._buffer.stats.total_time
+        metering_count: int = 0
+        unchanged_count: int = 0
+        failed_count: int = 0
+        metered_ids: tp.Set[str] = set()
+
+        async with self._fetcher.get_client() as client:
+            # the jobs take a slot of the limiter for every request they send
+            tasks: tp.List["asyncio.Future[tp.List[FetchResult]]"] = [
+                asyncio.ensure_future(job) for job in self._strategy.plan(client, tracked_accounts, limiter)
+            ]
+
+            try:
+                for future in asyncio.as_completed(tasks):
+                    try:
+                        results: tp.List[FetchResult] = await future
+                    except Exception as e:
+                        logger.error(f"A fetching job failed unexpectedly: {type(e).__name__}: {e}")
+                        continue
+
+                    for result in results:
+                        if result.validators is not None:
+                            self._buffer.add_validators(result.account.internal_id, result.validators)
+
+                        if result.not_modified:
+                            await self._buffer.add_unchanged(result.account.internal_id)
+                            unchanged_count += 1
+                            metered_ids.add(result.account.internal_id)
+                            if self._schedule is not None:
+                                self._schedule.observe_unchanged(result.account.internal_id, time())
+                            continue
+
+                        metering: tp.Optional[Metering] = self._parse_metering(result)
+
+                        if metering is None:
+                            failed_count += 1
+                            continue
+
+                        await self._buffer.add_metering(metering)
+                        metering_count += 1
+                        metered_ids.add(metering.parent_account_internal_id)
+                        if self._schedule is not None:
+                            self._schedule.observe(metering, time())
+
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+                # the accounts left without results, including the ones of the failed jobs, are retried soon
+                if self._schedule is not None:
+                    for account in tracked_accounts:
+                        if account.internal_id not in metered_ids:
+                            self._schedule.observe_failed(account.internal_id, time())
+
+                # the results of the run are durable once it's over
+                await self._buffer.flush()
+
+        if accounts is None or time() - self._snapshot_updated_at >= self._snapshot_interval:
+            self._snapshot_updated_at = time()
+            await self._update_stats_snapshot(
+                tracked_accounts if accounts is None else await AccountCache().get_tracked_accounts()
+            )
+        summary = GatheringSummary(metering_count, failed_count, round(time() - t0, 3), unchanged_count)
+        GATHER_DURATION.observe(time() - t0)
+        GATHERED_ACCOUNTS.inc(metering_count, result="metered")
+        GATHERED_ACCOUNTS.inc(unchanged_count, result="unchanged")
+        GATHERED_ACCOUNTS.inc(failed_count, result="failed")
+        flushes = self._buffer.stats.flushes - flushes
+        flush_time = self._buffer.stats.total_time - flush_time
+        logger.info(
+            f"Gathered {summary.metering_count} meterings in {summary.execution_time} seconds "
+            f"({summary.rate} accounts/s., {summary.unchanged_count} unchanged, {summary.failed_count} failed), "
+            f"written in {flushes} batches averaging {flush_time / flushes * 1000 if flushes else 0:.1f} ms."
+        )
+        return summary
+
+    async def import_accounts(
+        self, handles: tp.Iterable[str], metering_interval: tp.Optional[int] = None
+    ) -> ImportSummary:
+        """
+        add accounts to the list of tracked by their handles, storing their first meterings. The instances
+        are requested within the same limits as during gathering
+        """
+        return await AccountImporter(self._fetcher, self._buffer).import_accounts(handles, metering_interval)
+
+    def get_write_stats(self) -> tp.Dict[str, tp.Any]:
+        """get the number and the latency of the database writes made by the gatherer"""
+        return self._buffer.stats.as_dict()
+
+    async def close(self) -> None:
+        """write the buffered results before the worker exits"""
+        await self._buffer.close()
@@ -0,0 +1,219 @@
+import asyncio
+import re
+import typing as tp
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import httpx
+from loguru import logger
+
+from .Account import Account
+from .AccountCache import AccountCache
+from .Fetching import Fetcher
+from .Metering import Metering
+from .Types import ResponsePayload
+from .WriteBuffer import WriteBuffer
+from .database import get_database
+
+# a handle is user@domain, optionally prefixed with @ as Mastodon shows it
+HANDLE_PATTERN: tp.Pattern[str] = re.compile(
+    r"^@?(?P<username>[\w.-]+)@(?P<domain>[a-z0-9-]+(?:\.[a-z0-9-]+)+(?::\d+)?)$", re.IGNORECASE
+)
+# statuses of a lookup response meaning the account doesn't exist (or no longer does) on the instance
+NOT_FOUND_CODES: tp.FrozenSet[int] = frozenset((404, 410))
+
+
+@dataclass(frozen=True)
+class Handle:
+    """Stores a parsed user@domain handle"""
+
+    username: str
+    domain: str
+
+    @property
+    def acct(self) -> str:
+        return f"{self.username}@{self.domain}"
+
+    @property
+    def instance(self) -> str:
+        return f"https://{self.domain}"
+
+    @property
+    def key(self) -> str:
+        """usernames and domains are case insensitive"""
+        return self.acct.lower()
+
+
+def parse_handle(handle: str) -> tp.Optional[Handle]:
+    """parse a user@domain handle, None if it is malformed"""
+    match: tp.Optional[tp.Match[str]] = HANDLE_PATTERN.match(handle.strip())
+    if match is None:
+        return None
+    return Handle(match["username"], match["domain"].lower())
+
+
+@dataclass
+class ImportSummary:
+    """Stores the outcome of an import, the handles are grouped by what happened to them"""
+
+    imported: tp.Dict[str, Account] = field(default_factory=dict)
+    skipped: tp.List[str] = field(default_factory=list)
+    not_found: tp.List[str] = field(default_factory=list)
+    invalid: tp.List[str] = field(default_factory=list)
+    failed: tp.Dict[str, str] = field(default_factory=dict)
+
+
+class AccountImporter:
+    """
+    adds accounts to the list of tracked by their handles. The handles are resolved concurrently within
+    the per-instance limits of the fetcher, the lookup responses also give the first metering of every account,
+    written through the buffer of the gathering results
+    """
+
+    def __init__(self, fetcher: Fetcher, buffer: WriteBuffer) -> None:
+        self._fetcher: Fetcher = fetcher
+        self._buffer: WriteBuffer = buffer
+
+    async def _lookup(self, client: httpx.AsyncClient, instance: str, username: str) -> tp.Optional[ResponsePayload]:
+        """look a local account of the instance up by its username, None if there is no such account"""
+        try:
+            payload: tp.Any = await self._fetcher.get_json(
+                client, instance, f"{instance}/api/v1/accounts/lookup", params={"acct": username}
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in NOT_FOUND_CODES:
+                return None
+            raise
+
+        if not isinstance(payload, dict) or "id" not in payload:
+            raise ValueError("Expected an account entity")
+        return payload
+
+    async def _webfinger(self, client: httpx.AsyncClient, handle: Handle) -> tp.Optional[str]:
+        """
+        find the instance serving the account with WebFinger (https://docs.joinmastodon.org/spec/webfinger/),
+        it differs from the domain of the handle when the domain only delegates to it
+        """
+        try:
+            payload: tp.Any = await self._fetcher.get_json(
+                client,
+                handle.instance,
+                f"{handle.instance}/.well-known/webfinger",
+                params={"resource": f"acct:{handle.acct}"},
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in NOT_FOUND_CODES:
+                return None
+            raise
+
+        for link in payload.get("links", []) if isinstance(payload, dict) else []:
+            if link.get("rel") == "self" and link.get("href"):
+                url = urlsplit(link["href"])
+                return f"{url.scheme}://{url.netloc}"
+        return None
+
+    async def _resolve(
+        self, client: httpx.AsyncClient, handle: Handle, metering_interval: tp.Optional[int]
+    ) -> tp.Optional[tp.Tuple[Account, Metering]]:
+        """find the account behind the handle, None if it doesn't exist"""
+        instance: str = handle.instance
+        payload: tp.Optional[ResponsePayload] = await self._lookup(client, instance, handle.username)
+
+        if payload is None:
+            served_by: tp.Optional[str] = await self._webfinger(client, handle)
+            if served_by is None or served_by == instance:
+                return None
+            instance = served_by
+            payload = await self._lookup(client, instance, handle.username)
+            if payload is None:
+                return None
+
+        account: Account = Account(
+            username=str(payload.get("username", handle.username)),
+            instance=instance,
+            id=str(payload["id"]),
+            metering_interval=metering_interval,
+        )
+        metering: Metering = Metering(
+            toot_count=int(payload["statuses_count"]),
+            subscribers_count=int(payload["followers_count"]),
+            parent_account_internal_id=account.internal_id,
+        )
+        return account, metering
+
+    @staticmethod
+    async def _get_tracked_addresses() -> tp.Set[str]:
+        tracked_accounts: tp.List[Account] = await AccountCache().get_tracked_accounts()
+        return {account.full_address.rstrip("/").lower() for account in tracked_accounts}
+
+    async def import_accounts(
+        self, handles: tp.Iterable[str], metering_interval: tp.Optional[int] = None
+    ) -> ImportSummary:
+        """
+        resolve the handles and add the accounts found into the list of tracked with one bulk write,
+        along with their first meterings. Accounts that are tracked already are skipped
+        """
+        summary: ImportSummary = ImportSummary()
+        tracked: tp.Set[str] = await self._get_tracked_addresses()
+        pending: tp.Dict[str, Handle] = {}
+
+        for raw_handle in handles:
+            handle: tp.Optional[Handle] = parse_handle(raw_handle)
+            if handle is None:
+                summary.invalid.append(raw_handle)
+            elif handle.key in tracked or handle.key in pending:
+                summary.skipped.append(handle.acct)
+            else:
+                pending[handle.key] = handle
+
+        logger.info(f"Resolving {len(pending)} account handles")
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self._fetcher.concurrency)
+
+        async def _bounded(handle: Handle) -> tp.Optional[tp.Tuple[Account, Metering]]:
+            async with semaphore:
+                return await self._resolve(client, handle, metering_interval)
+
+        async with self._fetcher.get_client() as client:
+            results: tp.List[tp.Any] = await asyncio.gather(
+                *(_bounded(handle) for handle in pending.values()), return_exceptions=True
+            )
+
+        # different handles may lead to the same account, e.g. when its domain delegates to the instance
+        resolved: tp.Dict[tp.Tuple[str, str], tp.Tuple[str, Account, Metering]] = {}
+        for handle, result in zip(pending.values(), results):
+            if isinstance(result, Exception):
+                summary.failed[handle.acct] = f"{type(result).__name__}: {result}"
+            elif result is None:
+                summary.not_found.append(handle.acct)
+            elif (result[0].instance, result[0].id) in resolved:
+                summary.skipped.append(handle.acct)
+            else:
+                resolved[result[0].instance, result[0].id] = handle.acct, *result
+
+        if summary.failed:
+            logger.warning(f"Failed to resolve {len(summary.failed)} account handles")
+
+        accounts: tp.List[Account] = [account for _, account, _ in resolved.values()]
+        # the unique index has the final say on what is tracked already, the accounts may have been added meanwhile
+        added: tp.Set[str] = {account.internal_id for account in await get_database().add_tracked_accounts(accounts)}
+        meterings: tp.List[Metering] = []
+
+        for acct, account, metering in resolved.values():
+            if account.internal_id in added:
+                summary.imported[acct] = account
+                meterings.append(metering)
+            else:
+                summary.skipped.append(acct)
+
+        if added:
+            AccountCache().invalidate()
+            # the accounts are tracked already, so a failed write of their meterings is left to the buffer to retry
+            for metering in meterings:
+                await self._buffer.add_metering(metering)
+            await self._buffer.flush()
+
+        logger.info(
+            f"Imported {len(summary.imported)} accounts ({len(summary.skipped)} skipped, "
+            f"{len(summary.not_found)} not found, {len(summary.invalid)} invalid, {len(summary.failed)} failed)"
+        )
+        return summary
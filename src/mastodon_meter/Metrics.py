@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import functools
+import threading
+import typing as tp
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from time import monotonic
+
+LabelValues = tp.Tuple[str, ...]
+F = tp.TypeVar("F", bound=tp.Callable[..., tp.Awaitable[tp.Any]])
+
+# latency buckets in seconds, from a cached lookup to a request to a slow instance
+DEFAULT_BUCKETS: tp.Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    """
+    A family of time series in the Prometheus text format, distinguished by the label values.
+    Metrics are updated from the event loop as well as from the database thread, so updates are locked
+    """
+
+    kind: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tp.Tuple[str, ...] = ()) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labels: tp.Tuple[str, ...] = labels
+        self._lock: threading.Lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: tp.Dict[str, tp.Any]) -> LabelValues:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: LabelValues, **extra: str) -> str:
+        pairs: tp.List[str] = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+        pairs += [f'{label}="{value}"' for label, value in extra.items()]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abstractmethod
+    def samples(self) -> tp.Iterator[str]:
+        """get the lines of the time series in the text format"""
+
+    def render(self) -> str:
+        with self._lock:
+            samples: tp.List[str] = list(self.samples())
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *samples])
+
+
+class Counter(Metric):
+    """a total that only grows"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tp.Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: tp.Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: tp.Any) -> None:
+        key: LabelValues = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels: tp.Any) -> None:
+        """copy the total counted elsewhere"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> tp.Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """a value that goes up and down"""
+
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    """counts the observed values falling into each bucket, along with their sum"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tp.Tuple[str, ...] = (),
+        buckets: tp.Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets: tp.Tuple[float, ...] = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: tp.Dict[LabelValues, tp.List[int]] = {}
+        self._sums: tp.Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: tp.Any) -> None:
+        key: LabelValues = self._key(labels)
+        with self._lock:
+            counts: tp.List[int] = self._counts.setdefault(key, [0] * len(self.buckets))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: tp.Any) -> tp.Iterator[None]:
+        """observe the duration of the block"""
+        t0: float = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - t0, **labels)
+
+    def samples(self) -> tp.Iterator[str]:
+        for key, counts in sorted(self._counts.items()):
+            cumulative: int = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{self._format_labels(key, le=_format_value(bound))} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {_format_value(self._sums[key])}"
+            yield f"{self.name}_count{self._format_labels(key)} {cumulative}"
+
+
+REGISTRY: tp.List[Metric] = []
+
+
+def render_metrics() -> str:
+    """render all the metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def timed(histogram: Histogram, **labels: tp.Any) -> tp.Callable[[F], F]:
+    """decorate a coroutine function to observe its duration"""
+
+    def decorator(function: F) -> F:
+        @functools.wraps(function)
+        async def wrapper(*args: tp.Any, **kwargs: tp.Any) -> tp.Any:
+            with histogram.time(**labels):
+                return await function(*args, **kwargs)
+
+        return tp.cast(F, wrapper)
+
+    return decorator
+
+
+async def watch_event_loop_lag(interval: float = 0.5) -> None:
+    """measure how late the event loop wakes a sleeping task up, which is how long callbacks wait to be run"""
+    while True:
+        t0: float = monotonic()
+        await asyncio.sleep(interval)
+        lag: float = max(monotonic() - t0 - interval, 0)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
+
+
+# metrics of the application
+FETCH_DURATION = Histogram(
+    "mastodon_meter_fetch_duration_seconds", "Duration of the requests to the Mastodon instances.", ("instance",)
+)
+FETCH_ERRORS = Counter(
+    "mastodon_meter_fetch_errors_total", "Failed requests to the Mastodon instances.", ("instance", "error")
+)
+GATHER_DURATION = Histogram(
+    "mastodon_meter_gather_duration_seconds",
+    "Duration of the gathering runs.",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+GATHERED_ACCOUNTS = Counter(
+    "mastodon_meter_gathered_accounts_total", "Accounts processed by the gathering runs by outcome.", ("result",)
+)
+DB_OPERATION_DURATION = Histogram(
+    "mastodon_meter_db_operation_duration_seconds", "Duration of the database operations.", ("backend", "operation")
+)
+DB_DOCUMENTS = Counter(
+    "mastodon_meter_db_documents_total",
+    "Meterings, rollups and states read from or written into the database.",
+    ("backend", "direction"),
+)
+PLOT_RENDER_DURATION = Histogram(
+    "mastodon_meter_plot_render_duration_seconds", "Duration of the plot rendering, including the queueing.", ("plot",)
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "mastodon_meter_http_request_duration_seconds", "Duration of the API requests.", ("method", "route")
+)
+HTTP_REQUESTS = Counter("mastodon_meter_http_requests_total", "API requests.", ("method", "route", "status"))
+EVENT_LOOP_LAG = Histogram(
+    "mastodon_meter_event_loop_lag_seconds",
+    "Delay of the event loop in running a ready callback.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+EVENT_LOOP_LAG_LAST = Gauge("mastodon_meter_event_loop_lag_last_seconds", "The latest measured event loop lag.")
+WRITE_BUFFER_FLUSHES = Counter(
+    "mastodon_meter_write_buffer_flushes_total", "Flushes of the gathering results buffer by outcome.", ("result",)
+)
+WRITE_BUFFER_DOCUMENTS = Counter(
+    "mastodon_meter_write_buffer_documents_total", "Gathering results written by the buffer."
+)
+WRITE_BUFFER_DROPPED = Counter(
+    "mastodon_meter_write_buffer_dropped_total", "Gathering results dropped after repeatedly failed writes."
+)
+WRITE_BUFFER_FLUSH_SECONDS = Counter(
+    "mastodon_meter_write_buffer_flush_seconds_total", "Time spent flushing the gathering results buffer."
+)
+INSTANCE_CIRCUIT_OPEN = Gauge(
+    "mastodon_meter_instance_circuit_open",
+    "Whether requests to the instance are stopped (1) or not (0).",
+    ("instance",),
+)
+ACCOUNT_CACHE_LOOKUPS = Counter(
+    "mastodon_meter_account_cache_lookups_total", "Lookups of the tracked accounts cache by outcome.", ("result",)
+)
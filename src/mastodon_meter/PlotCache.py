@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import typing as tp
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+
+from loguru import logger
+
+from .Metering import Metering
+from .Singleton import SingletonMeta
+
+MEGABYTE = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class CachedPlot:
+    """Stores information about a rendered plot kept in the cache"""
+
+    key: str
+    account_internal_id: str
+    media_type: str
+    size: int
+    last_modified: tp.Optional[datetime]
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.key}"'
+
+
+class PlotCache(metaclass=SingletonMeta):
+    """
+    LRU cache of rendered plots. Plots are addressed by the data they are drawn from and kept
+    in memory. If a disk budget is configured, plots evicted from memory are spilled to disk
+    """
+
+    def __init__(self) -> None:
+        self._directory: str = "output/cache"
+        self._memory_budget: int = int(os.getenv("PLOT_CACHE_MEMORY_MB", default=32)) * MEGABYTE
+        self._disk_budget: int = int(os.getenv("PLOT_CACHE_DISK_MB", default=0)) * MEGABYTE
+        self._entries: tp.Dict[str, CachedPlot] = {}
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._memory_usage: int = 0
+        self._disk_usage: int = 0
+        self._pending: tp.Dict[str, "asyncio.Future[CachedPlot]"] = {}
+
+        if self._disk_budget:
+            # plots left by previous runs are not indexed, so they would never be evicted
+            shutil.rmtree(self._directory, ignore_errors=True)
+            os.makedirs(self._directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(
+        account_internal_id: str,
+        plot_type: str,
+        since: tp.Optional[datetime],
+        to: tp.Optional[datetime],
+        latest: tp.Optional[Metering],
+        *variants: object,
+    ) -> str:
+        """
+        get the address of a plot, which changes whenever the data it is drawn from changes.
+        Variants are the parameters of the plot, such as image options
+        """
+        parts: tp.Tuple[str, ...] = (
+            account_internal_id,
+            plot_type,
+            str(since),
+            str(to),
+            latest.internal_id if latest else "",
+            str(latest.timestamp) if latest else "",
+            *map(repr, variants),
+        )
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def _path_for(self, key: str) -> str:
+        return f"{self._directory}/{key}"
+
+    def read(self, key: str) -> tp.Optional[tp.Tuple[CachedPlot, bytes]]:
+        """get the cached plot and its contents, marking it as recently used"""
+        entry: tp.Optional[CachedPlot] = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return entry, self._memory[key]
+
+        try:
+            with open(self._path_for(key), "rb") as file:
+                content: bytes = file.read()
+        except FileNotFoundError:
+            self._drop(key)
+            return None
+
+        self._disk.move_to_end(key)
+        return entry, content
+
+    def put(
+        self,
+        key: str,
+        account_internal_id: str,
+        content: bytes,
+        media_type: str,
+        last_modified: tp.Optional[datetime],
+    ) -> CachedPlot:
+        """register a freshly rendered plot in the cache"""
+        if key in self._entries:
+            self._drop(key)
+
+        entry = CachedPlot(key, account_internal_id, media_type, len(content), last_modified)
+        self._entries[key] = entry
+        self._memory[key] = content
+        self._memory_usage += entry.size
+        self._evict()
+        return entry
+
+    async def get_or_render(
+        self,
+        key: str,
+        account_internal_id: str,
+        media_type: str,
+        last_modified: tp.Optional[datetime],
+        render: tp.Callable[[], tp.Awaitable[bytes]],
+    ) -> tp.Tuple[CachedPlot, bytes]:
+        """
+        get the cached plot or render it with the provided coroutine function.
+        Simultaneous requests for the same plot share one rendering
+        """
+        cached: tp.Optional[tp.Tuple[CachedPlot, bytes]] = self.read(key)
+        if cached is not None:
+            return cached
+
+        if key in self._pending:
+            await asyncio.shield(self._pending[key])
+            cached = self.read(key)
+            if cached is not None:
+                return cached
+
+        future: "asyncio.Future[CachedPlot]" = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+
+        try:
+            content: bytes = await render()
+            entry: CachedPlot = self.put(key, account_internal_id, content, media_type, last_modified)
+            future.set_result(entry)
+            return entry, content
+
+        except BaseException as e:
+            future.set_exception(e)
+            # the exception is propagated to the caller, waiters are optional
+            future.exception()
+            raise
+
+        finally:
+            del self._pending[key]
+
+    def invalidate_accounts(self, account_internal_ids: tp.Iterable[str]) -> None:
+        """drop all the plots drawn for the provided accounts"""
+        accounts: tp.Set[str] = set(account_internal_ids)
+        stale: tp.List[str] = [key for key, entry in self._entries.items() if entry.account_internal_id in accounts]
+
+        for key in stale:
+            self._drop(key)
+
+        if stale:
+            logger.debug(f"Invalidated {len(stale)} cached plots")
+
+    def _drop(self, key: str) -> None:
+        """remove the plot from the cache"""
+        entry: CachedPlot = self._entries.pop(key)
+
+        if self._memory.pop(key, None) is not None:
+            self._memory_usage -= entry.size
+
+        if self._disk.pop(key, None) is not None:
+            self._disk_usage -= entry.size
+            try:
+                os.remove(self._path_for(key))
+            except FileNotFoundError:
+                pass
+
+    def _spill(self, key: str, content: bytes) -> None:
+        """move the plot evicted from memory to disk, or drop it if it doesn't fit there"""
+        if len(content) > self._disk_budget:
+            del self._entries[key]
+            return
+
+        with open(self._path_for(key), "wb") as file:
+            file.write(content)
+
+        self._disk[key] = len(content)
+        self._disk_usage += len(content)
+
+    def _evict(self) -> None:
+        """move the least recently used plots down the tiers until the cache fits into its budgets"""
+        while self._memory_usage > self._memory_budget and self._memory:
+            key, content = self._memory.popitem(last=False)
+            self._memory_usage -= len(content)
+            self._spill(key, content)
+
+        while self._disk_usage > self._disk_budget and self._disk:
+            self._drop(next(iter(self._disk)))
@@ -1,82 +1,203 @@
 from __future__ import annotations
 
-import os
+import io
+import math
 import typing as tp
+from dataclasses import dataclass, replace
 from datetime import datetime as dt
-from functools import reduce
 
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
 from PIL import Image
 
 from .Account import Account
-from .Metering import Metering
+from .Series import MeteringSeries
+
+# media types of the supported image formats
+MEDIA_TYPES: tp.Dict[str, str] = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "webp": "image/webp",
+}
+
+# titles of the counters plotted on comparison graphs
+FIELD_TITLES: tp.Dict[str, str] = {
+    "subscribers_count": "Subscriber count",
+    "toot_count": "Statuses count",
+}
+
+# the size a grid of small multiples may take, the resolution is lowered for the grid to fit into it
+MAX_GRID_PIXELS: int = 25_000_000
+
+
+def get_growth(values: np.ndarray) -> np.ndarray:
+    """express the counts as growth in percent relative to the first one"""
+    if not len(values):
+        return values.astype(np.float64)
+    growth: np.ndarray = (values - values[0]) / max(int(values[0]), 1) * 100
+    return growth
+
+
+@dataclass(frozen=True)
+class PlotOptions:
+    """Stores the parameters of the image to render"""
+
+    format: str = "png"
+    dpi: int = 100
+    width: float = 6.4
+    height: float = 4.8
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
 
 
 class Plotter:
-    """handles drawing plots from the provided meterings"""
+    """
+    handles drawing plots from the provided metering series. It only uses the object-oriented
+    matplotlib API, so plots can be drawn simultaneously in different processes.
+    Plots are rendered in memory and returned as encoded images
+    """
 
     @staticmethod
     def _draw_generic_plot(
-        data: tp.Tuple[tp.List[str], tp.List[int]], filename: str, title: str, x_label: str, y_label: str
-    ) -> str:
-        """draw a plot with provided data"""
-        plt.plot(*data, marker="o")
-        plt.title(title)
+        axes: Axes, data: tp.Tuple[np.ndarray, np.ndarray], title: str, x_label: str, y_label: str
+    ) -> None:
+        """draw a plot with provided data on the provided axes"""
+        # markers only make sense while individual points can be told apart
+        axes.plot(*data, marker="o" if len(data[0]) <= 200 else None)
+        axes.xaxis.set_major_formatter(DateFormatter("%d.%m"))
+        axes.set_title(title)
+        axes.set_xlabel(x_label)
+        axes.set_ylabel(y_label)
+
+    @staticmethod
+    def _make_figure(
+        options: PlotOptions, columns: int = 1, rows: int = 1, count: tp.Optional[int] = None, grid: bool = False
+    ) -> tp.Tuple[Figure, tp.List[Axes]]:
+        """
+        make a figure with the requested number of subplots (all the cells by default) placed on a horizontal
+        line or in rows. Subplots of a grid share the time axis and are laid out not to overlap
+        """
+        figure: Figure = Figure(
+            figsize=(options.width * columns, options.height * rows), dpi=options.dpi, constrained_layout=grid
+        )
+        FigureCanvasAgg(figure)
         subtitle: str = f"Generated on {dt.utcnow().strftime('%Y.%m.%d %H:%M')} UTC using Mastodon-meter"
-        plt.suptitle(subtitle)
-        plt.xlabel(x_label)
-        plt.ylabel(y_label)
+        figure.suptitle(subtitle)
+        axes: tp.List[Axes] = []
+        for i in range(columns * rows if count is None else count):
+            axes.append(figure.add_subplot(rows, columns, i + 1, sharex=axes[0] if axes and grid else None))
+        return figure, axes
 
-        dir_: str = "output"
-        if not os.path.exists(dir_):
-            os.mkdir(dir_)
+    @staticmethod
+    def _encode(figure: Figure, options: PlotOptions) -> bytes:
+        """encode the figure into an image of the requested format"""
+        buffer = io.BytesIO()
 
-        filename = f"{dir_}/{filename}"
-        plt.savefig(filename)
-        plt.clf()
-        return filename
+        if options.format == "webp":
+            # matplotlib can't encode WebP on its own, so the image is converted by Pillow
+            png_buffer = io.BytesIO()
+            figure.savefig(png_buffer, format="png", dpi=options.dpi)
+            png_buffer.seek(0)
+            Image.open(png_buffer).save(buffer, format="webp")
+        else:
+            figure.savefig(buffer, format=options.format, dpi=options.dpi)
 
-    def draw_subscribers_plot(self, meterings: tp.List[Metering], account: Account) -> str:
-        """plot subscribers"""
-        x_data: tp.List[str] = [m.timestamp.strftime("%d.%m") for m in meterings]
-        y_data: tp.List[int] = [int(m.subscribers_count) for m in meterings]
+        return buffer.getvalue()
+
+    def _draw_subscribers(self, axes: Axes, series: MeteringSeries, account: Account) -> None:
         title: str = f"{account.full_address} subscribers"
-        x_label: str = "Time"
-        y_label: str = "Subscriber count"
-        filename: str = f"{account.internal_id}-subscribers-plot-{int(dt.utcnow().timestamp())}.png"
-        return self._draw_generic_plot((x_data, y_data), filename, title, x_label, y_label)
+        self._draw_generic_plot(axes, (series.datetimes, series.subscribers_count), title, "Time", "Subscriber count")
 
-    def draw_statuses_plot(self, meterings: tp.List[Metering], account: Account) -> str:
-        """plot status count"""
-        x_data: tp.List[str] = [m.timestamp.strftime("%d.%m") for m in meterings]
-        y_data: tp.List[int] = [int(m.toot_count) for m in meterings]
+    def _draw_statuses(self, axes: Axes, series: MeteringSeries, account: Account) -> None:
         title: str = f"{account.full_address} statuses"
-        x_label: str = "Time"
-        y_label: str = "Statuses count"
-        filename: str = f"{account.internal_id}-statuses-plot-{int(dt.utcnow().timestamp())}.png"
-        return self._draw_generic_plot((x_data, y_data), filename, title, x_label, y_label)
-
-    def draw_common_plot(self, meterings: tp.List[Metering], account: Account) -> str:
-        """plot statuses and subscribers on the same image"""
-        subscribers_plot: Image = Image.open(self.draw_subscribers_plot(meterings, account))
-        statuses_plot: Image = Image.open(self.draw_statuses_plot(meterings, account))
-        resulting_image: Image = self._unite_images([subscribers_plot, statuses_plot])
-        filename: str = f"output/{account.internal_id}-common-plot-{int(dt.utcnow().timestamp())}.png"
-        resulting_image.save(filename)
-        return filename
+        self._draw_generic_plot(axes, (series.datetimes, series.toot_count), title, "Time", "Statuses count")
+
+    def draw_subscribers_plot(self, series: MeteringSeries, account: Account, options: PlotOptions) -> bytes:
+        """plot subscribers"""
+        figure, (axes,) = self._make_figure(options)
+        self._draw_subscribers(axes, series, account)
+        return self._encode(figure, options)
+
+    def draw_statuses_plot(self, series: MeteringSeries, account: Account, options: PlotOptions) -> bytes:
+        """plot status count"""
+        figure, (axes,) = self._make_figure(options)
+        self._draw_statuses(axes, series, account)
+        return self._encode(figure, options)
+
+    def draw_common_plot(self, series: MeteringSeries, account: Account, options: PlotOptions) -> bytes:
+        """plot statuses and subscribers side by side on the same image"""
+        figure, (subscribers_axes, statuses_axes) = self._make_figure(options, columns=2)
+        self._draw_subscribers(subscribers_axes, series, account)
+        self._draw_statuses(statuses_axes, series, account)
+        return self._encode(figure, options)
 
     @staticmethod
-    def _unite_images(images: tp.List[Image]) -> Image:
-        """make an image that has all the provided images placed on a horizontal line"""
-
-        def _unite_two_images(image_1: Image, image_2: Image) -> Image:
-            """place_two images next to each other horizontally"""
-            w1, h1 = image_1.size
-            w2, h2 = image_2.size
-            resulting_image: Image = Image.new("RGB", (w1 + w2, max((h1, h2))))
-            resulting_image.paste(image_1, (0, 0))
-            resulting_image.paste(image_2, (w1, 0))
-            return resulting_image
-
-        result: Image = reduce(_unite_two_images, images)
-        return result
+    def _get_comparison_values(series: MeteringSeries, field: str, normalize: bool) -> np.ndarray:
+        values: np.ndarray = series.column(field)
+        return get_growth(values) if normalize else values
+
+    def draw_comparison_plot(
+        self,
+        accounts: tp.List[Account],
+        series: tp.List[MeteringSeries],
+        field: str,
+        normalize: bool,
+        options: PlotOptions,
+    ) -> bytes:
+        """plot the counter of many accounts overlaid on the same axes, as growth in percent if normalized"""
+        figure, (axes,) = self._make_figure(options)
+        # markers only make sense while individual points can be told apart
+        points: int = max((len(account_series) for account_series in series), default=0)
+
+        for account, account_series in zip(accounts, series):
+            axes.plot(
+                account_series.datetimes,
+                self._get_comparison_values(account_series, field, normalize),
+                marker="o" if points <= 50 else None,
+                label=account.full_address,
+            )
+
+        axes.xaxis.set_major_formatter(DateFormatter("%d.%m"))
+        axes.set_title(f"{FIELD_TITLES[field]} {'growth' if normalize else 'comparison'}")
+        axes.set_xlabel("Time")
+        axes.set_ylabel("Growth, %" if normalize else FIELD_TITLES[field])
+        axes.legend(fontsize="small", ncol=math.ceil(len(accounts) / 15))
+        return self._encode(figure, options)
+
+    def draw_small_multiples(
+        self,
+        accounts: tp.List[Account],
+        series: tp.List[MeteringSeries],
+        field: str,
+        normalize: bool,
+        options: PlotOptions,
+        columns: int,
+    ) -> bytes:
+        """
+        plot the counter of every account on its own panel of one figure. The panels are half the size of a single
+        plot and share the time axis, normalized ones also share the growth axis so that they can be compared by eye
+        """
+        columns = min(columns, len(accounts))
+        rows: int = math.ceil(len(accounts) / columns)
+        width, height = options.width / 2, options.height / 2
+        dpi: int = min(options.dpi, int(math.sqrt(MAX_GRID_PIXELS / (width * columns * height * rows))))
+        panel_options: PlotOptions = replace(options, width=width, height=height, dpi=dpi)
+
+        figure, panels = self._make_figure(panel_options, columns, rows, count=len(accounts), grid=True)
+        y_label: str = "Growth, %" if normalize else FIELD_TITLES[field]
+
+        for i, (axes, account, account_series) in enumerate(zip(panels, accounts, series)):
+            data: tp.Tuple[np.ndarray, np.ndarray] = (
+                account_series.datetimes,
+                self._get_comparison_values(account_series, field, normalize),
+            )
+            self._draw_generic_plot(axes, data, account.full_address, "", y_label if i % columns == 0 else "")
+            if normalize and i:
+                axes.sharey(panels[0])
+
+        return self._encode(figure, panel_options)
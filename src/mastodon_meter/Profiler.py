@@ -0,0 +1,97 @@
+import collections
+import os
+import sys
+import threading
+import typing as tp
+from time import monotonic
+from types import FrameType
+
+from loguru import logger
+
+from .Singleton import SingletonMeta
+
+
+def _describe(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler(metaclass=SingletonMeta):
+    """
+    statistical profiler of the event loop thread. A background thread takes the stack of the event loop thread
+    at the set interval, so the overhead stays low enough to find the hot paths under production load
+    """
+
+    def __init__(self) -> None:
+        self.interval: float = 0.01
+        self._thread: tp.Optional[threading.Thread] = None
+        self._stopped: threading.Event = threading.Event()
+        self._stacks: tp.Counter[str] = collections.Counter()
+        self._samples: int = 0
+        self._started_at: float = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float) -> None:
+        """start sampling the stack of the calling thread, dropping the previous samples"""
+        if self.running:
+            raise RuntimeError("Profiler is already running")
+
+        self.interval = interval
+        self._stacks = collections.Counter()
+        self._samples = 0
+        self._started_at = monotonic()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._sample, args=(threading.get_ident(),), name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Started sampling profiler with {interval * 1000:.1f} ms. interval")
+
+    def _sample(self, thread_id: int) -> None:
+        while not self._stopped.wait(self.interval):
+            frame: tp.Optional[FrameType] = sys._current_frames().get(thread_id)
+            stack: tp.List[str] = []
+
+            while frame is not None:
+                stack.append(_describe(frame))
+                frame = frame.f_back
+
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+                self._samples += 1
+
+    def stop(self, top: int = 30) -> tp.Dict[str, tp.Any]:
+        """
+        stop sampling and get the profile: the functions the event loop spent the most samples in, by their own
+        samples and by the samples of the stacks they are in, and all the stacks in the collapsed (flame graph) format
+        """
+        if self._thread is None:
+            raise RuntimeError("Profiler is not running")
+
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+        own: tp.Counter[str] = collections.Counter()
+        total: tp.Counter[str] = collections.Counter()
+        for stack, count in self._stacks.items():
+            functions: tp.List[str] = stack.split(";")
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+
+        def _share(count: int) -> float:
+            return round(count / self._samples, 4) if self._samples else 0.0
+
+        logger.info(f"Stopped sampling profiler with {self._samples} samples")
+        return {
+            "samples": self._samples,
+            "duration": round(monotonic() - self._started_at, 3),
+            "interval_ms": self.interval * 1000,
+            "top_own": [{"function": f, "share": _share(count)} for f, count in own.most_common(top)],
+            "top_total": [{"function": f, "share": _share(count)} for f, count in total.most_common(top)],
+            "collapsed_stacks": "\n".join(f"{stack} {count}" for stack, count in self._stacks.most_common()),
+        }
@@ -0,0 +1,67 @@
+import asyncio
+import multiprocessing
+import os
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import matplotlib
+from loguru import logger
+
+from .Metrics import PLOT_RENDER_DURATION
+from .Singleton import SingletonMeta
+
+T = tp.TypeVar("T")
+
+
+class RenderQueueFull(Exception):
+    """raised when too many plots are already waiting to be rendered"""
+
+
+def _init_worker() -> None:
+    """configure a rendering worker process"""
+    matplotlib.use("Agg")
+
+
+class RenderPool(metaclass=SingletonMeta):
+    """renders plots in a pool of worker processes, so that drawing does not block the event loop"""
+
+    def __init__(self) -> None:
+        workers: int = int(os.getenv("PLOT_WORKERS", default=2))
+        self._queue_limit: int = int(os.getenv("PLOT_QUEUE_LIMIT", default=16))
+        self._executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=self._get_context(), initializer=_init_worker
+        )
+        self._in_flight: int = 0
+        logger.info(f"Started plot rendering pool with {workers} workers")
+
+    @staticmethod
+    def _get_context() -> multiprocessing.context.BaseContext:
+        """
+        start the workers from a clean process instead of forking the server, which has threads
+        and open connections a fork would copy in whatever state they are in
+        """
+        if "forkserver" not in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context("spawn")
+
+        context: multiprocessing.context.BaseContext = multiprocessing.get_context("forkserver")
+        # the server process imports the plotting code once, every worker forked from it gets it ready
+        context.set_forkserver_preload(["mastodon_meter.Plotting"])
+        return context
+
+    async def render(self, function: tp.Callable[..., T], *args: tp.Any) -> T:
+        """run the rendering function in the pool, refusing to queue more than $PLOT_QUEUE_LIMIT jobs"""
+        if self._in_flight >= self._queue_limit:
+            raise RenderQueueFull(f"Rendering queue is full ({self._in_flight} plots pending), try again later")
+
+        self._in_flight += 1
+        try:
+            loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+            with PLOT_RENDER_DURATION.time(plot=getattr(function, "__name__", "unknown")):
+                return await loop.run_in_executor(self._executor, partial(function, *args))
+        finally:
+            self._in_flight -= 1
+
+    def shutdown(self) -> None:
+        """stop the worker processes"""
+        self._executor.shutdown(wait=False)
@@ -1,42 +1,228 @@
 import typing as tp
+from collections import OrderedDict
 from datetime import datetime as dt
 
+import numpy as np
+
 from .Account import Account
-from .Metering import Metering
+from .AccountState import AccountState
+from .DatabaseWrapper import DatabaseWrapper
+from .Rollups import ROLLUP_FIELDS
+from .Series import MeteringSeries
+from .Singleton import SingletonMeta
+from .Types import Document
+from .database import get_database
+
+DAY: int = 86400
+WEEK: int = 7 * DAY
 
+# versions of the tracked accounts and of their states, a report is valid while both stay the same
+ReportVersion = tp.Tuple[int, int]
 
-class Reporter:
+
+class Reporter(metaclass=SingletonMeta):
     """generates reports and stats"""
 
-    def get_simple_text_report(self, tracked_accounts: tp.List[tp.Tuple[Account, tp.List[Metering]]]) -> str:
+    # number of distinct account selections to keep rendered reports for
+    report_cache_size: int = 128
+    # number of quantiles the snapshot keeps for every metric, bounding its size whatever the number of accounts
+    snapshot_quantiles: int = 1000
+
+    def __init__(self) -> None:
+        self._reports: "OrderedDict[tp.Optional[tp.Tuple[str, ...]], str]" = OrderedDict()
+        self._data_version: tp.Optional[ReportVersion] = None
+
+    @staticmethod
+    async def get_data_version() -> ReportVersion:
+        """
+        get the versions of the tracked accounts and their states kept in the database, so that the reports
+        rendered by this worker are dropped once any worker changes the data they are based on
+        """
+        database: DatabaseWrapper = get_database()
+        return await database.get_accounts_version(), await database.get_account_states_version()
+
+    @staticmethod
+    def _report_key(account_internal_ids: tp.Optional[tp.List[str]]) -> tp.Optional[tp.Tuple[str, ...]]:
+        return tuple(sorted(set(account_internal_ids))) if account_internal_ids is not None else None
+
+    def get_cached_report(
+        self, version: ReportVersion, account_internal_ids: tp.Optional[tp.List[str]]
+    ) -> tp.Optional[str]:
+        """get the report rendered for the accounts from the data of the provided version, if any"""
+        if version != self._data_version:
+            self._reports.clear()
+            self._data_version = version
+        return self._reports.get(self._report_key(account_internal_ids))
+
+    def cache_report(
+        self, version: ReportVersion, account_internal_ids: tp.Optional[tp.List[str]], report: str
+    ) -> None:
+        """keep the rendered report until the data it is based on changes"""
+        if version != self._data_version:
+            return
+
+        self._reports[self._report_key(account_internal_ids)] = report
+        while len(self._reports) > self.report_cache_size:
+            self._reports.popitem(last=False)
+
+    def invalidate_reports(self) -> None:
+        """drop the rendered reports, called when meterings are gathered or tracked accounts change"""
+        self._reports.clear()
+        self._data_version = None
+
+    def get_simple_text_report(self, tracked_accounts: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]]) -> str:
         """a simple report to put in messages"""
         title: str = f"Mastodon-meter summary report generated on {dt.utcnow().strftime('%Y.%m.%d %H:%M')} UTC\n"
         message_lines: tp.List[str] = [title]
         message_lines += map(self._get_report_line, tracked_accounts)
         return "\n".join(message_lines)
 
-    def _get_report_line(self, account_data: tp.Tuple[Account, tp.List[Metering]]) -> str:
+    def _get_report_line(self, account_data: tp.Tuple[Account, tp.Optional[AccountState]]) -> str:
         """get a report string for one account"""
-        account, meterings = account_data
+        account, state = account_data
 
-        if not meterings:
+        if state is None:
             return f"No records to display for {account.full_address}"
 
-        last: Metering = meterings[-1]
-        previous: tp.Optional[Metering] = meterings[-2] if len(meterings) > 1 else None
+        subscribers: int = state.subscribers_count
+        statuses: int = state.toot_count
 
-        if previous is not None:
-            subscribers_diff: int = last.subscribers_count - previous.subscribers_count
-            statuses_diff: int = last.toot_count - previous.toot_count
+        if state.subscribers_count_delta is not None and state.toot_count_delta is not None:
             report_line: str = (
-                f"{account.full_address}: {last.subscribers_count}{self._progress(subscribers_diff)} subscribers, "
-                f"{last.toot_count}{self._progress(statuses_diff)} statuses"
+                f"{account.full_address}: {subscribers}{self._progress(state.subscribers_count_delta)} subscribers, "
+                f"{statuses}{self._progress(state.toot_count_delta)} statuses"
             )
         else:
-            report_line = f"{account.full_address}: {last.subscribers_count} subscribers, {last.toot_count} statuses"
+            report_line = f"{account.full_address}: {subscribers} subscribers, {statuses} statuses"
 
         return report_line
 
+    @classmethod
+    def _get_quantiles(cls, values: np.ndarray) -> tp.List[int]:
+        """
+        get the values the share of the accounts not greater than reaches each multiple of 1 / quantiles at
+        (every value, if there are fewer of them), so that ranks looked up in them are off by 1 / quantiles at most
+        """
+        values = np.sort(values)
+        size: int = len(values)
+
+        if size > cls.snapshot_quantiles:
+            steps: np.ndarray = np.arange(1, cls.snapshot_quantiles + 1)
+            values = values[(steps * size + cls.snapshot_quantiles - 1) // cls.snapshot_quantiles - 1]
+
+        quantiles: tp.List[int] = values.tolist()
+        return quantiles
+
+    @classmethod
+    def get_stats_snapshot(cls, weekly_changes: tp.List[Document]) -> Document:
+        """
+        make a snapshot of the counters and their weekly growth across all the tracked accounts,
+        storing the quantiles of every metric, so that percentile ranks are a binary search away
+        """
+        metrics: Document = {}
+
+        for field in ROLLUP_FIELDS:
+            last: np.ndarray = np.array([row[f"{field}_last"] for row in weekly_changes], dtype=np.int64)
+            first: np.ndarray = np.array([row[f"{field}_first"] for row in weekly_changes], dtype=np.int64)
+            metrics[field] = cls._get_quantiles(last)
+            metrics[f"{field}_weekly_growth"] = cls._get_quantiles(last - first)
+
+        return {"timestamp": dt.utcnow(), "account_count": len(weekly_changes), "metrics": metrics}
+
+    @staticmethod
+    def _percentile_rank(snapshot: tp.Optional[Document], metric: str, value: float) -> tp.Optional[float]:
+        """
+        get the share of the tracked accounts (in percents) having the metric not greater than the value,
+        as the share of the snapshot quantiles not greater than it
+        """
+        if snapshot is None or not snapshot["metrics"].get(metric):
+            return None
+
+        values: np.ndarray = np.asarray(snapshot["metrics"][metric])
+        return round(100 * int(np.searchsorted(values, value, side="right")) / len(values), 2)
+
+    def get_account_stats(
+        self,
+        series: MeteringSeries,
+        snapshot: tp.Optional[Document] = None,
+        window: int = 7,
+        horizon: int = 30,
+        peak_count: int = 3,
+    ) -> Document:
+        """
+        compute growth stats from the daily series of an account in one vectorized pass over both counters:
+        growth rates, rolling averages of the daily growth, peak growth days, percentile ranks
+        across the tracked accounts taken from the snapshot and linear and exponential trend forecasts
+        """
+        if not len(series):
+            return {}
+
+        # resample the counters onto a regular daily grid, filling the days with no meterings in
+        days: np.ndarray = (series.timestamps - series.timestamps[0]) // DAY
+        grid: np.ndarray = np.arange(days[-1] + 1)
+        counts: np.ndarray = np.vstack(
+            [np.interp(grid, days, series.column(field).astype(np.float64)) for field in ROLLUP_FIELDS]
+        )
+        dates: np.ndarray = (series.timestamps[0] + grid * DAY).astype("datetime64[s]").astype("datetime64[D]")
+
+        daily: np.ndarray = np.diff(counts, axis=1)
+        span: int = daily.shape[1]
+        last_week: np.ndarray = counts[:, -1] - counts[:, max(len(grid) - 8, 0)]
+
+        # rolling average of the daily growth over a window ending on each day
+        window = max(min(window, span), 1)
+        cumulative: np.ndarray = np.concatenate([np.zeros((len(ROLLUP_FIELDS), 1)), np.cumsum(daily, axis=1)], axis=1)
+        rolling: np.ndarray = (cumulative[:, window:] - cumulative[:, :-window]) / window if span else daily
+        peaks: np.ndarray = np.argsort(-daily, axis=1, kind="stable")[:, :peak_count]
+
+        # least squares trends over the same window the rolling average is computed for
+        start: int = max(len(grid) - window - 1, 0)
+        x: np.ndarray = grid[start:].astype(np.float64)
+        recent: np.ndarray = counts[:, start:]
+        linear: tp.Optional[np.ndarray] = np.polyfit(x, recent.T, 1) if len(x) > 1 else None
+        positive: bool = bool(np.all(recent > 0))
+        exponential: tp.Optional[np.ndarray] = np.polyfit(x, np.log(recent.T), 1) if len(x) > 1 and positive else None
+        target: float = float(grid[-1] + horizon)
+
+        stats: Document = {
+            "since": str(dates[0]),
+            "to": str(dates[-1]),
+            "days": span,
+            "window": window,
+        }
+
+        for i, field in enumerate(ROLLUP_FIELDS):
+            current: int = int(counts[i, -1])
+            stats[field] = {
+                "current": current,
+                "growth_per_day": round(float(daily[i].mean()), 2) if span else 0.0,
+                "growth_per_week": round(float(daily[i].mean()) * 7, 2) if span else 0.0,
+                "last_day_growth": int(daily[i, -1]) if span else 0,
+                "last_week_growth": int(last_week[i]),
+                "rolling_average": [
+                    {"date": str(date), "value": round(float(value), 2)}
+                    for date, value in zip(dates[window:], rolling[i])
+                ],
+                "peak_days": [
+                    {"date": str(dates[day + 1]), "growth": int(daily[i, day])} for day in peaks[i] if daily[i, day] > 0
+                ],
+                "percentile_rank": {
+                    "count": self._percentile_rank(snapshot, field, current),
+                    "weekly_growth": self._percentile_rank(snapshot, f"{field}_weekly_growth", last_week[i]),
+                },
+                "forecast": {
+                    "horizon_days": horizon,
+                    "linear": round(float(np.polyval(linear[:, i], target)), 2) if linear is not None else None,
+                    "exponential": (
+                        round(float(np.exp(np.polyval(exponential[:, i], target))), 2)
+                        if exponential is not None
+                        else None
+                    ),
+                },
+            }
+
+        return stats
+
     @staticmethod
     def _progress(diff: int) -> str:
         if diff > 0:
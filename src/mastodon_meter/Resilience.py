@@ -0,0 +1,175 @@
+import json
+import os
+import random
+import typing as tp
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic
+
+import httpx
+
+# status codes worth retrying: rate limiting and server side failures
+RETRYABLE_STATUS_CODES: tp.FrozenSet[int] = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+
+class CircuitOpen(Exception):
+    """raised instead of making a request to an instance that is considered down"""
+
+
+class MalformedResponse(ValueError):
+    """raised when a successful response lacks the expected data, e.g. it was cut short or is an error page"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """check if the request failed for a reason that may go away if it is repeated"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    # a broken body usually means an error page served instead of the API response
+    return isinstance(error, (httpx.TransportError, json.JSONDecodeError, MalformedResponse))
+
+
+def _parse_seconds_until(value: str) -> tp.Optional[float]:
+    """parse either a number of seconds or a point in time (HTTP or ISO 8601 date) into seconds from now"""
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    moment: tp.Optional[datetime] = None
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def get_rate_limit_delay(response: httpx.Response) -> tp.Optional[float]:
+    """
+    get the number of seconds the instance asks to wait before the next request, taken from the
+    Retry-After header or from the X-RateLimit-* headers Mastodon sends once the limit is exhausted
+    """
+    retry_after: tp.Optional[str] = response.headers.get("retry-after")
+    if retry_after:
+        return _parse_seconds_until(retry_after)
+
+    remaining: tp.Optional[str] = response.headers.get("x-ratelimit-remaining")
+    reset: tp.Optional[str] = response.headers.get("x-ratelimit-reset")
+    if reset and (response.status_code == 429 or (remaining is not None and remaining.strip() == "0")):
+        return _parse_seconds_until(reset)
+
+    return None
+
+
+class RetryPolicy:
+    """exponential backoff with full jitter, respecting the delays requested by the instances"""
+
+    def __init__(self) -> None:
+        self.attempts: int = max(int(os.getenv("RETRY_ATTEMPTS", default=3)), 1)
+        self.base_delay: float = float(os.getenv("RETRY_BASE_DELAY", default=0.5))
+        self.max_delay: float = float(os.getenv("RETRY_MAX_DELAY", default=30))
+
+    def get_delay(self, attempt: int, error: Exception) -> float:
+        """get the delay before the next attempt, the first attempt is number 0"""
+        if isinstance(error, httpx.HTTPStatusError):
+            requested: tp.Optional[float] = get_rate_limit_delay(error.response)
+            if requested is not None:
+                return requested + random.uniform(0, self.base_delay)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    stops requests to an instance after a series of consecutive failures. After the cooldown
+    one trial request is let through: the circuit closes if it succeeds and opens again otherwise
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float) -> None:
+        self._failure_threshold: int = failure_threshold
+        self._cooldown: float = cooldown
+        self._failures: int = 0
+        self._open_until: float = 0
+        self._trial_started: bool = False
+
+    @property
+    def state(self) -> str:
+        if not self._open_until:
+            return "closed"
+        return "open" if monotonic() < self._open_until else "half-open"
+
+    def check(self) -> bool:
+        """raise if requests to the instance are not allowed now, return True if the request is the trial one"""
+        state: str = self.state
+        if state == "open" or (state == "half-open" and self._trial_started):
+            raise CircuitOpen(f"Circuit is open for {max(self._open_until - monotonic(), 0):.1f} s. more")
+        if state == "half-open":
+            self._trial_started = True
+            return True
+        return False
+
+    def abandon_trial(self) -> None:
+        """let another request be the trial one, when the trial request ended without an outcome (e.g. cancelled)"""
+        if self.state == "half-open":
+            self._trial_started = False
+
+    def open(self, duration: tp.Optional[float] = None) -> None:
+        """stop requests to the instance for the duration (the cooldown by default)"""
+        self._open_until = monotonic() + (duration if duration is not None else self._cooldown)
+        self._trial_started = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._open_until = 0
+        self._trial_started = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self._failure_threshold or self.state == "half-open":
+            self.open()
+
+
+class InstanceStats:
+    """collects request outcomes and latencies for one instance"""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.requests: int = 0
+        self.failures: int = 0
+        self.retries: int = 0
+        self.rejected: int = 0
+        self.status_codes: tp.Dict[str, int] = {}
+        self.last_error: tp.Optional[str] = None
+        self._latencies: tp.Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float, status_code: tp.Optional[int], error: tp.Optional[Exception] = None) -> None:
+        self.requests += 1
+        self._latencies.append(latency)
+
+        if status_code is not None:
+            self.status_codes[str(status_code)] = self.status_codes.get(str(status_code), 0) + 1
+        if error is not None:
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {str(error).splitlines()[0] if str(error) else ''}"
+
+    def as_dict(self) -> tp.Dict[str, tp.Any]:
+        latencies: tp.List[float] = sorted(self._latencies)
+
+        def _percentile(share: float) -> tp.Optional[float]:
+            return round(latencies[int(share * (len(latencies) - 1))] * 1000, 1) if latencies else None
+
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "error_rate": round(self.failures / self.requests, 4) if self.requests else 0.0,
+            "status_codes": dict(self.status_codes),
+            "latency_ms": {"p50": _percentile(0.5), "p95": _percentile(0.95), "max": _percentile(1.0)},
+            "last_error": self.last_error,
+        }
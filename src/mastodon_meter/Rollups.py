@@ -0,0 +1,161 @@
+import typing as tp
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from .Metering import Metering
+from .Types import Document
+
+
+@dataclass(frozen=True)
+class RollupTier:
+    """Describes one level of metering aggregation"""
+
+    name: str
+    seconds: int
+
+    @property
+    def collection_name(self) -> str:
+        return f"meterings-{self.name}"
+
+    def bucket_start(self, timestamp: datetime) -> datetime:
+        """get the start of the bucket the timestamp falls into, weeks start on Monday"""
+        if self.seconds < 86400:
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+
+        day: datetime = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.seconds == 86400:
+            return day
+
+        return day - timedelta(days=day.weekday())
+
+
+# aggregation levels from the finest to the coarsest
+ROLLUP_TIERS: tp.Tuple[RollupTier, ...] = (
+    RollupTier("hourly", 3600),
+    RollupTier("daily", 86400),
+    RollupTier("weekly", 604800),
+)
+ROLLUP_TIER_NAMES: tp.Dict[str, RollupTier] = {tier.name: tier for tier in ROLLUP_TIERS}
+
+# counters aggregated in every bucket
+ROLLUP_FIELDS: tp.Tuple[str, ...] = ("toot_count", "subscribers_count")
+
+
+@dataclass(frozen=True)
+class Rollup:
+    """Stores aggregated meterings of an account over one bucket of time"""
+
+    parent_account_internal_id: str
+    timestamp: datetime
+    count: int
+    first_timestamp: datetime
+    last_timestamp: datetime
+    toot_count_min: int
+    toot_count_max: int
+    toot_count_first: int
+    toot_count_last: int
+    subscribers_count_min: int
+    subscribers_count_max: int
+    subscribers_count_first: int
+    subscribers_count_last: int
+
+
+def get_rollup_update(metering: Metering) -> tp.List[Document]:
+    """
+    make an update pipeline merging the metering into its bucket. It doesn't depend
+    on the order the meterings are merged in, so it can be used for backfilling as well
+    """
+    timestamp: datetime = metering.timestamp
+    is_last: Document = {"$gte": [timestamp, {"$ifNull": ["$last_timestamp", timestamp]}]}
+    is_first: Document = {"$lte": [timestamp, {"$ifNull": ["$first_timestamp", timestamp]}]}
+    fields: Document = {
+        "count": {"$add": [{"$ifNull": ["$count", 0]}, 1]},
+        "first_timestamp": {"$min": ["$first_timestamp", timestamp]},
+        "last_timestamp": {"$max": ["$last_timestamp", timestamp]},
+    }
+
+    for field in ROLLUP_FIELDS:
+        value: int = getattr(metering, field)
+        fields[f"{field}_min"] = {"$min": [f"${field}_min", value]}
+        fields[f"{field}_max"] = {"$max": [f"${field}_max", value]}
+        fields[f"{field}_first"] = {"$cond": [is_first, value, f"${field}_first"]}
+        fields[f"{field}_last"] = {"$cond": [is_last, value, f"${field}_last"]}
+
+    return [{"$set": fields}]
+
+
+def make_rollups(meterings: tp.List[Metering], tier: RollupTier) -> tp.List[Rollup]:
+    """aggregate the chronologically sorted meterings of one account into the buckets of the tier"""
+    rollups: tp.List[Rollup] = []
+
+    for bucket, bucket_meterings in groupby(meterings, key=lambda m: tier.bucket_start(m.timestamp)):
+        group: tp.List[Metering] = list(bucket_meterings)
+        counters: Document = {}
+
+        for field in ROLLUP_FIELDS:
+            values: tp.List[int] = [getattr(m, field) for m in group]
+            counters[f"{field}_min"] = min(values)
+            counters[f"{field}_max"] = max(values)
+            counters[f"{field}_first"] = values[0]
+            counters[f"{field}_last"] = values[-1]
+
+        rollups.append(
+            Rollup(
+                parent_account_internal_id=group[0].parent_account_internal_id,
+                timestamp=bucket,
+                count=len(group),
+                first_timestamp=group[0].timestamp,
+                last_timestamp=group[-1].timestamp,
+                **counters,
+            )
+        )
+
+    return rollups
+
+
+def get_rollup_rows(rollups: tp.List[Rollup], previous: tp.Optional[Rollup]) -> tp.List[Document]:
+    """
+    represent the buckets as rows of the raw data response. Deltas are the change
+    of the last counts since the previous bucket, or since the first metering in the bucket
+    """
+    rows: tp.List[Document] = []
+
+    for rollup in rollups:
+        row: Document = {
+            "metering_id": f"{rollup.parent_account_internal_id}-{int(rollup.timestamp.timestamp())}",
+            "timestamp": str(rollup.timestamp),
+            "metering_count": rollup.count,
+        }
+
+        for field in ROLLUP_FIELDS:
+            last: int = getattr(rollup, f"{field}_last")
+            base: int = getattr(previous, f"{field}_last") if previous else getattr(rollup, f"{field}_first")
+            row[field] = last
+            row[f"{field}_min"] = getattr(rollup, f"{field}_min")
+            row[f"{field}_max"] = getattr(rollup, f"{field}_max")
+            row[f"{field}_delta"] = last - base
+
+        rows.append(row)
+        previous = rollup
+
+    return rows
+
+
+def choose_tier(
+    raw_count: tp.Optional[int], since: datetime, to: datetime, max_points: int
+) -> tp.Tuple[tp.Optional[RollupTier], bool]:
+    """
+    pick the finest data source that fits into the point budget: raw meterings (None) or a rollup tier.
+    If the number of raw meterings is unknown, a rollup tier is picked.
+    The second value tells if the chosen source still exceeds the budget and needs downsampling
+    """
+    if raw_count is not None and raw_count <= max_points:
+        return None, False
+
+    span: float = (to - since).total_seconds()
+    for tier in ROLLUP_TIERS:
+        if span / tier.seconds + 1 <= max_points:
+            return tier, False
+
+    return ROLLUP_TIERS[-1], True
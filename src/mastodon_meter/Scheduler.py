@@ -0,0 +1,113 @@
+import asyncio
+import bisect
+import hashlib
+import os
+import socket
+import typing as tp
+from uuid import uuid4
+
+from loguru import logger
+
+from .Account import Account
+from .AccountCache import AccountCache
+from .Singleton import SingletonMeta
+from .database import get_database
+
+# modes of splitting the metering work between the workers of the deployment
+SCHEDULER_MODES: tp.Tuple[str, ...] = ("leader", "sharded")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """assigns keys to workers with consistent hashing, so that only a small share of keys moves when workers change"""
+
+    def __init__(self, workers: tp.List[str], replicas: int = 64) -> None:
+        points: tp.List[tp.Tuple[int, str]] = sorted(
+            (_hash(f"{worker}#{i}"), worker) for worker in workers for i in range(replicas)
+        )
+        self._hashes: tp.List[int] = [point for point, _ in points]
+        self._workers: tp.List[str] = [worker for _, worker in points]
+
+    def get_worker(self, key: str) -> str:
+        """get the worker owning the key"""
+        position: int = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._workers[position]
+
+
+class Scheduler(metaclass=SingletonMeta):
+    """
+    coordinates metering between the workers of the deployment through the database. In the 'leader' mode
+    only the worker holding the leader lease gathers meterings, in the 'sharded' mode every alive worker gathers
+    meterings for its share of the tracked accounts. Dead workers are detected by their expired leases and heartbeats
+    """
+
+    leader_lease: str = "metering-leader"
+
+    def __init__(self) -> None:
+        self.mode: str = os.getenv("SCHEDULER_MODE", default="leader")
+        self.worker_id: str = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}"
+        self._lease_ttl: int = int(os.getenv("SCHEDULER_LEASE_TTL", default=60))
+        self._heartbeat_task: tp.Optional["asyncio.Task[None]"] = None
+
+        if self.mode not in SCHEDULER_MODES:
+            message = f"Unknown scheduler mode '{self.mode}', expected one of: {', '.join(SCHEDULER_MODES)}"
+            logger.critical(message)
+            raise ValueError(message)
+
+        logger.info(f"Worker {self.worker_id} uses '{self.mode}' scheduler mode")
+
+    async def _renew(self) -> bool:
+        """renew the leader lease or the worker heartbeat, depending on the mode"""
+        if self.mode == "leader":
+            return await get_database().acquire_lease(self.leader_lease, self.worker_id, self._lease_ttl)
+
+        await get_database().register_worker(self.worker_id, self._lease_ttl)
+        return True
+
+    async def _keep_alive(self) -> None:
+        """renew the lease or the heartbeat several times per its lifetime"""
+        while True:
+            try:
+                await self._renew()
+            except Exception as e:
+                logger.error(f"An error occurred while renewing the scheduler lease: {e}")
+
+            await asyncio.sleep(self._lease_ttl / 3)
+
+    def start(self) -> None:
+        """start reporting this worker alive"""
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._keep_alive())
+
+    async def stop(self) -> None:
+        """give up the lease or the heartbeat, so that other workers take the work over without waiting for expiry"""
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+        if self.mode == "leader":
+            await get_database().release_lease(self.leader_lease, self.worker_id)
+        else:
+            await get_database().unregister_worker(self.worker_id)
+
+    async def get_assigned_accounts(self) -> tp.Optional[tp.List[Account]]:
+        """get the tracked accounts this worker has to meter now, None if it has nothing to do"""
+        if not await self._renew():
+            logger.info(f"Worker {self.worker_id} is not the leader, skipping metering")
+            return None
+
+        accounts: tp.List[Account] = await AccountCache().get_tracked_accounts()
+        if self.mode == "leader":
+            return accounts
+
+        workers: tp.List[str] = await get_database().get_alive_workers()
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+
+        ring: HashRing = HashRing(workers)
+        assigned: tp.List[Account] = [a for a in accounts if ring.get_worker(a.internal_id) == self.worker_id]
+        logger.info(f"Worker {self.worker_id} is assigned {len(assigned)} of {len(accounts)} accounts")
+        return assigned
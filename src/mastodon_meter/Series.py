@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import typing as tp
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+from .Metering import Metering
+
+
+def to_epoch(timestamp: datetime) -> int:
+    """convert a naive UTC datetime into epoch seconds"""
+    return int(np.datetime64(timestamp, "s").astype(np.int64))
+
+
+@dataclass(frozen=True)
+class MeteringSeries:
+    """
+    Stores meterings of an account column-wise: epoch timestamps (in seconds)
+    and counters are kept in NumPy arrays sorted chronologically
+    """
+
+    timestamps: np.ndarray
+    toot_count: np.ndarray
+    subscribers_count: np.ndarray
+
+    @classmethod
+    def empty(cls) -> MeteringSeries:
+        return cls(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64))
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: tp.List[tp.Dict[str, tp.Any]],
+        toot_count_field: str = "toot_count",
+        subscribers_count_field: str = "subscribers_count",
+    ) -> MeteringSeries:
+        """build a series from a batch of database documents"""
+        count: int = len(documents)
+        timestamps: np.ndarray = np.array([d["timestamp"] for d in documents], dtype="datetime64[s]")
+        return cls(
+            timestamps.astype(np.int64),
+            np.fromiter((d[toot_count_field] for d in documents), dtype=np.int64, count=count),
+            np.fromiter((d[subscribers_count_field] for d in documents), dtype=np.int64, count=count),
+        )
+
+    @classmethod
+    def from_meterings(cls, meterings: tp.List[Metering]) -> MeteringSeries:
+        return cls.from_documents([vars(m) for m in meterings])
+
+    @classmethod
+    def concatenate(cls, chunks: tp.List[MeteringSeries]) -> MeteringSeries:
+        """join the series built from consecutive batches"""
+        if not chunks:
+            return cls.empty()
+        if len(chunks) == 1:
+            return chunks[0]
+
+        return cls(
+            np.concatenate([c.timestamps for c in chunks]),
+            np.concatenate([c.toot_count for c in chunks]),
+            np.concatenate([c.subscribers_count for c in chunks]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def datetimes(self) -> np.ndarray:
+        return self.timestamps.astype("datetime64[s]")
+
+    def column(self, field: str) -> np.ndarray:
+        """get the counter by its name"""
+        values: np.ndarray = getattr(self, field)
+        return values
+
+    def take(self, indices: tp.Union[slice, np.ndarray]) -> MeteringSeries:
+        """get a series holding only the selected points"""
+        return MeteringSeries(self.timestamps[indices], self.toot_count[indices], self.subscribers_count[indices])
+
+    def within(self, since: tp.Optional[datetime], to: tp.Optional[datetime]) -> MeteringSeries:
+        """get the part of the series within the time boundaries"""
+        start: int = int(np.searchsorted(self.timestamps, to_epoch(since), side="left")) if since else 0
+        end: int = int(np.searchsorted(self.timestamps, to_epoch(to), side="right")) if to else len(self)
+        return self.take(slice(start, end))
+
+
+def collect_account_series(
+    chunks: tp.Dict[str, tp.List[MeteringSeries]],
+    documents: tp.List[tp.Dict[str, tp.Any]],
+    toot_count_field: str = "toot_count",
+    subscribers_count_field: str = "subscribers_count",
+) -> None:
+    """
+    split a batch of documents ordered by account and then chronologically
+    into series of the accounts, appending them to the chunks of each account
+    """
+    for account_internal_id, group in groupby(documents, key=itemgetter("parent_account_internal_id")):
+        series: MeteringSeries = MeteringSeries.from_documents(list(group), toot_count_field, subscribers_count_field)
+        chunks.setdefault(account_internal_id, []).append(series)
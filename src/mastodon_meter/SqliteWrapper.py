@@ -0,0 +1,730 @@
+import asyncio
+import json
+import os
+import sqlite3
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime, timedelta
+
+from loguru import logger
+
+from .Account import Account
+from .AccountState import AccountState
+from .DatabaseWrapper import DatabaseWrapper
+from .Fetching import Validators
+from .Metering import Metering
+from .Metrics import DB_DOCUMENTS
+from .Rollups import ROLLUP_FIELDS, ROLLUP_TIERS, Rollup, RollupTier
+from .Series import MeteringSeries, collect_account_series
+from .Types import Document
+
+T = tp.TypeVar("T")
+Parameters = tp.Sequence[tp.Any]
+
+# datetime columns of the tables, stored as ISO 8601 text, so that they sort chronologically
+DATETIME_COLUMNS: tp.FrozenSet[str] = frozenset(
+    ("timestamp", "added_on", "first_timestamp", "last_timestamp", "previous_timestamp", "last_checked")
+)
+
+# the number of values bound in one IN (...) clause, kept below the SQLite limit on query parameters
+IN_CHUNK_SIZE: int = 500
+
+ACCOUNT_COLUMNS: tp.Tuple[str, ...] = ("internal_id", "username", "instance", "id", "added_on", "metering_interval")
+METERING_COLUMNS: tp.Tuple[str, ...] = (
+    "internal_id",
+    "parent_account_internal_id",
+    "timestamp",
+    "toot_count",
+    "subscribers_count",
+)
+ROLLUP_COLUMNS: tp.Tuple[str, ...] = tuple(
+    ["parent_account_internal_id", "timestamp", "count", "first_timestamp", "last_timestamp"]
+    + [f"{field}_{stat}" for field in ROLLUP_FIELDS for stat in ("min", "max", "first", "last")]
+)
+STATE_COLUMNS: tp.Tuple[str, ...] = (
+    "parent_account_internal_id",
+    "timestamp",
+    "toot_count",
+    "subscribers_count",
+    "previous_timestamp",
+    "previous_toot_count",
+    "previous_subscribers_count",
+    "toot_count_delta",
+    "subscribers_count_delta",
+    "last_checked",
+)
+
+
+def _rollup_table(tier: RollupTier) -> str:
+    return f"rollups_{tier.name}"
+
+
+def _get_schema() -> str:
+    rollup_table: str = """
+        CREATE TABLE IF NOT EXISTS {name} (
+            parent_account_internal_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_timestamp TEXT NOT NULL,
+            last_timestamp TEXT NOT NULL,
+            {counters},
+            PRIMARY KEY (parent_account_internal_id, timestamp)
+        ) WITHOUT ROWID;
+    """
+    counters: str = ", ".join(f"{column} INTEGER NOT NULL" for column in ROLLUP_COLUMNS[5:])
+    rollup_tables: str = "".join(
+        rollup_table.format(name=_rollup_table(tier), counters=counters) for tier in ROLLUP_TIERS
+    )
+
+    return f"""
+        CREATE TABLE IF NOT EXISTS tracked_accounts (
+            internal_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            instance TEXT NOT NULL,
+            id TEXT NOT NULL,
+            added_on TEXT NOT NULL,
+            metering_interval INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS meterings (
+            internal_id TEXT NOT NULL,
+            parent_account_internal_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            toot_count INTEGER NOT NULL,
+            subscribers_count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS meterings_by_account ON meterings (parent_account_internal_id, timestamp);
+        {rollup_tables}
+        CREATE TABLE IF NOT EXISTS account_states (
+            parent_account_internal_id TEXT PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            toot_count INTEGER NOT NULL,
+            subscribers_count INTEGER NOT NULL,
+            previous_timestamp TEXT,
+            previous_toot_count INTEGER,
+            previous_subscribers_count INTEGER,
+            toot_count_delta INTEGER,
+            subscribers_count_delta INTEGER,
+            last_checked TEXT
+        );
+        CREATE TABLE IF NOT EXISTS fetch_validators (
+            account_internal_id TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, expires_at TEXT NOT NULL);
+    """
+
+
+def _to_text(timestamp: datetime) -> str:
+    return timestamp.isoformat(sep=" ", timespec="microseconds")
+
+
+def _to_row(values: tp.Iterable[tp.Any]) -> tp.Tuple[tp.Any, ...]:
+    """convert the values to be stored into the types SQLite understands"""
+    return tuple(_to_text(value) if isinstance(value, datetime) else value for value in values)
+
+
+def _to_document(row: sqlite3.Row) -> Document:
+    """convert a row into a document, parsing the datetime columns"""
+    document: Document = dict(zip(row.keys(), row))
+
+    for column in DATETIME_COLUMNS.intersection(document):
+        if document[column] is not None:
+            document[column] = datetime.fromisoformat(document[column])
+
+    return document
+
+
+def _chunks(values: tp.List[str]) -> tp.Iterator[tp.List[str]]:
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        end: int = start + IN_CHUNK_SIZE
+        yield values[start:end]
+
+
+def _placeholders(count: int) -> str:
+    return ", ".join("?" * count)
+
+
+class SqliteWrapper(DatabaseWrapper):
+    """
+    A database wrapper implementation for SQLite, an embedded database for small deployments and local runs.
+    The database runs in the WAL mode, the queries are executed in a dedicated thread not to block the event loop
+    """
+
+    def __init__(self) -> None:
+        """open the database file, creating the tables if they don't exist yet"""
+        path: str = os.getenv("SQLITE_PATH", default="mastodon-meter.sqlite3")
+        logger.info(f"Opening SQLite database at {path}")
+
+        self._batch_size: int = int(os.getenv("DB_BATCH_SIZE", default=1000))
+        # a connection must not be used concurrently, so all the queries go through one thread
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript(_get_schema())
+
+        logger.info("Opened SQLite database")
+
+    async def _run(self, function: tp.Callable[..., T], *args: tp.Any) -> T:
+        """run the function in the database thread"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _fetch_all(self, query: str, parameters: Parameters) -> tp.List[Document]:
+        return [_to_document(row) for row in self._connection.execute(query, _to_row(parameters))]
+
+    def _fetch_one(self, query: str, parameters: Parameters) -> tp.Optional[Document]:
+        row: tp.Optional[sqlite3.Row] = self._connection.execute(query, _to_row(parameters)).fetchone()
+        return _to_document(row) if row is not None else None
+
+    def _fetch_many(self, cursor: sqlite3.Cursor, size: int) -> tp.List[Document]:
+        return [_to_document(row) for row in cursor.fetchmany(size)]
+
+    def _write(self, query: str, rows: tp.Iterable[Parameters]) -> int:
+        """execute the statement for every row in one transaction, returning the number of changed rows"""
+        with self._connection:
+            cursor: sqlite3.Cursor = self._connection.executemany(query, [_to_row(row) for row in rows])
+        return cursor.rowcount
+
+    def _insert_new(self, query: str, rows: tp.Iterable[Parameters]) -> tp.List[bool]:
+        """execute the ignoring insert for every row in one transaction, telling which rows were inserted"""
+        with self._connection:
+            return [self._connection.execute(query, _to_row(row)).rowcount > 0 for row in rows]
+
+    async def _query(self, query: str, *parameters: tp.Any) -> tp.List[Document]:
+        return await self._run(self._fetch_all, query, parameters)
+
+    async def _query_one(self, query: str, *parameters: tp.Any) -> tp.Optional[Document]:
+        return await self._run(self._fetch_one, query, parameters)
+
+    async def _execute(self, query: str, *parameters: tp.Any) -> int:
+        return await self._run(self._write, query, [parameters])
+
+    async def _iter_documents(
+        self, query: str, parameters: Parameters, batch_size: tp.Optional[int] = None
+    ) -> tp.AsyncIterator[Document]:
+        """stream the rows of the query result in batches"""
+        batch_size = batch_size or self._batch_size
+        cursor: sqlite3.Cursor = await self._run(self._connection.execute, query, _to_row(parameters))
+
+        while True:
+            documents: tp.List[Document] = await self._run(self._fetch_many, cursor, batch_size)
+            DB_DOCUMENTS.inc(len(documents), backend=type(self).__name__, direction="read")
+            for document in documents:
+                yield document
+            if len(documents) < batch_size:
+                break
+
+    @staticmethod
+    def _metering_query(
+        account_internal_id: tp.Union[str, tp.List[str], None],
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+    ) -> tp.Tuple[str, tp.List[tp.Any]]:
+        """
+        make a condition selecting rows for an account (or for a list of accounts, or for all of them)
+        within the time boundaries, served by the primary indexes
+        """
+        conditions: tp.List[str] = []
+        parameters: tp.List[tp.Any] = []
+
+        if isinstance(account_internal_id, list):
+            conditions.append(f"parent_account_internal_id IN ({_placeholders(len(account_internal_id))})")
+            parameters.extend(account_internal_id)
+        elif account_internal_id is not None:
+            conditions.append("parent_account_internal_id = ?")
+            parameters.append(account_internal_id)
+
+        for operator, value in ((">=", since), (">", after), ("<=", to)):
+            if value is not None:
+                conditions.append(f"timestamp {operator} ?")
+                parameters.append(value)
+
+        return " AND ".join(conditions) or "1", parameters
+
+    async def ensure_indexes(self) -> None:
+        """
+        the tables and most of the indexes are created along with the connection. The unique indexes on the identity
+        of the accounts and the meterings may fail on a database storing one twice, that must not keep the app
+        from starting
+        """
+        try:
+            await self._execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS tracked_accounts_by_identity ON tracked_accounts (instance, id)"
+            )
+        except sqlite3.IntegrityError:
+            logger.warning("Some accounts are tracked more than once, remove the duplicates to prevent new ones")
+
+        try:
+            await self._execute("CREATE UNIQUE INDEX IF NOT EXISTS meterings_by_id ON meterings (internal_id)")
+        except sqlite3.IntegrityError:
+            logger.warning("Some meterings are stored more than once, remove the duplicates to prevent new ones")
+
+    async def backfill_rollups(self) -> None:
+        """rollups are maintained since the database was created, so there is nothing to backfill"""
+
+    async def backfill_account_states(self) -> None:
+        """states are maintained since the database was created, so there is nothing to backfill"""
+
+    async def close(self) -> None:
+        """wait for the pending queries and close the database"""
+        await self._run(self._connection.close)
+        self._executor.shutdown()
+
+    async def add_tracked_account(self, account: Account) -> None:
+        data: Document = asdict(account)
+        await self._execute(
+            f"INSERT INTO tracked_accounts ({', '.join(ACCOUNT_COLUMNS)}) VALUES ({_placeholders(len(ACCOUNT_COLUMNS))})",
+            *(data[column] for column in ACCOUNT_COLUMNS),
+        )
+        await self._bump_version("accounts-version")
+
+    async def add_tracked_accounts(self, accounts: tp.List[Account]) -> tp.List[Account]:
+        inserted: tp.List[bool] = await self._run(
+            self._insert_new,
+            f"INSERT OR IGNORE INTO tracked_accounts ({', '.join(ACCOUNT_COLUMNS)}) "
+            f"VALUES ({_placeholders(len(ACCOUNT_COLUMNS))})",
+            [[asdict(account)[column] for column in ACCOUNT_COLUMNS] for account in accounts],
+        )
+        added: tp.List[Account] = [account for account, new in zip(accounts, inserted) if new]
+        if added:
+            DB_DOCUMENTS.inc(len(added), backend=type(self).__name__, direction="written")
+            await self._bump_version("accounts-version")
+        return added
+
+    async def delete_tracked_account(self, account_internal_id: str) -> None:
+        await self._execute("DELETE FROM tracked_accounts WHERE internal_id = ?", account_internal_id)
+        await self._execute("DELETE FROM fetch_validators WHERE account_internal_id = ?", account_internal_id)
+        await self._bump_version("accounts-version")
+
+    async def set_metering_interval(self, account_internal_id: str, metering_interval: tp.Optional[int]) -> None:
+        changed: int = await self._execute(
+            "UPDATE tracked_accounts SET metering_interval = ? WHERE internal_id = ?",
+            metering_interval,
+            account_internal_id,
+        )
+
+        if not changed:
+            raise KeyError(f"Account {account_internal_id} is not tracked")
+
+        await self._bump_version("accounts-version")
+
+    async def _bump_version(self, key: str) -> None:
+        await self._execute(
+            "INSERT INTO meta (key, value) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            key,
+        )
+
+    async def _get_version(self, key: str) -> int:
+        data: tp.Optional[Document] = await self._query_one("SELECT value FROM meta WHERE key = ?", key)
+        return int(data["value"]) if data else 0
+
+    async def get_accounts_version(self) -> int:
+        return await self._get_version("accounts-version")
+
+    async def iter_tracked_accounts(self) -> tp.AsyncIterator[Account]:
+        async for data in self._iter_documents("SELECT * FROM tracked_accounts ORDER BY rowid", ()):
+            yield Account(**data)
+
+    async def get_account_by_internal_id(self, account_internal_id: str) -> Account:
+        data: tp.Optional[Document] = await self._query_one(
+            "SELECT * FROM tracked_accounts WHERE internal_id = ?", account_internal_id
+        )
+
+        if data is None:
+            raise KeyError(f"Account {account_internal_id} is not tracked")
+
+        return Account(**data)
+
+    async def add_meterings(self, meterings: tp.List[Metering]) -> None:
+        # the meterings stored by a failed write already are ignored by the unique index on their ids
+        await self._run(
+            self._write,
+            f"INSERT OR IGNORE INTO meterings ({', '.join(METERING_COLUMNS)}) "
+            f"VALUES ({_placeholders(len(METERING_COLUMNS))})",
+            [[getattr(m, column) for column in METERING_COLUMNS] for m in meterings],
+        )
+        DB_DOCUMENTS.inc(len(meterings), backend=type(self).__name__, direction="written")
+
+    async def delete_meterings_for_account(self, account_internal_id: str) -> None:
+        tables: tp.List[str] = ["meterings", "account_states"] + [_rollup_table(tier) for tier in ROLLUP_TIERS]
+        for table in tables:
+            await self._execute(f"DELETE FROM {table} WHERE parent_account_internal_id = ?", account_internal_id)
+        await self._bump_version("account-states-version")
+
+    async def iter_meterings(
+        self,
+        account_internal_id: str,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+        limit: int = 0,
+        batch_size: tp.Optional[int] = None,
+    ) -> tp.AsyncIterator[Metering]:
+        condition, parameters = self._metering_query(account_internal_id, since, to, after)
+        query: str = f"SELECT * FROM meterings WHERE {condition} ORDER BY timestamp"
+
+        if limit:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        async for data in self._iter_documents(query, parameters, batch_size):
+            yield Metering(**data)
+
+    async def iter_meterings_for_accounts(
+        self,
+        account_internal_ids: tp.Optional[tp.List[str]] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.AsyncIterator[Metering]:
+        # the number of query parameters is limited, so long lists of accounts are queried in sorted chunks
+        selections: tp.List[tp.Optional[tp.List[str]]] = (
+            list(_chunks(sorted(set(account_internal_ids)))) if account_internal_ids is not None else [None]
+        )
+
+        for selection in selections:
+            condition, parameters = self._metering_query(selection, since, to)
+            query: str = f"SELECT * FROM meterings WHERE {condition} ORDER BY parent_account_internal_id, timestamp"
+            async for data in self._iter_documents(query, parameters):
+                yield Metering(**data)
+
+    async def _get_edge_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime], to: tp.Optional[datetime], order: str
+    ) -> tp.Optional[Metering]:
+        condition, parameters = self._metering_query(account_internal_id, since, to)
+        data: tp.Optional[Document] = await self._query_one(
+            f"SELECT * FROM meterings WHERE {condition} ORDER BY timestamp {order} LIMIT 1", *parameters
+        )
+        return Metering(**data) if data else None
+
+    async def get_latest_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.Optional[Metering]:
+        return await self._get_edge_metering(account_internal_id, since, to, "DESC")
+
+    async def get_earliest_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.Optional[Metering]:
+        return await self._get_edge_metering(account_internal_id, since, to, "ASC")
+
+    async def count_meterings(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> int:
+        condition, parameters = self._metering_query(account_internal_id, since, to)
+        data: tp.Optional[Document] = await self._query_one(
+            f"SELECT COUNT(*) AS count FROM meterings WHERE {condition}", *parameters
+        )
+        return int(data["count"]) if data else 0
+
+    async def _load_series(
+        self,
+        table: str,
+        condition: str,
+        parameters: Parameters,
+        toot_count_field: str = "toot_count",
+        subscribers_count_field: str = "subscribers_count",
+    ) -> MeteringSeries:
+        """load the matching rows into a columnar series, converting them batch by batch"""
+        query: str = (
+            f"SELECT timestamp, {toot_count_field}, {subscribers_count_field} FROM {table} "
+            f"WHERE {condition} ORDER BY timestamp"
+        )
+        cursor: sqlite3.Cursor = await self._run(self._connection.execute, query, _to_row(parameters))
+        chunks: tp.List[MeteringSeries] = []
+
+        while True:
+            documents: tp.List[Document] = await self._run(self._fetch_many, cursor, self._batch_size)
+            if not documents:
+                break
+            chunks.append(MeteringSeries.from_documents(documents, toot_count_field, subscribers_count_field))
+            DB_DOCUMENTS.inc(len(documents), backend=type(self).__name__, direction="read")
+
+        return MeteringSeries.concatenate(chunks)
+
+    async def get_metering_series(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> MeteringSeries:
+        condition, parameters = self._metering_query(account_internal_id, since, to)
+        return await self._load_series("meterings", condition, parameters)
+
+    async def get_series_for_accounts(
+        self,
+        account_internal_ids: tp.List[str],
+        tier: tp.Optional[RollupTier] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.Dict[str, MeteringSeries]:
+        table: str = "meterings"
+        fields: tp.Tuple[str, str] = ("toot_count", "subscribers_count")
+        if tier is not None:
+            since = tier.bucket_start(since) if since else None
+            table = _rollup_table(tier)
+            fields = ("toot_count_last", "subscribers_count_last")
+
+        chunks: tp.Dict[str, tp.List[MeteringSeries]] = {}
+        # the number of query parameters is limited, so long lists of accounts are queried in chunks
+        for selection in _chunks(sorted(set(account_internal_ids))):
+            condition, parameters = self._metering_query(selection, since, to)
+            cursor: sqlite3.Cursor = await self._run(
+                self._connection.execute,
+                f"SELECT parent_account_internal_id, timestamp, {', '.join(fields)} FROM {table} "
+                f"WHERE {condition} ORDER BY parent_account_internal_id, timestamp",
+                _to_row(parameters),
+            )
+
+            while True:
+                documents: tp.List[Document] = await self._run(self._fetch_many, cursor, self._batch_size)
+                if not documents:
+                    break
+                collect_account_series(chunks, documents, *fields)
+                DB_DOCUMENTS.inc(len(documents), backend=type(self).__name__, direction="read")
+
+        return {
+            account_internal_id: MeteringSeries.concatenate(chunks.get(account_internal_id, []))
+            for account_internal_id in account_internal_ids
+        }
+
+    async def update_account_states(self, meterings: tp.List[Metering]) -> None:
+        # the previous counts are taken from the row before the update, so meterings are applied in chronological order.
+        # The ones not newer than the state are skipped, so that a retried write doesn't shift the state twice
+        await self._run(
+            self._write,
+            """
+            INSERT INTO account_states (parent_account_internal_id, timestamp, toot_count, subscribers_count, last_checked)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (parent_account_internal_id) DO UPDATE SET
+                previous_timestamp = timestamp,
+                previous_toot_count = toot_count,
+                previous_subscribers_count = subscribers_count,
+                toot_count_delta = excluded.toot_count - toot_count,
+                subscribers_count_delta = excluded.subscribers_count - subscribers_count,
+                timestamp = excluded.timestamp,
+                toot_count = excluded.toot_count,
+                subscribers_count = excluded.subscribers_count,
+                last_checked = excluded.last_checked
+            WHERE excluded.timestamp > timestamp
+            """,
+            [
+                (m.parent_account_internal_id, m.timestamp, m.toot_count, m.subscribers_count, m.timestamp)
+                for m in sorted(meterings, key=lambda m: m.timestamp)
+            ],
+        )
+        DB_DOCUMENTS.inc(len(meterings), backend=type(self).__name__, direction="written")
+        await self._bump_version("account-states-version")
+
+    async def get_account_states_version(self) -> int:
+        return await self._get_version("account-states-version")
+
+    async def mark_accounts_checked(self, account_internal_ids: tp.List[str], timestamp: datetime) -> None:
+        await self._run(
+            self._write,
+            "UPDATE account_states SET last_checked = ? WHERE parent_account_internal_id = ?",
+            [(timestamp, account_internal_id) for account_internal_id in account_internal_ids],
+        )
+
+    async def get_account_states(
+        self, account_internal_ids: tp.Optional[tp.List[str]] = None
+    ) -> tp.List[tp.Tuple[Account, tp.Optional[AccountState]]]:
+        state_columns: str = ", ".join(f"s.{column} AS state_{column}" for column in STATE_COLUMNS)
+        query: str = (
+            f"SELECT a.*, {state_columns} FROM tracked_accounts a "
+            "LEFT JOIN account_states s ON s.parent_account_internal_id = a.internal_id"
+        )
+        rows: tp.List[Document] = []
+
+        if account_internal_ids is None:
+            rows = await self._query(f"{query} ORDER BY a.rowid")
+        else:
+            for chunk in _chunks(account_internal_ids):
+                rows += await self._query(f"{query} WHERE a.internal_id IN ({_placeholders(len(chunk))})", *chunk)
+
+        result: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]] = []
+        for row in rows:
+            state: Document = {column: row.pop(f"state_{column}") for column in STATE_COLUMNS}
+            # the state columns are prefixed, so their datetimes are parsed here
+            for column in DATETIME_COLUMNS.intersection(state):
+                if state[column] is not None:
+                    state[column] = datetime.fromisoformat(state[column])
+
+            has_state: bool = state["parent_account_internal_id"] is not None
+            result.append((Account(**row), AccountState(**state) if has_state else None))
+
+        return result
+
+    async def get_validators(self, account_internal_ids: tp.List[str]) -> tp.Dict[str, Validators]:
+        result: tp.Dict[str, Validators] = {}
+
+        for chunk in _chunks(account_internal_ids):
+            rows: tp.List[Document] = await self._query(
+                f"SELECT * FROM fetch_validators WHERE account_internal_id IN ({_placeholders(len(chunk))})", *chunk
+            )
+            result.update({row.pop("account_internal_id"): Validators(**row) for row in rows})
+
+        return result
+
+    async def save_validators(self, validators: tp.Dict[str, Validators]) -> None:
+        await self._run(
+            self._write,
+            "INSERT OR REPLACE INTO fetch_validators (account_internal_id, etag, last_modified) VALUES (?, ?, ?)",
+            [(account_internal_id, v.etag, v.last_modified) for account_internal_id, v in validators.items()],
+        )
+
+    async def update_rollups(self, meterings: tp.List[Metering], tiers: tp.Sequence[RollupTier] = ROLLUP_TIERS) -> None:
+        # the merge doesn't depend on the order of the meterings, like the one of the MongoDB backend
+        updates: tp.List[str] = [
+            "count = count + 1",
+            "first_timestamp = min(first_timestamp, excluded.first_timestamp)",
+            "last_timestamp = max(last_timestamp, excluded.last_timestamp)",
+        ]
+        for field in ROLLUP_FIELDS:
+            updates += [
+                f"{field}_min = min({field}_min, excluded.{field}_min)",
+                f"{field}_max = max({field}_max, excluded.{field}_max)",
+                f"{field}_first = CASE WHEN excluded.first_timestamp <= first_timestamp "
+                f"THEN excluded.{field}_first ELSE {field}_first END",
+                f"{field}_last = CASE WHEN excluded.last_timestamp >= last_timestamp "
+                f"THEN excluded.{field}_last ELSE {field}_last END",
+            ]
+
+        for tier in tiers:
+            rows: tp.List[tp.List[tp.Any]] = []
+            for m in meterings:
+                row: tp.List[tp.Any] = [m.parent_account_internal_id, tier.bucket_start(m.timestamp), 1]
+                row += [m.timestamp, m.timestamp]
+                for field in ROLLUP_FIELDS:
+                    row += [getattr(m, field)] * 4
+                rows.append(row)
+
+            await self._run(
+                self._write,
+                f"""
+                INSERT INTO {_rollup_table(tier)} ({', '.join(ROLLUP_COLUMNS)})
+                VALUES ({_placeholders(len(ROLLUP_COLUMNS))})
+                ON CONFLICT (parent_account_internal_id, timestamp) DO UPDATE SET {', '.join(updates)}
+                """,
+                rows,
+            )
+            DB_DOCUMENTS.inc(len(rows), backend=type(self).__name__, direction="written")
+
+    async def get_rollups(
+        self,
+        account_internal_id: str,
+        tier: RollupTier,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+        limit: int = 0,
+    ) -> tp.List[Rollup]:
+        since = tier.bucket_start(since) if since else None
+        condition, parameters = self._metering_query(account_internal_id, since, to, after)
+        query: str = f"SELECT * FROM {_rollup_table(tier)} WHERE {condition} ORDER BY timestamp"
+
+        if limit:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        return [Rollup(**data) for data in await self._query(query, *parameters)]
+
+    async def get_rollup_series(
+        self,
+        account_internal_id: str,
+        tier: RollupTier,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> MeteringSeries:
+        since = tier.bucket_start(since) if since else None
+        condition, parameters = self._metering_query(account_internal_id, since, to)
+        return await self._load_series(
+            _rollup_table(tier), condition, parameters, "toot_count_last", "subscribers_count_last"
+        )
+
+    async def get_rollup_changes(
+        self, account_internal_ids: tp.List[str], tier: RollupTier, since: datetime
+    ) -> tp.List[Document]:
+        columns: tp.List[str] = ["parent_account_internal_id AS _id"]
+        for field in ROLLUP_FIELDS:
+            columns.append(f"first_value({field}_first) OVER buckets AS {field}_first")
+            columns.append(f"last_value({field}_last) OVER buckets AS {field}_last")
+
+        result: tp.List[Document] = []
+        for chunk in _chunks(account_internal_ids):
+            result += await self._query(
+                f"""
+                SELECT DISTINCT {', '.join(columns)} FROM {_rollup_table(tier)}
+                WHERE parent_account_internal_id IN ({_placeholders(len(chunk))}) AND timestamp >= ?
+                WINDOW buckets AS (
+                    PARTITION BY parent_account_internal_id ORDER BY timestamp
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                )
+                """,
+                *chunk,
+                tier.bucket_start(since),
+            )
+
+        return result
+
+    async def get_previous_rollup(
+        self, account_internal_id: str, tier: RollupTier, before: datetime
+    ) -> tp.Optional[Rollup]:
+        data: tp.Optional[Document] = await self._query_one(
+            f"SELECT * FROM {_rollup_table(tier)} WHERE parent_account_internal_id = ? AND timestamp < ? "
+            "ORDER BY timestamp DESC LIMIT 1",
+            account_internal_id,
+            before,
+        )
+        return Rollup(**data) if data else None
+
+    async def save_stats_snapshot(self, snapshot: Document) -> None:
+        value: str = json.dumps({**snapshot, "timestamp": _to_text(snapshot["timestamp"])})
+        await self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('stats-snapshot', ?)", value)
+
+    async def get_stats_snapshot(self) -> tp.Optional[Document]:
+        data: tp.Optional[Document] = await self._query_one("SELECT value FROM meta WHERE key = 'stats-snapshot'")
+        if data is None:
+            return None
+
+        snapshot: Document = json.loads(data["value"])
+        snapshot["timestamp"] = datetime.fromisoformat(snapshot["timestamp"])
+        return snapshot
+
+    async def acquire_lease(self, name: str, holder: str, ttl: int) -> bool:
+        now: datetime = datetime.utcnow()
+        changed: int = await self._execute(
+            """
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE holder = excluded.holder OR expires_at < ?
+            """,
+            name,
+            holder,
+            now + timedelta(seconds=ttl),
+            now,
+        )
+        return changed > 0
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        await self._execute("DELETE FROM leases WHERE name = ? AND holder = ?", name, holder)
+
+    async def register_worker(self, worker_id: str, ttl: int) -> None:
+        now: datetime = datetime.utcnow()
+        await self._execute("DELETE FROM workers WHERE expires_at < ?", now)
+        await self._execute(
+            "INSERT OR REPLACE INTO workers (worker_id, expires_at) VALUES (?, ?)",
+            worker_id,
+            now + timedelta(seconds=ttl),
+        )
+
+    async def unregister_worker(self, worker_id: str) -> None:
+        await self._execute("DELETE FROM workers WHERE worker_id = ?", worker_id)
+
+    async def get_alive_workers(self) -> tp.List[str]:
+        rows: tp.List[Document] = await self._query(
+            "SELECT worker_id FROM workers WHERE expires_at > ? ORDER BY worker_id", datetime.utcnow()
+        )
+        return [row["worker_id"] for row in rows]
@@ -1,11 +1,15 @@
 import typing as tp
+from datetime import datetime
 
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 
 from .Account import Account
+from .Downsampling import SamplingOptions
 from .Metering import Metering
+from .Plotting import PlotOptions
 
 Document = tp.Dict[str, tp.Any]
 ResponsePayload = tp.Dict[str, tp.Any]
-GraphData = tp.Tuple[tp.List[Metering], Account]
-FileOrError = tp.Union[ResponsePayload, FileResponse]
+TimeBoundaries = tp.Tuple[tp.Optional[datetime], tp.Optional[datetime]]
+GraphData = tp.Tuple[Account, TimeBoundaries, tp.Optional[Metering], PlotOptions, SamplingOptions]
+FileOrError = tp.Union[ResponsePayload, Response]
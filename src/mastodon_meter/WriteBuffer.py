@@ -0,0 +1,184 @@
+import asyncio
+import os
+import typing as tp
+from dataclasses import dataclass, field
+from time import monotonic
+
+from loguru import logger
+
+from .Fetching import Validators
+from .Metering import Metering
+
+
+@dataclass
+class WriteBatch:
+    """Stores the gathering results waiting to be written into the database"""
+
+    meterings: tp.List[Metering] = field(default_factory=list)
+    unchanged: tp.List[str] = field(default_factory=list)
+    validators: tp.Dict[str, Validators] = field(default_factory=dict)
+    # ids of the meterings each step of a failed write was done for, so that retrying the batch doesn't repeat it
+    completed: tp.Dict[str, tp.Set[str]] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.meterings) + len(self.unchanged)
+
+    def __bool__(self) -> bool:
+        return bool(self.meterings or self.unchanged or self.validators)
+
+    def requeue(self, newer: "WriteBatch") -> "WriteBatch":
+        """put the results of a failed write in front of the ones added meanwhile"""
+        return WriteBatch(
+            meterings=self.meterings + newer.meterings,
+            unchanged=self.unchanged + newer.unchanged,
+            validators={**self.validators, **newer.validators},
+            completed=self.completed,
+        )
+
+    def pending(self, step: str) -> tp.List[Metering]:
+        """get the meterings the step of the write is not done for yet"""
+        done: tp.Set[str] = self.completed.get(step, set())
+        return [m for m in self.meterings if m.internal_id not in done]
+
+    def complete(self, step: str, meterings: tp.List[Metering]) -> None:
+        """record that the step of the write is done for the meterings"""
+        self.completed.setdefault(step, set()).update(m.internal_id for m in meterings)
+
+
+@dataclass
+class FlushStats:
+    """Stores the number and the latency of the buffer flushes"""
+
+    flushes: int = 0
+    documents: int = 0
+    failures: int = 0
+    dropped: int = 0
+    total_time: float = 0
+    max_time: float = 0
+    last_time: float = 0
+
+    def as_dict(self) -> tp.Dict[str, tp.Any]:
+        return {
+            "flushes": self.flushes,
+            "documents": self.documents,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "latency_ms": {
+                "last": round(self.last_time * 1000, 1),
+                "avg": round(self.total_time / self.flushes * 1000, 1) if self.flushes else None,
+                "max": round(self.max_time * 1000, 1),
+                "total": round(self.total_time * 1000, 1),
+            },
+        }
+
+
+WriteFunction = tp.Callable[[WriteBatch], tp.Awaitable[None]]
+
+
+class WriteBuffer:
+    """
+    write-behind buffer for the gathering results. The results are written in batches once
+    the batch is full or the oldest result has waited for the flush interval, so that memory
+    usage stays bounded and the database gets a steady load during large runs
+    """
+
+    def __init__(self, write: WriteFunction) -> None:
+        self._write: WriteFunction = write
+        self._batch_size: int = int(os.getenv("WRITE_BATCH_SIZE", default=100))
+        self._flush_interval: float = float(os.getenv("WRITE_FLUSH_INTERVAL", default=5))
+        # how many times in a row a failed batch is put back to be retried with the next flush
+        self._retry_limit: int = int(os.getenv("WRITE_RETRY_LIMIT", default=3))
+        self._retries: int = 0
+        self._batch: WriteBatch = WriteBatch()
+        self._batch_started: float = 0
+        self._lock: tp.Optional[asyncio.Lock] = None
+        self._timer: tp.Optional["asyncio.Task[None]"] = None
+        self.stats: FlushStats = FlushStats()
+
+    def _start(self) -> None:
+        """start the timer flushing the results, that waited for too long"""
+        if self._timer is None or self._timer.done():
+            # the lock is made anew for the event loop of the run, unless a flush in progress holds it
+            if self._lock is None or not self._lock.locked():
+                self._lock = asyncio.Lock()
+            self._timer = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self._batch and monotonic() - self._batch_started >= self._flush_interval:
+                # stopping the timer must not interrupt a write, the batch is already taken out of the buffer
+                await asyncio.shield(self.flush())
+
+    async def _added(self) -> None:
+        if len(self._batch) >= self._batch_size:
+            await self.flush()
+
+    def _touch(self) -> None:
+        self._start()
+        if not self._batch:
+            self._batch_started = monotonic()
+
+    async def add_metering(self, metering: Metering) -> None:
+        self._touch()
+        self._batch.meterings.append(metering)
+        await self._added()
+
+    async def add_unchanged(self, account_internal_id: str) -> None:
+        self._touch()
+        self._batch.unchanged.append(account_internal_id)
+        await self._added()
+
+    def add_validators(self, account_internal_id: str, validators: Validators) -> None:
+        self._touch()
+        self._batch.validators[account_internal_id] = validators
+
+    async def flush(self) -> None:
+        """write all the buffered results, waiting for a flush in progress"""
+        if self._lock is None:
+            return
+
+        async with self._lock:
+            if not self._batch:
+                return
+            batch, self._batch = self._batch, WriteBatch()
+
+            t0: float = monotonic()
+            try:
+                await self._write(batch)
+            except Exception as e:
+                self.stats.failures += 1
+                self._requeue(batch)
+                logger.error(f"Failed to write {len(batch)} gathering results: {type(e).__name__}: {e}")
+                return
+            finally:
+                elapsed: float = monotonic() - t0
+                self.stats.flushes += 1
+                self.stats.total_time += elapsed
+                self.stats.last_time = elapsed
+                self.stats.max_time = max(self.stats.max_time, elapsed)
+
+            self._retries = 0
+            self.stats.documents += len(batch)
+            logger.debug(f"Flushed {len(batch)} gathering results in {elapsed * 1000:.1f} ms")
+
+    def _requeue(self, batch: WriteBatch) -> None:
+        """keep the results of a failed write for the next flush, unless it failed too many times in a row"""
+        if self._retries >= self._retry_limit:
+            self._retries = 0
+            self.stats.dropped += len(batch)
+            logger.error(f"Dropped {len(batch)} gathering results after {self._retry_limit + 1} failed writes")
+            return
+
+        self._retries += 1
+        if not self._batch:
+            self._batch_started = monotonic()
+        self._batch = batch.requeue(self._batch)
+
+    async def close(self) -> None:
+        """flush the remaining results and stop the timer"""
+        if self._timer is not None:
+            # a flush of the timer is shielded and completes before the final one takes the lock
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
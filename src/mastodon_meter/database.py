@@ -1,17 +1,40 @@
 import os
 import typing as tp
 from dataclasses import asdict
+from datetime import datetime, timedelta
+from uuid import UUID, uuid5
 
 from loguru import logger
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorCursor, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+from pymongo.results import UpdateResult
 
 from .Account import Account
+from .AccountState import AccountState, get_state_update
+from .DatabaseWrapper import DatabaseWrapper
+from .Fetching import Validators
 from .Metering import Metering
-from .Singleton import SingletonMeta
+from .Metrics import DB_DOCUMENTS
+from .Rollups import ROLLUP_FIELDS, ROLLUP_TIERS, Rollup, RollupTier, get_rollup_update, make_rollups
+from .Series import MeteringSeries, collect_account_series
+from .SqliteWrapper import SqliteWrapper
 from .Types import Document
 
+# supported database backends
+DATABASE_BACKENDS: tp.Tuple[str, ...] = ("mongodb", "sqlite")
 
-class MongoDbWrapper(metaclass=SingletonMeta):
+# the error code of a write violating a unique index
+DUPLICATE_KEY_ERROR: int = 11000
+
+# layouts of the meterings storage: a document per metering or a MongoDB time-series collection
+METERING_STORAGES: tp.Tuple[str, ...] = ("documents", "timeseries")
+
+# namespace of the metering ids derived from the account and the timestamp in the time-series storage
+METERING_ID_NAMESPACE: UUID = UUID("8f0e6c1e-5a3b-4d1e-9c62-7b0f2d4a9e15")
+
+
+class MongoDbWrapper(DatabaseWrapper):
     """A database wrapper implementation for MongoDB"""
 
     def __init__(self) -> None:
@@ -26,75 +49,861 @@ class MongoDbWrapper(metaclass=SingletonMeta):
 
         mongo_client: AsyncIOMotorClient = AsyncIOMotorClient(mongo_client_url)
 
-        self._database: AsyncIOMotorDatabase = mongo_client["mastodon-meter"]
-        self._meterings_collection: AsyncIOMotorCollection = self._database["meterings"]
+        self._database: AsyncIOMotorDatabase = mongo_client[os.getenv("MONGO_DATABASE", default="mastodon-meter")]
+        self._metering_storage: str = os.getenv("METERING_STORAGE", default="documents")
+
+        if self._metering_storage not in METERING_STORAGES:
+            message = (
+                f"Unknown metering storage '{self._metering_storage}', expected one of: {', '.join(METERING_STORAGES)}"
+            )
+            logger.critical(message)
+            raise ValueError(message)
+
+        self._metering_collections: tp.Dict[str, AsyncIOMotorCollection] = {
+            "documents": self._database["meterings"],
+            "timeseries": self._database["meterings-ts"],
+        }
+        self._meterings_collection: AsyncIOMotorCollection = self._metering_collections[self._metering_storage]
         self._tracked_accounts_collection: AsyncIOMotorCollection = self._database["tracked-accounts"]
+        self._rollup_collections: tp.Dict[str, AsyncIOMotorCollection] = {
+            tier.name: self._database[tier.collection_name] for tier in ROLLUP_TIERS
+        }
+        self._account_states_collection: AsyncIOMotorCollection = self._database["account-states"]
+        self._meta_collection: AsyncIOMotorCollection = self._database["meta"]
+        self._leases_collection: AsyncIOMotorCollection = self._database["leases"]
+        self._workers_collection: AsyncIOMotorCollection = self._database["workers"]
+        self._validators_collection: AsyncIOMotorCollection = self._database["fetch-validators"]
+        self._batch_size: int = int(os.getenv("DB_BATCH_SIZE", default=1000))
 
         logger.info("Connected to MongoDB")
 
-    @staticmethod
-    async def _remove_ids(cursor: AsyncIOMotorCursor) -> tp.List[Document]:
-        """remove all MongoDB specific IDs from the resulting documents"""
-        result: tp.List[Document] = []
-        for doc in await cursor.to_list(length=100):
-            del doc["_id"]
-            result.append(doc)
-        return result
+    async def _create_timeseries_collection(self) -> None:
+        """
+        create the time-series collection for the meterings, if it doesn't exist yet. The server groups
+        the meterings of an account into compressed buckets, keeping the account id once per bucket
+        """
+        try:
+            await self._database.create_collection(
+                self._metering_collections["timeseries"].name,
+                timeseries={
+                    "timeField": "timestamp",
+                    "metaField": "parent_account_internal_id",
+                    "granularity": "hours",
+                },
+            )
+        except CollectionInvalid:
+            return
 
-    async def _find_matching_documents(
-        self, key: str, value: str, collection_: AsyncIOMotorCollection
-    ) -> tp.List[Document]:
+        logger.info("Created time-series collection for the meterings")
+
+    async def ensure_indexes(self) -> None:
+        """create the indexes required by the queries, if they don't exist yet"""
+        if self._metering_storage == "timeseries":
+            await self._create_timeseries_collection()
+
+        await self._meterings_collection.create_index(
+            [("parent_account_internal_id", ASCENDING), ("timestamp", ASCENDING)]
+        )
+        await self._ensure_metering_identity_index()
+        await self._tracked_accounts_collection.create_index("internal_id", unique=True)
+        await self._ensure_account_identity_index()
+        await self._account_states_collection.create_index("parent_account_internal_id", unique=True)
+
+        for collection in self._rollup_collections.values():
+            await collection.create_index(
+                [("parent_account_internal_id", ASCENDING), ("timestamp", ASCENDING)], unique=True
+            )
+        # heartbeats of the dead workers are cleaned up by the server
+        await self._workers_collection.create_index("expires_at", expireAfterSeconds=0)
+        logger.info("Ensured database indexes")
+
+    async def _ensure_metering_identity_index(self) -> None:
         """
-        finds all elements in the specified collection, which have
-        specified key matching specified value
+        a metering written again by a retried write must not be stored twice. Time-series collections
+        don't support unique indexes, the stored meterings are looked up there instead
         """
-        cursor: AsyncIOMotorCursor = collection_.find({key: value})
-        return await self._remove_ids(cursor)
+        if self._metering_storage == "timeseries":
+            return
+
+        try:
+            await self._meterings_collection.create_index("internal_id", unique=True)
+        except DuplicateKeyError:
+            logger.warning("Some meterings are stored more than once, remove the duplicates to prevent new ones")
+
+    async def _ensure_account_identity_index(self) -> None:
+        """an account is identified by its instance and its id there, so that it can't be tracked twice"""
+        try:
+            await self._tracked_accounts_collection.create_index(
+                [("instance", ASCENDING), ("id", ASCENDING)], unique=True
+            )
+        except DuplicateKeyError:
+            logger.warning("Some accounts are tracked more than once, remove the duplicates to prevent new ones")
+
+    async def _iter_documents(
+        self,
+        collection_: AsyncIOMotorCollection,
+        query: tp.Optional[Document] = None,
+        sort: tp.Optional[tp.List[tp.Tuple[str, int]]] = None,
+        limit: int = 0,
+        batch_size: tp.Optional[int] = None,
+    ) -> tp.AsyncIterator[Document]:
+        """
+        stream the documents matching the query from the specified collection in batches,
+        MongoDB specific IDs are projected away by the server
+        """
+        cursor: AsyncIOMotorCursor = collection_.find(
+            query or {},
+            projection={"_id": False},
+            sort=sort,
+            limit=limit,
+            batch_size=batch_size or self._batch_size,
+        )
+        read: int = 0
 
-    async def _get_all_items_in_collection(self, collection_: AsyncIOMotorCollection) -> tp.List[Document]:
-        """get all documents in the provided collection"""
-        cursor: AsyncIOMotorCursor = collection_.find()
-        return await self._remove_ids(cursor)
+        try:
+            async for document in cursor:
+                read += 1
+                yield document
+        finally:
+            DB_DOCUMENTS.inc(read, backend=type(self).__name__, direction="read")
+
+    async def _load_series(
+        self,
+        collection_: AsyncIOMotorCollection,
+        query: Document,
+        toot_count_field: str = "toot_count",
+        subscribers_count_field: str = "subscribers_count",
+    ) -> MeteringSeries:
+        """load the matching documents into a columnar series, converting them batch by batch"""
+        projection: Document = {"_id": False, "timestamp": True, toot_count_field: True, subscribers_count_field: True}
+        cursor: AsyncIOMotorCursor = collection_.find(
+            query, projection=projection, sort=[("timestamp", ASCENDING)], batch_size=self._batch_size
+        )
+        chunks: tp.List[MeteringSeries] = []
+
+        while True:
+            documents: tp.List[Document] = await cursor.to_list(length=self._batch_size)
+            if not documents:
+                break
+            chunks.append(MeteringSeries.from_documents(documents, toot_count_field, subscribers_count_field))
+            DB_DOCUMENTS.inc(len(documents), backend=type(self).__name__, direction="read")
+
+        return MeteringSeries.concatenate(chunks)
 
     async def add_tracked_account(self, account: Account) -> None:
         """add the provided account into the list of tracked accounts"""
         collection: AsyncIOMotorCollection = self._tracked_accounts_collection
         await collection.insert_one(asdict(account))
+        await self._bump_version("accounts-version")
+
+    async def add_tracked_accounts(self, accounts: tp.List[Account]) -> tp.List[Account]:
+        """
+        add the provided accounts into the list of tracked accounts in one bulk write, skipping
+        the ones tracked already (with the same instance and id). Returns the accounts added
+        """
+        if not accounts:
+            return []
+
+        skipped: tp.Set[int] = set()
+        try:
+            # an unordered write goes on past the duplicates, reporting them all at the end
+            await self._tracked_accounts_collection.insert_many([asdict(a) for a in accounts], ordered=False)
+        except BulkWriteError as e:
+            errors: tp.List[Document] = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            skipped = {error["index"] for error in errors}
+
+        added: tp.List[Account] = [account for i, account in enumerate(accounts) if i not in skipped]
+        if added:
+            DB_DOCUMENTS.inc(len(added), backend=type(self).__name__, direction="written")
+            await self._bump_version("accounts-version")
+        return added
 
     async def delete_tracked_account(self, account_internal_id: str) -> None:
         """delete the provided account from the list of tracked accounts"""
         collection: AsyncIOMotorCollection = self._tracked_accounts_collection
         await collection.delete_one({"internal_id": account_internal_id})
+        await self._validators_collection.delete_one({"_id": account_internal_id})
+        await self._bump_version("accounts-version")
 
-    async def get_tracked_accounts(self) -> tp.List[Account]:
-        """get the list of all tracked accounts"""
+    async def set_metering_interval(self, account_internal_id: str, metering_interval: tp.Optional[int]) -> None:
+        """set the metering interval of the account, None means the default one"""
         collection: AsyncIOMotorCollection = self._tracked_accounts_collection
-        tracked_accounts = await self._get_all_items_in_collection(collection)
-        return [Account(**data) for data in tracked_accounts]
+        result: UpdateResult = await collection.update_one(
+            {"internal_id": account_internal_id}, {"$set": {"metering_interval": metering_interval}}
+        )
+
+        if not result.matched_count:
+            raise KeyError(f"Account {account_internal_id} is not tracked")
+
+        await self._bump_version("accounts-version")
+
+    async def _bump_version(self, key: str) -> None:
+        await self._meta_collection.update_one({"_id": key}, {"$inc": {"value": 1}}, upsert=True)
+
+    async def _get_version(self, key: str) -> int:
+        data: tp.Optional[Document] = await self._meta_collection.find_one({"_id": key})
+        return int(data["value"]) if data else 0
+
+    async def get_accounts_version(self) -> int:
+        """get the counter incremented on every change of the tracked accounts"""
+        return await self._get_version("accounts-version")
+
+    async def iter_tracked_accounts(self) -> tp.AsyncIterator[Account]:
+        """stream all the tracked accounts"""
+        async for data in self._iter_documents(self._tracked_accounts_collection):
+            yield Account(**data)
 
     async def get_account_by_internal_id(self, account_internal_id: str) -> Account:
         """get the account by it's internal id"""
         collection: AsyncIOMotorCollection = self._tracked_accounts_collection
-        account_data: Document = await collection.find_one({"internal_id": account_internal_id})
-        del account_data["_id"]
+        account_data: tp.Optional[Document] = await collection.find_one(
+            {"internal_id": account_internal_id}, projection={"_id": False}
+        )
+
+        if account_data is None:
+            raise KeyError(f"Account {account_internal_id} is not tracked")
+
         return Account(**account_data)
 
     async def add_meterings(self, meterings: tp.List[Metering]) -> None:
-        """add the provided metering into the database"""
+        """add the provided meterings into the database in any order, skipping the ones stored already"""
         collection: AsyncIOMotorCollection = self._meterings_collection
-        metering_documents: tp.List[Document] = [asdict(m) for m in meterings]
-        await collection.insert_many(metering_documents)
+        # meterings only hold scalars, so a shallow copy is enough (insert_many adds _id to the documents)
+        metering_documents: tp.List[Document] = [dict(vars(m)) for m in await self._skip_stored(meterings)]
+
+        if not metering_documents:
+            return
+
+        if self._metering_storage == "timeseries":
+            for document in metering_documents:
+                del document["internal_id"]
+            await collection.insert_many(metering_documents, ordered=False)
+        else:
+            requests: tp.List[UpdateOne] = [
+                UpdateOne({"internal_id": document["internal_id"]}, {"$setOnInsert": document}, upsert=True)
+                for document in metering_documents
+            ]
+            await collection.bulk_write(requests, ordered=False)
+
+        DB_DOCUMENTS.inc(len(metering_documents), backend=type(self).__name__, direction="written")
+
+    async def _skip_stored(self, meterings: tp.List[Metering]) -> tp.List[Metering]:
+        """
+        leave out the meterings of a time-series collection, that have been stored by a failed write already.
+        They are told by the account and the timestamp, which the server keeps with millisecond precision
+        """
+        if self._metering_storage != "timeseries" or not meterings:
+            return meterings
+
+        def _key(account_internal_id: str, timestamp: datetime) -> tp.Tuple[str, datetime]:
+            return account_internal_id, timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+        query: Document = self._metering_query(
+            list({m.parent_account_internal_id for m in meterings}),
+            since=min(m.timestamp for m in meterings),
+            to=max(m.timestamp for m in meterings),
+        )
+        stored: tp.Set[tp.Tuple[str, datetime]] = {
+            _key(data["parent_account_internal_id"], data["timestamp"])
+            async for data in self._iter_documents(self._meterings_collection, query)
+        }
+        return [m for m in meterings if _key(m.parent_account_internal_id, m.timestamp) not in stored]
 
     async def delete_meterings_for_account(self, account_internal_id: str) -> None:
         """delete all the meterings for the provided account from the database"""
         collection: AsyncIOMotorCollection = self._meterings_collection
         await collection.delete_many({"parent_account_internal_id": account_internal_id})
 
-    async def get_all_meterings(self, account_internal_id: str) -> tp.List[Metering]:
-        """get all meterings for an account from the database"""
-        metering_data: tp.List[Document] = await self._find_matching_documents(
-            "parent_account_internal_id",
-            account_internal_id,
+        for rollup_collection in self._rollup_collections.values():
+            await rollup_collection.delete_many({"parent_account_internal_id": account_internal_id})
+
+        await self._account_states_collection.delete_one({"parent_account_internal_id": account_internal_id})
+        await self._bump_version("account-states-version")
+
+    @staticmethod
+    def _to_metering(data: Document) -> Metering:
+        """
+        make a metering from a stored document. Time-series documents don't store metering ids,
+        so the ids are derived from the account and the timestamp, staying the same between reads
+        """
+        if "internal_id" not in data:
+            key: str = f"{data['parent_account_internal_id']}/{data['timestamp'].isoformat()}"
+            data["internal_id"] = uuid5(METERING_ID_NAMESPACE, key).hex
+
+        return Metering(**data)
+
+    @staticmethod
+    def _metering_query(
+        account_internal_id: tp.Union[str, tp.List[str], None],
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+    ) -> Document:
+        """
+        make a query selecting meterings for an account (or for a list of accounts, or for all of them)
+        within the time boundaries, that can be served by the (parent_account_internal_id, timestamp) index
+        """
+        query: Document = {}
+        time_range: Document = {}
+
+        if isinstance(account_internal_id, list):
+            query["parent_account_internal_id"] = {"$in": account_internal_id}
+        elif account_internal_id is not None:
+            query["parent_account_internal_id"] = account_internal_id
+
+        if since is not None:
+            time_range["$gte"] = since
+        if after is not None:
+            time_range["$gt"] = after
+        if to is not None:
+            time_range["$lte"] = to
+        if time_range:
+            query["timestamp"] = time_range
+
+        return query
+
+    async def iter_meterings(
+        self,
+        account_internal_id: str,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+        limit: int = 0,
+        batch_size: tp.Optional[int] = None,
+    ) -> tp.AsyncIterator[Metering]:
+        """
+        stream meterings for an account within the time boundaries in chronological
+        order, starting right after the provided timestamp (keyset pagination)
+        """
+        query: Document = self._metering_query(account_internal_id, since, to, after)
+
+        documents = self._iter_documents(
+            self._meterings_collection,
+            query,
+            sort=[("timestamp", ASCENDING)],
+            limit=limit,
+            batch_size=batch_size,
+        )
+        async for data in documents:
+            yield self._to_metering(data)
+
+    async def iter_meterings_for_accounts(
+        self,
+        account_internal_ids: tp.Optional[tp.List[str]] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.AsyncIterator[Metering]:
+        """
+        stream meterings for the accounts (all the stored ones by default) within the time boundaries,
+        ordered by account and then chronologically. Only a batch of meterings is held in memory at a time
+        """
+        documents = self._iter_documents(
             self._meterings_collection,
+            self._metering_query(account_internal_ids, since, to),
+            sort=[("parent_account_internal_id", ASCENDING), ("timestamp", ASCENDING)],
+        )
+        async for data in documents:
+            yield self._to_metering(data)
+
+    async def get_latest_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.Optional[Metering]:
+        """get the most recent metering for an account within the time boundaries"""
+        collection: AsyncIOMotorCollection = self._meterings_collection
+        data: tp.Optional[Document] = await collection.find_one(
+            self._metering_query(account_internal_id, since, to),
+            projection={"_id": False},
+            sort=[("timestamp", DESCENDING)],
+        )
+        return self._to_metering(data) if data else None
+
+    async def get_earliest_metering(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> tp.Optional[Metering]:
+        """get the oldest metering for an account within the time boundaries"""
+        collection: AsyncIOMotorCollection = self._meterings_collection
+        data: tp.Optional[Document] = await collection.find_one(
+            self._metering_query(account_internal_id, since, to),
+            projection={"_id": False},
+            sort=[("timestamp", ASCENDING)],
         )
-        return [Metering(**data) for data in metering_data]
+        return self._to_metering(data) if data else None
+
+    async def count_meterings(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> int:
+        """count meterings for an account within the time boundaries"""
+        collection: AsyncIOMotorCollection = self._meterings_collection
+        count: int = await collection.count_documents(self._metering_query(account_internal_id, since, to))
+        return count
+
+    async def get_latest_meterings(
+        self, account_internal_ids: tp.Optional[tp.List[str]] = None, count: int = 2
+    ) -> tp.List[tp.Tuple[Account, MeteringSeries]]:
+        """
+        get tracked accounts with series of their latest meterings in one round trip.
+        Each account's meterings are looked up through the (parent_account_internal_id, timestamp) index
+        """
+        pipeline: tp.List[Document] = []
+
+        if account_internal_ids is not None:
+            pipeline.append({"$match": {"internal_id": {"$in": account_internal_ids}}})
+
+        pipeline += [
+            {
+                "$lookup": {
+                    "from": self._meterings_collection.name,
+                    "let": {"account_internal_id": "$internal_id"},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$parent_account_internal_id", "$$account_internal_id"]}}},
+                        {"$sort": {"timestamp": DESCENDING}},
+                        {"$limit": count},
+                        {"$project": {"_id": False, "timestamp": True, "toot_count": True, "subscribers_count": True}},
+                    ],
+                    "as": "latest_meterings",
+                }
+            },
+            {"$project": {"_id": False}},
+        ]
+
+        result: tp.List[tp.Tuple[Account, MeteringSeries]] = []
+        async for data in self._tracked_accounts_collection.aggregate(pipeline, batchSize=self._batch_size):
+            latest: tp.List[Document] = data.pop("latest_meterings")
+            series: MeteringSeries = MeteringSeries.from_documents(latest[::-1]) if latest else MeteringSeries.empty()
+            result.append((Account(**data), series))
+
+        return result
+
+    async def update_account_states(self, meterings: tp.List[Metering]) -> None:
+        """
+        make the provided meterings the current states of their accounts, keeping the previous ones.
+        Meterings not newer than the current state of their account are skipped
+        """
+        if not meterings:
+            return
+
+        requests: tp.List[UpdateOne] = [
+            UpdateOne({"parent_account_internal_id": m.parent_account_internal_id}, get_state_update(m), upsert=True)
+            for m in sorted(meterings, key=lambda m: m.timestamp)
+        ]
+        await self._account_states_collection.bulk_write(requests, ordered=True)
+        DB_DOCUMENTS.inc(len(requests), backend=type(self).__name__, direction="written")
+        await self._bump_version("account-states-version")
+
+    async def get_account_states_version(self) -> int:
+        """get the counter incremented on every change of the account states"""
+        return await self._get_version("account-states-version")
+
+    async def _start_backfill(self, name: str) -> bool:
+        """
+        mark the backfill started, unless it is finished already. An interrupted backfill keeps
+        only the started mark, so it is run again from the start
+        """
+        marker: Document = await self._meta_collection.find_one_and_update(
+            {"_id": name},
+            {"$setOnInsert": {"started_on": datetime.utcnow()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return marker.get("finished_on") is None
+
+    async def _finish_backfill(self, name: str) -> None:
+        await self._meta_collection.update_one({"_id": name}, {"$set": {"finished_on": datetime.utcnow()}})
+
+    async def backfill_account_states(self) -> None:
+        """build the states of the accounts metered before the states were introduced, only done once"""
+        # the states are only inserted if missing, so running the backfill again changes nothing
+        if not await self._start_backfill("account-states-backfill"):
+            return
+
+        logger.info("Backfilling account states")
+        requests: tp.List[UpdateOne] = []
+
+        for account, series in await self.get_latest_meterings():
+            if not len(series):
+                continue
+
+            state: Document = {
+                "parent_account_internal_id": account.internal_id,
+                "timestamp": series.datetimes[-1].item(),
+            }
+
+            for field in ROLLUP_FIELDS:
+                values: tp.List[int] = series.column(field).tolist()
+                state[field] = values[-1]
+
+                if len(values) > 1:
+                    state[f"previous_{field}"] = values[-2]
+                    state[f"{field}_delta"] = values[-1] - values[-2]
+
+            if len(series) > 1:
+                state["previous_timestamp"] = series.datetimes[-2].item()
+
+            requests.append(
+                UpdateOne({"parent_account_internal_id": account.internal_id}, {"$setOnInsert": state}, upsert=True)
+            )
+
+        if requests:
+            await self._account_states_collection.bulk_write(requests, ordered=False)
+            await self._bump_version("account-states-version")
+        await self._finish_backfill("account-states-backfill")
+        logger.info(f"Backfilled states for {len(requests)} accounts")
+
+    async def mark_accounts_checked(self, account_internal_ids: tp.List[str], timestamp: datetime) -> None:
+        """record that the accounts were found unchanged at the provided time, instead of storing new meterings"""
+        await self._account_states_collection.update_many(
+            {"parent_account_internal_id": {"$in": account_internal_ids}}, {"$set": {"last_checked": timestamp}}
+        )
+
+    async def get_validators(self, account_internal_ids: tp.List[str]) -> tp.Dict[str, Validators]:
+        """get the cache validators of the latest responses for the accounts"""
+        cursor: AsyncIOMotorCursor = self._validators_collection.find(
+            {"_id": {"$in": account_internal_ids}}, batch_size=self._batch_size
+        )
+        return {data.pop("_id"): Validators(**data) async for data in cursor}
+
+    async def save_validators(self, validators: tp.Dict[str, Validators]) -> None:
+        """store the cache validators of the latest responses for the accounts"""
+        requests: tp.List[UpdateOne] = [
+            UpdateOne({"_id": account_internal_id}, {"$set": asdict(v)}, upsert=True)
+            for account_internal_id, v in validators.items()
+        ]
+        await self._validators_collection.bulk_write(requests, ordered=False)
+
+    async def get_account_states(
+        self, account_internal_ids: tp.Optional[tp.List[str]] = None
+    ) -> tp.List[tp.Tuple[Account, tp.Optional[AccountState]]]:
+        """get tracked accounts with their current states in one round trip"""
+        pipeline: tp.List[Document] = []
+
+        if account_internal_ids is not None:
+            pipeline.append({"$match": {"internal_id": {"$in": account_internal_ids}}})
+
+        pipeline += [
+            {
+                "$lookup": {
+                    "from": self._account_states_collection.name,
+                    "localField": "internal_id",
+                    "foreignField": "parent_account_internal_id",
+                    "as": "state",
+                }
+            },
+            {"$project": {"_id": False, "state._id": False}},
+        ]
+
+        result: tp.List[tp.Tuple[Account, tp.Optional[AccountState]]] = []
+        async for data in self._tracked_accounts_collection.aggregate(pipeline, batchSize=self._batch_size):
+            states: tp.List[Document] = data.pop("state")
+            result.append((Account(**data), AccountState(**states[0]) if states else None))
+
+        return result
+
+    async def get_metering_series(
+        self, account_internal_id: str, since: tp.Optional[datetime] = None, to: tp.Optional[datetime] = None
+    ) -> MeteringSeries:
+        """get the meterings for an account within the time boundaries as a columnar series"""
+        query: Document = self._metering_query(account_internal_id, since, to)
+        return await self._load_series(self._meterings_collection, query)
+
+    async def get_series_for_accounts(
+        self,
+        account_internal_ids: tp.List[str],
+        tier: tp.Optional[RollupTier] = None,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> tp.Dict[str, MeteringSeries]:
+        """
+        get the series of many accounts within the time boundaries in one query: the raw meterings,
+        or the last counts of the buckets of the tier. Accounts without data get empty series
+        """
+        collection: AsyncIOMotorCollection = self._meterings_collection
+        fields: tp.Tuple[str, str] = ("toot_count", "subscribers_count")
+        if tier is not None:
+            since = tier.bucket_start(since) if since else None
+            collection = self._rollup_collections[tier.name]
+            fields = ("toot_count_last", "subscribers_count_last")
+
+        projection: Document = {"_id": False, "parent_account_internal_id": True, "timestamp": True}
+        projection.update(dict.fromkeys(fields, True))
+        cursor: AsyncIOMotorCursor = collection.find(
+            self._metering_query(account_internal_ids, since, to),
+            projection=projection,
+            sort=[("parent_account_internal_id", ASCENDING), ("timestamp", ASCENDING)],
+            batch_size=self._batch_size,
+        )
+        chunks: tp.Dict[str, tp.List[MeteringSeries]] = {}
+
+        while True:
+            documents: tp.List[Document] = await cursor.to_list(length=self._batch_size)
+            if not documents:
+                break
+            collect_account_series(chunks, documents, *fields)
+            DB_DOCUMENTS.inc(len(documents), backend=type(self).__name__, direction="read")
+
+        return {
+            account_internal_id: MeteringSeries.concatenate(chunks.get(account_internal_id, []))
+            for account_internal_id in account_internal_ids
+        }
+
+    async def update_rollups(self, meterings: tp.List[Metering], tiers: tp.Sequence[RollupTier] = ROLLUP_TIERS) -> None:
+        """merge the provided meterings into the buckets of the rollup tiers (every one by default)"""
+        if not meterings:
+            return
+
+        for tier in tiers:
+            requests: tp.List[UpdateOne] = [
+                UpdateOne(
+                    {
+                        "parent_account_internal_id": m.parent_account_internal_id,
+                        "timestamp": tier.bucket_start(m.timestamp),
+                    },
+                    get_rollup_update(m),
+                    upsert=True,
+                )
+                for m in meterings
+            ]
+            await self._rollup_collections[tier.name].bulk_write(requests, ordered=False)
+            DB_DOCUMENTS.inc(len(requests), backend=type(self).__name__, direction="written")
+
+    async def backfill_rollups(self) -> None:
+        """build the rollups for the meterings gathered before rollups were introduced, only done once"""
+        # the buckets are rebuilt from all the meterings of the account and replaced, so running it again changes nothing
+        if not await self._start_backfill("rollups-backfill"):
+            return
+
+        logger.info("Backfilling metering rollups")
+        documents: tp.AsyncIterator[Document] = self._iter_documents(
+            self._meterings_collection, sort=[("parent_account_internal_id", ASCENDING), ("timestamp", ASCENDING)]
+        )
+        account_meterings: tp.List[Metering] = []
+        account_count: int = 0
+
+        async for data in documents:
+            metering: Metering = self._to_metering(data)
+            if (
+                account_meterings
+                and metering.parent_account_internal_id != account_meterings[0].parent_account_internal_id
+            ):
+                await self._replace_rollups(account_meterings)
+                account_meterings = []
+                account_count += 1
+            account_meterings.append(metering)
+
+        if account_meterings:
+            await self._replace_rollups(account_meterings)
+            account_count += 1
+
+        await self._finish_backfill("rollups-backfill")
+        logger.info(f"Backfilled metering rollups for {account_count} accounts")
+
+    async def _replace_rollups(self, meterings: tp.List[Metering]) -> None:
+        """replace the buckets of every rollup tier with the ones built from all the meterings of one account"""
+        for tier in ROLLUP_TIERS:
+            requests: tp.List[UpdateOne] = [
+                UpdateOne(
+                    {"parent_account_internal_id": rollup.parent_account_internal_id, "timestamp": rollup.timestamp},
+                    {"$set": asdict(rollup)},
+                    upsert=True,
+                )
+                for rollup in make_rollups(meterings, tier)
+            ]
+            await self._rollup_collections[tier.name].bulk_write(requests, ordered=False)
+            DB_DOCUMENTS.inc(len(requests), backend=type(self).__name__, direction="written")
+
+    async def get_rollups(
+        self,
+        account_internal_id: str,
+        tier: RollupTier,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+        after: tp.Optional[datetime] = None,
+        limit: int = 0,
+    ) -> tp.List[Rollup]:
+        """get the buckets of the tier covering the time boundaries in chronological order"""
+        since = tier.bucket_start(since) if since else None
+        documents = self._iter_documents(
+            self._rollup_collections[tier.name],
+            self._metering_query(account_internal_id, since, to, after),
+            sort=[("timestamp", ASCENDING)],
+            limit=limit,
+            batch_size=limit or None,
+        )
+        return [Rollup(**data) async for data in documents]
+
+    async def get_rollup_series(
+        self,
+        account_internal_id: str,
+        tier: RollupTier,
+        since: tp.Optional[datetime] = None,
+        to: tp.Optional[datetime] = None,
+    ) -> MeteringSeries:
+        """get the last counts of the buckets of the tier covering the time boundaries as a columnar series"""
+        since = tier.bucket_start(since) if since else None
+        query: Document = self._metering_query(account_internal_id, since, to)
+        collection: AsyncIOMotorCollection = self._rollup_collections[tier.name]
+        return await self._load_series(collection, query, "toot_count_last", "subscribers_count_last")
+
+    async def get_rollup_changes(
+        self, account_internal_ids: tp.List[str], tier: RollupTier, since: datetime
+    ) -> tp.List[Document]:
+        """
+        get the first and the last counts of each account within the buckets of the tier
+        starting from the provided timestamp, computed by the server in one aggregation
+        """
+        group: Document = {"_id": "$parent_account_internal_id"}
+        for field in ROLLUP_FIELDS:
+            group[f"{field}_first"] = {"$first": f"${field}_first"}
+            group[f"{field}_last"] = {"$last": f"${field}_last"}
+
+        pipeline: tp.List[Document] = [
+            {
+                "$match": {
+                    "parent_account_internal_id": {"$in": account_internal_ids},
+                    "timestamp": {"$gte": tier.bucket_start(since)},
+                }
+            },
+            {"$sort": {"parent_account_internal_id": ASCENDING, "timestamp": ASCENDING}},
+            {"$group": group},
+        ]
+        collection: AsyncIOMotorCollection = self._rollup_collections[tier.name]
+        return [data async for data in collection.aggregate(pipeline, batchSize=self._batch_size)]
+
+    async def migrate_meterings(self, batch_size: tp.Optional[int] = None) -> int:
+        """
+        copy the meterings from the documents storage into the time-series one in batches of the provided size.
+        The progress is saved after every batch, so an interrupted migration resumes after the last copied batch
+        """
+        await self._create_timeseries_collection()
+        source: AsyncIOMotorCollection = self._metering_collections["documents"]
+        target: AsyncIOMotorCollection = self._metering_collections["timeseries"]
+        batch_size = batch_size or self._batch_size
+
+        progress: Document = await self._meta_collection.find_one({"_id": "meterings-migration"}) or {}
+        last_id: tp.Any = progress.get("last_id")
+        copied: int = progress.get("copied", 0)
+
+        if last_id is not None:
+            logger.info(f"Resuming the meterings migration after {copied} copied meterings")
+
+        while True:
+            cursor: AsyncIOMotorCursor = source.find(
+                {"_id": {"$gt": last_id}} if last_id is not None else {},
+                projection={"internal_id": False},
+                sort=[("_id", ASCENDING)],
+                limit=batch_size,
+                batch_size=batch_size,
+            )
+            documents: tp.List[Document] = await cursor.to_list(length=batch_size)
+            if not documents:
+                break
+
+            last_id = documents[-1]["_id"]
+            for document in documents:
+                del document["_id"]
+
+            await target.insert_many(documents, ordered=False)
+            copied += len(documents)
+            await self._meta_collection.update_one(
+                {"_id": "meterings-migration"},
+                {"$set": {"last_id": last_id, "copied": copied, "updated_on": datetime.utcnow()}},
+                upsert=True,
+            )
+            logger.info(f"Copied {copied} meterings into the time-series storage")
+
+        return copied
+
+    async def get_meterings_storage_stats(self) -> tp.Dict[str, Document]:
+        """get the number of meterings and the sizes of the data and the indexes in bytes for each storage"""
+        existing: tp.List[str] = await self._database.list_collection_names()
+        result: tp.Dict[str, Document] = {}
+
+        for storage, collection in self._metering_collections.items():
+            if collection.name not in existing:
+                continue
+
+            stats: Document = await self._database.command("collStats", collection.name)
+            result[storage] = {
+                "count": await collection.count_documents({}),
+                "size": stats.get("size", 0),
+                "storage_size": stats.get("storageSize", 0),
+                "index_size": stats.get("totalIndexSize", 0),
+            }
+
+        return result
+
+    async def save_stats_snapshot(self, snapshot: Document) -> None:
+        """replace the stats snapshot with the one made by the latest gathering run"""
+        await self._meta_collection.replace_one({"_id": "stats-snapshot"}, snapshot, upsert=True)
+
+    async def get_stats_snapshot(self) -> tp.Optional[Document]:
+        """get the stats snapshot made by the latest gathering run"""
+        snapshot: tp.Optional[Document] = await self._meta_collection.find_one({"_id": "stats-snapshot"})
+        return snapshot
+
+    async def get_previous_rollup(
+        self, account_internal_id: str, tier: RollupTier, before: datetime
+    ) -> tp.Optional[Rollup]:
+        """get the bucket of the tier preceding the provided timestamp"""
+        data: tp.Optional[Document] = await self._rollup_collections[tier.name].find_one(
+            {"parent_account_internal_id": account_internal_id, "timestamp": {"$lt": before}},
+            projection={"_id": False},
+            sort=[("timestamp", DESCENDING)],
+        )
+        return Rollup(**data) if data else None
+
+    async def acquire_lease(self, name: str, holder: str, ttl: int) -> bool:
+        """
+        take or renew the named lease for the provided number of seconds.
+        Fails if the lease is held by someone else and has not expired yet
+        """
+        now: datetime = datetime.utcnow()
+        try:
+            await self._leases_collection.update_one(
+                {"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": holder, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        """give the named lease up, if it is held by the provided holder"""
+        await self._leases_collection.delete_one({"_id": name, "holder": holder})
+
+    async def register_worker(self, worker_id: str, ttl: int) -> None:
+        """report the worker alive for the provided number of seconds"""
+        now: datetime = datetime.utcnow()
+        await self._workers_collection.update_one(
+            {"_id": worker_id},
+            {"$set": {"heartbeat": now, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+
+    async def unregister_worker(self, worker_id: str) -> None:
+        """remove the worker from the list of alive ones"""
+        await self._workers_collection.delete_one({"_id": worker_id})
+
+    async def get_alive_workers(self) -> tp.List[str]:
+        """get the identifiers of the workers, whose heartbeats have not expired yet"""
+        cursor: AsyncIOMotorCursor = self._workers_collection.find(
+            {"expires_at": {"$gt": datetime.utcnow()}}, projection={"_id": True}
+        )
+        return sorted([data["_id"] async for data in cursor])
+
+
+def get_database() -> DatabaseWrapper:
+    """get the wrapper of the database backend chosen with the $DATABASE_BACKEND environment variable"""
+    backend: str = os.getenv("DATABASE_BACKEND", default="mongodb")
+
+    if backend == "mongodb":
+        return MongoDbWrapper()
+    if backend == "sqlite":
+        return SqliteWrapper()
+
+    message = f"Unknown database backend '{backend}', expected one of: {', '.join(DATABASE_BACKENDS)}"
+    logger.critical(message)
+    raise ValueError(message)
@@ -16,6 +16,7 @@ class AddAccountRequest(BaseModel):
     username: str
     instance: str
     instance_id: str
+    metering_interval: tp.Optional[int]
 
 
 class AddAccountResponse(ResponseBase):
@@ -24,6 +25,23 @@ class AddAccountResponse(ResponseBase):
     account_internal_id: str
 
 
+class ImportAccountsRequest(BaseModel):
+    """a request to add many accounts to the list of tracked by their user@instance handles"""
+
+    handles: tp.List[str]
+    metering_interval: tp.Optional[int]
+
+
+class ImportAccountsResponse(ResponseBase):
+    """a response telling what happened to every handle of an import"""
+
+    imported: tp.Dict[str, str]
+    skipped: tp.List[str]
+    not_found: tp.List[str]
+    invalid: tp.List[str]
+    failed: tp.Dict[str, str]
+
+
 class DeleteAccountRequest(BaseModel):
     """a request to delete an account from the list of tracked"""
 
@@ -31,23 +49,107 @@ class DeleteAccountRequest(BaseModel):
     remove_associated_data: bool
 
 
+class SetMeteringIntervalRequest(BaseModel):
+    """a request to change the metering interval of a tracked account"""
+
+    account_internal_id: str
+    metering_interval: tp.Optional[int]
+
+
 class TrackedAccountList(ResponseBase):
     """a request to retrieve the list of tracked accounts"""
 
-    tracked_accounts: tp.List[tp.Dict[str, str]]
+    tracked_accounts: tp.List[tp.Dict[str, tp.Any]]
 
 
 class AccountRawData(AddAccountResponse):
     """a request to retrieve the list of meterings for an account"""
 
     data: tp.List[tp.Dict[str, tp.Union[int, str]]]
+    next_cursor: tp.Optional[str]
 
 
-class GraphRequest(BaseModel):
+class TimeRangeRequest(BaseModel):
+    """a request limited to the data within the time boundaries"""
+
+    since: tp.Optional[str] = None
+    to: tp.Optional[str] = None
+
+
+class GraphRequest(TimeRangeRequest):
     """a request to retrieve a graph for an account"""
 
-    since: tp.Optional[str]
-    to: tp.Optional[str]
+    format: tp.Optional[tp.Literal["png", "svg", "webp"]]
+    dpi: tp.Optional[int]
+    width: tp.Optional[float]
+    height: tp.Optional[float]
+    max_points: tp.Optional[int]
+    downsampling: tp.Optional[tp.Literal["rollup", "lttb"]]
+
+
+class ComparisonRequest(GraphRequest):
+    """a request to plot a counter of many accounts on one graph or on a grid of small ones"""
+
+    accounts: tp.List[str]
+    metric: tp.Optional[tp.Literal["subscribers", "toots"]]
+    layout: tp.Optional[tp.Literal["overlay", "grid"]]
+    normalize: tp.Optional[bool]
+    columns: tp.Optional[int]
+
+
+class RawDataRequest(TimeRangeRequest):
+    """a request to retrieve a page of meterings for an account"""
+
+    cursor: tp.Optional[str] = None
+    limit: tp.Optional[int] = None
+    resolution: tp.Optional[tp.Literal["raw", "hourly", "daily", "weekly"]] = None
+
+
+class ExportRequest(TimeRangeRequest):
+    """a request to export the meterings of many accounts, all the tracked ones by default"""
+
+    accounts: tp.Optional[tp.List[str]] = None
+    format: tp.Optional[tp.Literal["ndjson", "csv", "parquet"]] = None
+    compression: tp.Optional[tp.Literal["zstd", "gzip", "identity"]] = None
+
+
+class StatsRequest(TimeRangeRequest):
+    """a request to retrieve growth stats for an account"""
+
+    window: tp.Optional[int] = None
+    horizon: tp.Optional[int] = None
+
+
+class AccountStats(AddAccountResponse):
+    """a response holding growth stats for an account"""
+
+    stats: tp.Dict[str, tp.Any]
+
+
+class CacheStatsResponse(ResponseBase):
+    """a response holding hit and miss counters of a cache"""
+
+    worker_id: str
+    account_cache: tp.Dict[str, tp.Any]
+
+
+class InstanceStatsResponse(ResponseBase):
+    """a response holding request stats for the Mastodon instances"""
+
+    worker_id: str
+    instances: tp.Dict[str, tp.Dict[str, tp.Any]]
+
+
+class ProfilerStartRequest(BaseModel):
+    """a request to start the sampling profiler"""
+
+    interval_ms: tp.Optional[float]
+
+
+class ProfileResponse(ResponseBase):
+    """a response holding the samples collected by the profiler"""
+
+    profile: tp.Dict[str, tp.Any]
 
 
 class GetReportRequest(BaseModel):
@@ -0,0 +1,72 @@
+import os
+import typing as tp
+from uuid import uuid4
+
+import pytest
+
+import mastodon_meter.database as database_module
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Singleton import SingletonMeta
+from mastodon_meter.SqliteWrapper import SqliteWrapper
+from mastodon_meter.database import DATABASE_BACKENDS, MongoDbWrapper
+
+
+def _patch_mongomock(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    run the MongoDB backend against the in-memory mongomock server. Bulk operations of recent pymongo versions
+    pass a sort argument the mock doesn't know, it is only used by the server when updating one of many matches
+    """
+    mongomock_motor: tp.Any = pytest.importorskip("mongomock_motor")
+    from mongomock.collection import BulkOperationBuilder
+
+    for name in ("add_update", "add_replace"):
+        operation: tp.Callable[..., None] = getattr(BulkOperationBuilder, name)
+
+        def _without_sort(self: tp.Any, *args: tp.Any, _operation: tp.Any = operation, **kwargs: tp.Any) -> None:
+            kwargs.pop("sort", None)
+            _operation(self, *args, **kwargs)
+
+        monkeypatch.setattr(BulkOperationBuilder, name, _without_sort)
+
+    monkeypatch.setattr(database_module, "AsyncIOMotorClient", mongomock_motor.AsyncMongoMockClient)
+    monkeypatch.setenv("MONGO_CONNECTION_URL", "mongodb://mongomock")
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture(params=DATABASE_BACKENDS)
+async def database(
+    request: pytest.FixtureRequest,
+    tmp_path: tp.Any,
+    monkeypatch: pytest.MonkeyPatch,
+) -> tp.AsyncIterator[DatabaseWrapper]:
+    """
+    an empty database of every backend, the same one get_database() returns while the test runs. MongoDB tests
+    run against the server set by $MONGO_TEST_CONNECTION_URL, or against an in-memory mock if it is not set
+    """
+    monkeypatch.setenv("DATABASE_BACKEND", request.param)
+    wrapper: DatabaseWrapper
+
+    if request.param == "sqlite":
+        monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "mastodon-meter.sqlite3"))
+        wrapper = SqliteWrapper()
+    else:
+        mongo_server: tp.Optional[str] = os.getenv("MONGO_TEST_CONNECTION_URL")
+        if mongo_server:
+            monkeypatch.setenv("MONGO_CONNECTION_URL", mongo_server)
+        else:
+            _patch_mongomock(monkeypatch)
+        monkeypatch.setenv("MONGO_DATABASE", f"mastodon-meter-test-{uuid4().hex[:8]}")
+        wrapper = MongoDbWrapper()
+
+    try:
+        await wrapper.ensure_indexes()
+        yield wrapper
+    finally:
+        if isinstance(wrapper, MongoDbWrapper):
+            await wrapper._database.client.drop_database(wrapper._database.name)
+        await wrapper.close()
+        SingletonMeta._instances.pop(type(wrapper), None)
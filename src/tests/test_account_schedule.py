@@ -0,0 +1,100 @@
+import typing as tp
+from datetime import datetime, timezone
+
+import pytest
+
+from mastodon_meter.Account import Account
+from mastodon_meter.AccountSchedule import AccountSchedule
+from mastodon_meter.AccountState import AccountState
+from mastodon_meter.Metering import Metering
+
+HOUR: float = 3600
+DAY: float = 86400
+
+
+def make_account(index: int, metering_interval: tp.Optional[int] = None) -> Account:
+    return Account(
+        username=f"user{index}",
+        instance="https://mastodon.example",
+        id=str(index),
+        internal_id=f"account-{index}",
+        metering_interval=metering_interval,
+    )
+
+
+@pytest.fixture
+def schedule(monkeypatch: pytest.MonkeyPatch) -> AccountSchedule:
+    monkeypatch.setenv("METERING_INTERVAL", str(int(DAY)))
+    monkeypatch.setenv("METERING_MIN_INTERVAL", str(int(HOUR)))
+    monkeypatch.setenv("METERING_MAX_INTERVAL", str(int(4 * DAY)))
+    monkeypatch.setenv("METERING_FAST_CHANGE", "10")
+    return AccountSchedule(adaptive=True)
+
+
+def test_accounts_are_due_one_interval_after_their_latest_metering(schedule: AccountSchedule) -> None:
+    now: float = 10 * DAY
+    metered_at: datetime = datetime.fromtimestamp(now - HOUR, timezone.utc).replace(tzinfo=None)
+    states: tp.Dict[str, AccountState] = {"account-1": AccountState("account-1", metered_at, 1, 1)}
+    schedule.sync([make_account(0), make_account(1), make_account(2, metering_interval=int(HOUR))], states, now)
+
+    assert [account.internal_id for account in schedule.pop_due(now)] == ["account-0", "account-2"]
+    assert schedule.pop_due(now) == []
+    assert schedule.next_due() == now + HOUR
+    assert [account.internal_id for account in schedule.pop_due(now + HOUR)] == ["account-2"]
+    assert [account.internal_id for account in schedule.pop_due(now + DAY - HOUR)] == ["account-2", "account-1"]
+
+
+def test_sync_drops_untracked_accounts_and_applies_new_intervals(schedule: AccountSchedule) -> None:
+    schedule.sync([make_account(0), make_account(1)], {}, 0)
+    schedule.pop_due(0)
+
+    schedule.sync([make_account(1, metering_interval=int(HOUR))], {}, 0)
+    assert len(schedule) == 1 and "account-0" not in schedule
+    assert schedule.next_due() == HOUR
+
+
+def test_adaptive_intervals_follow_the_changes(schedule: AccountSchedule) -> None:
+    schedule.sync([make_account(0), make_account(1, metering_interval=int(DAY))], {}, 0)
+    schedule.pop_due(0)
+    for account_id in ("account-0", "account-1"):
+        schedule.observe(Metering(10, 10, account_id), 0)
+
+    # unchanged counts double the interval up to the maximum
+    for _ in range(4):
+        schedule.observe(Metering(10, 10, "account-0"), 0)
+        schedule.observe_unchanged("account-1", 0)
+    assert schedule._entries["account-0"].interval == 4 * DAY
+    assert schedule._entries["account-1"].interval == DAY
+
+    # fast changes halve it down to the minimum
+    for i in range(1, 10):
+        schedule.observe(Metering(10 + 20 * i, 10, "account-0"), 0)
+    assert schedule._entries["account-0"].interval == HOUR
+    assert schedule.next_due() == HOUR
+
+
+def test_fixed_schedule_doesnt_adapt() -> None:
+    schedule: AccountSchedule = AccountSchedule(adaptive=False)
+    schedule.sync([make_account(0)], {}, 0)
+    schedule.pop_due(0)
+    interval: float = schedule._entries["account-0"].interval
+
+    schedule.observe(Metering(10, 10, "account-0"), 0)
+    schedule.observe(Metering(10, 10, "account-0"), 0)
+    schedule.observe_unchanged("account-0", 0)
+    assert schedule._entries["account-0"].interval == interval
+
+
+def test_failed_accounts_are_retried_soon(schedule: AccountSchedule, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("METERING_RETRY_DELAY", "300")
+    schedule = AccountSchedule(adaptive=True)
+    schedule.sync([make_account(0), make_account(1)], {}, 0)
+    schedule.pop_due(0)
+
+    schedule.observe_failed("account-0", 0)
+    assert schedule.next_due() == 300
+    assert [account.internal_id for account in schedule.pop_due(300)] == ["account-0"]
+
+    # the retry never postpones the metering
+    schedule.observe_failed("account-1", DAY - 100)
+    assert schedule._entries["account-1"].due == DAY
@@ -0,0 +1,205 @@
+import typing as tp
+from datetime import datetime, timedelta
+
+import pytest
+
+from mastodon_meter.Account import Account
+from mastodon_meter.AccountState import AccountState
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Metering import Metering
+from mastodon_meter.Rollups import ROLLUP_TIER_NAMES, make_rollups
+from mastodon_meter.Series import MeteringSeries
+
+pytestmark = pytest.mark.anyio
+
+START: datetime = datetime(2022, 1, 3, 10, 0)
+
+
+def make_account(index: int, instance: str = "https://mastodon.example") -> Account:
+    return Account(username=f"user{index}", instance=instance, id=str(index), internal_id=f"{index:032x}")
+
+
+def make_meterings(account: Account, count: int, step: timedelta = timedelta(hours=1)) -> tp.List[Metering]:
+    return [Metering(100 + i, 1000 + 2 * i, account.internal_id, START + step * i) for i in range(count)]
+
+
+async def test_add_tracked_accounts_skips_tracked_ones(database: DatabaseWrapper) -> None:
+    tracked: Account = make_account(1)
+    await database.add_tracked_account(tracked)
+    version: int = await database.get_accounts_version()
+
+    # the same account under another internal id, twice in the same batch and a new one
+    duplicate: Account = Account(username="user1", instance=tracked.instance, id=tracked.id)
+    new: Account = make_account(2)
+    added: tp.List[Account] = await database.add_tracked_accounts([duplicate, new, make_account(2)])
+
+    assert [account.internal_id for account in added] == [new.internal_id]
+    assert {account.internal_id for account in await database.get_tracked_accounts()} == {
+        tracked.internal_id,
+        new.internal_id,
+    }
+    assert await database.get_accounts_version() == version + 1
+
+    assert await database.add_tracked_accounts([make_account(1), make_account(2)]) == []
+    assert await database.get_accounts_version() == version + 1
+
+
+async def test_meterings_are_paged_with_a_cursor(database: DatabaseWrapper) -> None:
+    account: Account = make_account(1)
+    meterings: tp.List[Metering] = make_meterings(account, 25)
+    await database.add_meterings(meterings[::-1] + make_meterings(make_account(2), 5))
+
+    pages: tp.List[tp.List[Metering]] = []
+    cursor: tp.Optional[datetime] = None
+    while True:
+        page, cursor = await database.get_meterings_page(account.internal_id, limit=10, after=cursor)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [m.timestamp for page in pages for m in page] == [m.timestamp for m in meterings]
+    assert [m.subscribers_count for page in pages for m in page] == [m.subscribers_count for m in meterings]
+
+
+async def test_meterings_pages_respect_the_time_boundaries(database: DatabaseWrapper) -> None:
+    account: Account = make_account(1)
+    meterings: tp.List[Metering] = make_meterings(account, 25)
+    await database.add_meterings(meterings)
+    since, to = meterings[5].timestamp, meterings[14].timestamp
+
+    page, cursor = await database.get_meterings_page(account.internal_id, limit=4, since=since, to=to)
+    assert [m.timestamp for m in page] == [m.timestamp for m in meterings[5:9]]
+    assert cursor == meterings[8].timestamp
+
+    streamed: tp.List[Metering] = [m async for m in database.iter_meterings(account.internal_id, since, to, cursor)]
+    assert [m.timestamp for m in streamed] == [m.timestamp for m in meterings[9:15]]
+
+
+async def test_series_for_accounts_are_read_at_once(database: DatabaseWrapper) -> None:
+    accounts: tp.List[Account] = [make_account(i) for i in range(3)]
+    histories: tp.Dict[str, tp.List[Metering]] = {
+        accounts[0].internal_id: make_meterings(accounts[0], 30),
+        accounts[1].internal_id: make_meterings(accounts[1], 10, step=timedelta(hours=5)),
+    }
+    meterings: tp.List[Metering] = [m for history in histories.values() for m in history]
+    await database.add_meterings(meterings)
+    await database.update_rollups(meterings)
+    ids: tp.List[str] = [account.internal_id for account in accounts]
+
+    series: tp.Dict[str, MeteringSeries] = await database.get_series_for_accounts(ids)
+    assert set(series) == set(ids)
+    assert not len(series[accounts[2].internal_id])
+    for internal_id, history in histories.items():
+        expected: MeteringSeries = await database.get_metering_series(internal_id)
+        assert series[internal_id].timestamps.tolist() == expected.timestamps.tolist()
+        assert series[internal_id].column("toot_count").tolist() == [m.toot_count for m in history]
+
+    since, to = START + timedelta(hours=10), START + timedelta(hours=20)
+    bounded: tp.Dict[str, MeteringSeries] = await database.get_series_for_accounts(ids, since=since, to=to)
+    assert len(bounded[accounts[0].internal_id]) == 11
+    assert len(bounded[accounts[1].internal_id]) == 3
+
+    daily: tp.Dict[str, MeteringSeries] = await database.get_series_for_accounts(ids, ROLLUP_TIER_NAMES["daily"])
+    rollups = make_rollups(histories[accounts[1].internal_id], ROLLUP_TIER_NAMES["daily"])
+    assert daily[accounts[1].internal_id].column("subscribers_count").tolist() == [
+        rollup.subscribers_count_last for rollup in rollups
+    ]
+
+
+async def test_rollups_merge_meterings_in_any_order(database: DatabaseWrapper) -> None:
+    account: Account = make_account(1)
+    meterings: tp.List[Metering] = make_meterings(account, 60, step=timedelta(minutes=25))
+    # the buckets are merged across several writes and don't depend on the order of the meterings
+    await database.update_rollups(meterings[30:])
+    await database.update_rollups(meterings[:30][::-1])
+
+    for tier in ROLLUP_TIER_NAMES.values():
+        assert await database.get_rollups(account.internal_id, tier) == make_rollups(meterings, tier)
+
+
+async def test_rollups_backfill_keeps_maintained_rollups(database: DatabaseWrapper) -> None:
+    account: Account = make_account(1)
+    meterings: tp.List[Metering] = make_meterings(account, 40, step=timedelta(minutes=40))
+    await database.add_meterings(meterings)
+    await database.update_rollups(meterings)
+
+    # an interrupted backfill runs again, neither counts a metering twice
+    await database.backfill_rollups()
+    await database.backfill_rollups()
+
+    hourly = ROLLUP_TIER_NAMES["hourly"]
+    assert await database.get_rollups(account.internal_id, hourly) == make_rollups(meterings, hourly)
+
+
+async def test_account_states_follow_the_latest_meterings(database: DatabaseWrapper) -> None:
+    accounts: tp.List[Account] = [make_account(i) for i in range(3)]
+    for account in accounts:
+        await database.add_tracked_account(account)
+    version: int = await database.get_account_states_version()
+
+    first, second, third = make_meterings(accounts[0], 3)
+    await database.update_account_states([first])
+    # the meterings of a batch are applied in chronological order
+    await database.update_account_states([third, second, *make_meterings(accounts[1], 1)])
+
+    assert await database.get_account_states_version() > version
+    states: tp.Dict[str, tp.Optional[AccountState]] = {
+        account.internal_id: state for account, state in await database.get_account_states()
+    }
+    assert set(states) == {account.internal_id for account in accounts}
+    assert states[accounts[2].internal_id] is None
+
+    state: tp.Optional[AccountState] = states[accounts[0].internal_id]
+    assert state is not None
+    assert (state.timestamp, state.toot_count, state.subscribers_count) == (
+        third.timestamp,
+        third.toot_count,
+        third.subscribers_count,
+    )
+    assert state.previous_timestamp == second.timestamp
+    assert state.toot_count_delta == third.toot_count - second.toot_count
+    assert state.subscribers_count_delta == third.subscribers_count - second.subscribers_count
+
+    single: tp.Optional[AccountState] = states[accounts[1].internal_id]
+    assert single is not None and single.previous_timestamp is None and single.toot_count_delta is None
+
+    selected = await database.get_account_states([accounts[1].internal_id])
+    assert [account.internal_id for account, _ in selected] == [accounts[1].internal_id]
+
+
+async def test_meterings_and_states_written_again_change_nothing(database: DatabaseWrapper) -> None:
+    account: Account = make_account(1)
+    await database.add_tracked_account(account)
+    meterings: tp.List[Metering] = make_meterings(account, 3)
+
+    # a retried write repeats the meterings and the states written by the failed one
+    for _ in range(2):
+        await database.add_meterings(meterings)
+        await database.update_account_states(meterings[1:])
+
+    assert await database.count_meterings(account.internal_id) == len(meterings)
+    [(_, state)] = await database.get_account_states([account.internal_id])
+    assert state is not None
+    assert (state.timestamp, state.previous_timestamp) == (meterings[2].timestamp, meterings[1].timestamp)
+    assert state.toot_count_delta == meterings[2].toot_count - meterings[1].toot_count
+
+
+async def test_leases_are_held_by_one_holder(database: DatabaseWrapper) -> None:
+    assert await database.acquire_lease("leader", "worker-1", ttl=60)
+    assert not await database.acquire_lease("leader", "worker-2", ttl=60)
+    # the holder renews its lease
+    assert await database.acquire_lease("leader", "worker-1", ttl=60)
+
+    await database.release_lease("leader", "worker-2")
+    assert not await database.acquire_lease("leader", "worker-2", ttl=60)
+
+    await database.release_lease("leader", "worker-1")
+    assert await database.acquire_lease("leader", "worker-2", ttl=60)
+    assert await database.acquire_lease("another", "worker-1", ttl=60)
+
+
+async def test_expired_leases_are_taken_over(database: DatabaseWrapper) -> None:
+    assert await database.acquire_lease("leader", "worker-1", ttl=-1)
+    assert await database.acquire_lease("leader", "worker-2", ttl=60)
+    assert not await database.acquire_lease("leader", "worker-1", ttl=60)
@@ -0,0 +1,86 @@
+import random
+import typing as tp
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from mastodon_meter.Downsampling import lttb
+from mastodon_meter.Metering import Metering
+from mastodon_meter.Series import MeteringSeries
+
+
+def make_series(values: tp.List[int]) -> MeteringSeries:
+    start: datetime = datetime(2022, 1, 1)
+    return MeteringSeries.from_meterings(
+        [Metering(i, value, "account", start + timedelta(hours=i, minutes=i % 7)) for i, value in enumerate(values)]
+    )
+
+
+def reference_lttb(x: tp.List[float], y: tp.List[float], threshold: int) -> tp.List[int]:
+    """the algorithm as published, one bucket at a time"""
+    size: int = len(x)
+    every: float = (size - 2) / (threshold - 2)
+    selected: tp.List[int] = [0]
+    a: int = 0
+
+    for i in range(threshold - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_start, next_end = end, min(int((i + 2) * every) + 1, size)
+        if i == threshold - 3:
+            next_start, next_end = size - 1, size
+        avg_x: float = sum(x[next_start:next_end]) / (next_end - next_start)
+        avg_y: float = sum(y[next_start:next_end]) / (next_end - next_start)
+
+        best, best_area = start, -1.0
+        for j in range(start, min(end, size - 1)):
+            area: float = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+
+    return selected + [size - 1]
+
+
+@pytest.mark.parametrize("size, threshold", [(10, 3), (100, 10), (1000, 97), (1001, 1000), (5000, 300)])
+def test_lttb_matches_the_reference(size: int, threshold: int) -> None:
+    rng: random.Random = random.Random(size)
+    values: tp.List[int] = [int(1000 + 100 * rng.gauss(0, 1) + i) for i in range(size)]
+    series: MeteringSeries = make_series(values)
+
+    sampled: MeteringSeries = lttb(series, threshold)
+    expected: tp.List[int] = reference_lttb(
+        series.timestamps.astype(float).tolist(), [float(v) for v in values], threshold
+    )
+
+    assert len(sampled) == threshold
+    assert sampled.timestamps.tolist() == series.timestamps[expected].tolist()
+    assert sampled.toot_count.tolist() == series.toot_count[expected].tolist()
+
+
+def test_lttb_keeps_the_ends_and_the_peaks() -> None:
+    values: tp.List[int] = [100] * 500
+    values[123], values[321] = 10000, 0
+    sampled: MeteringSeries = lttb(make_series(values), 20)
+
+    subscribers: tp.List[int] = sampled.subscribers_count.tolist()
+    assert 10000 in subscribers and 0 in subscribers
+    assert sampled.toot_count[0] == 0 and sampled.toot_count[-1] == 499
+    assert np.all(np.diff(sampled.timestamps) > 0)
+
+
+def test_lttb_follows_the_chosen_counter() -> None:
+    series: MeteringSeries = make_series([100] * 300)
+    toots: np.ndarray = series.toot_count.copy()
+    toots[150] = 100000
+    series = MeteringSeries(series.timestamps, toots, series.subscribers_count)
+
+    assert 100000 in lttb(series, 10, field="toot_count").toot_count.tolist()
+
+
+@pytest.mark.parametrize("threshold", [0, 2, 50, 51])
+def test_short_series_are_left_as_they_are(threshold: int) -> None:
+    series: MeteringSeries = make_series(list(range(50)))
+
+    assert lttb(series, threshold) is series
@@ -0,0 +1,103 @@
+import io
+import sys
+import typing as tp
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from mastodon_meter import Export
+from mastodon_meter.Export import ExportUnavailable, MeteringExport, negotiate_compression
+from mastodon_meter.Metering import Metering
+
+METERINGS: tp.List[Metering] = [
+    Metering(100 + i, 1000 + i, "account", datetime(2022, 1, 3, 10, 0) + timedelta(hours=i)) for i in range(2500)
+]
+
+
+@pytest.fixture
+def zstd_available(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Export, "get_compressor", lambda compression: tp.cast(Export.Compressor, object()))
+
+
+@pytest.fixture
+def zstd_missing(monkeypatch: pytest.MonkeyPatch) -> None:
+    get_compressor: tp.Callable[[str], Export.Compressor] = Export.get_compressor
+
+    def _get_compressor(compression: str) -> Export.Compressor:
+        if compression == "zstd":
+            raise ExportUnavailable("zstd compression requires the zstandard package to be installed")
+        return get_compressor(compression)
+
+    monkeypatch.setattr(Export, "get_compressor", _get_compressor)
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, compression",
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("gzip, deflate, br", "gzip"),
+        ("GZIP ; q=0.5", "gzip"),
+        ("gzip;q=0", None),
+        ("gzip;q=0.0, deflate", None),
+        ("gzip;q=oops", None),
+        ("br, zstd;q=0.1, gzip;q=1", "zstd"),
+        ("zstd;q=0, gzip", "gzip"),
+    ],
+)
+def test_best_accepted_compression_is_chosen(
+    zstd_available: None, accept_encoding: tp.Optional[str], compression: tp.Optional[str]
+) -> None:
+    assert negotiate_compression(accept_encoding) == compression
+
+
+def test_unavailable_compressions_are_skipped(zstd_missing: None) -> None:
+    assert negotiate_compression("zstd, gzip") == "gzip"
+    assert negotiate_compression("zstd") is None
+
+
+async def read_export(export: MeteringExport) -> bytes:
+    async def _meterings() -> tp.AsyncIterator[Metering]:
+        for metering in METERINGS:
+            yield metering
+
+    return b"".join([chunk async for chunk in export.stream(_meterings())])
+
+
+@pytest.mark.anyio
+async def test_parquet_export_is_read_back() -> None:
+    parquet: tp.Any = pytest.importorskip("pyarrow.parquet")
+    table: tp.Any = parquet.read_table(io.BytesIO(await read_export(MeteringExport("parquet"))))
+
+    assert table.num_rows == len(METERINGS)
+    assert table.column("timestamp").to_pylist() == [m.timestamp for m in METERINGS]
+    assert table.column("toot_count").to_pylist() == [m.toot_count for m in METERINGS]
+
+
+@pytest.mark.anyio
+async def test_zstd_export_is_decompressed() -> None:
+    zstandard: tp.Any = pytest.importorskip("zstandard")
+    data: bytes = await read_export(MeteringExport("csv", "zstd"))
+    lines: tp.List[str] = zstandard.ZstdDecompressor().decompressobj().decompress(data).decode().splitlines()
+
+    assert lines[0] == ",".join(Export.EXPORT_COLUMNS)
+    assert len(lines) == len(METERINGS) + 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("body", [{"format": "parquet"}, {"compression": "zstd"}])
+async def test_exports_needing_missing_packages_are_not_implemented(
+    monkeypatch: pytest.MonkeyPatch, body: tp.Dict[str, str]
+) -> None:
+    from app import app
+
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response: httpx.Response = await client.request("GET", "/api/export", json=body)
+
+    assert response.status_code == 501
+    assert "'export' extra" in response.json()["message"]
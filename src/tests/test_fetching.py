@@ -0,0 +1,164 @@
+import asyncio
+import json
+import typing as tp
+
+import httpx
+import pytest
+
+from mastodon_meter.Account import Account
+from mastodon_meter.Fetching import COUNTER_FIELDS, BatchedFetchStrategy, CounterScanner, Fetcher, FetchJob, FetchResult
+
+ACCOUNT: tp.Dict[str, tp.Any] = {
+    "id": "1",
+    "username": "user",
+    "note": 'a "quoted" note with {braces} and [brackets], "statuses_count": 1',
+    "fields": [{"name": "followers_count", "value": "5"}],
+    "source": {"statuses_count": 2, "followers_count": 3},
+    "statuses_count": 1234,
+    "emojis": [],
+    "followers_count": 56789,
+    "following_count": 10,
+}
+
+
+def scan(document: bytes, chunk_size: int) -> CounterScanner:
+    scanner: CounterScanner = CounterScanner(COUNTER_FIELDS)
+    for i in range(0, len(document), chunk_size):
+        if scanner.feed(document[i : i + chunk_size]):
+            break
+    return scanner
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 10000])
+def test_counters_are_found_at_the_top_level_only(chunk_size: int) -> None:
+    document: bytes = json.dumps(ACCOUNT).encode()
+    scanner: CounterScanner = scan(document, chunk_size)
+
+    assert scanner.done
+    assert scanner.values == {"statuses_count": 1234, "followers_count": 56789}
+
+
+def test_scanning_stops_once_the_counters_are_found() -> None:
+    document: bytes = b'{"statuses_count": 1, "followers_count": 2, "note": "never scanned'
+    scanner: CounterScanner = CounterScanner(COUNTER_FIELDS)
+
+    assert scanner.feed(document)
+    assert scanner.values == {"statuses_count": 1, "followers_count": 2}
+
+
+def test_numbers_split_between_chunks_are_read_whole() -> None:
+    scanner: CounterScanner = CounterScanner(COUNTER_FIELDS)
+
+    assert not scanner.feed(b'{"statuses_count": 12')
+    assert not scanner.feed(b'34, "followers_count"')
+    assert scanner.feed(b": 5}")
+    assert scanner.values == {"statuses_count": 1234, "followers_count": 5}
+
+
+def test_missing_counters_leave_the_scan_unfinished() -> None:
+    scanner: CounterScanner = scan(json.dumps({"id": "1", "statuses_count": 3}).encode(), chunk_size=4)
+
+    assert not scanner.done
+    assert scanner.values == {"statuses_count": 3}
+
+
+def test_non_integer_counters_are_not_taken() -> None:
+    scanner: CounterScanner = scan(b'{"statuses_count": "12", "followers_count": 1.5}', chunk_size=5)
+
+    assert scanner.values == {}
+
+
+class ChunkedBody(httpx.AsyncByteStream):
+    """a response body served in small chunks, remembering how much of it was read"""
+
+    def __init__(self, document: bytes, chunk_size: int = 16) -> None:
+        self.chunks: tp.List[bytes] = [document[i : i + chunk_size] for i in range(0, len(document), chunk_size)]
+        self.read: int = 0
+
+    async def __aiter__(self) -> tp.AsyncIterator[bytes]:
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+
+@pytest.fixture
+def fetcher(monkeypatch: pytest.MonkeyPatch) -> Fetcher:
+    monkeypatch.setenv("RETRY_ATTEMPTS", "2")
+    monkeypatch.setenv("RETRY_BASE_DELAY", "0")
+    monkeypatch.setenv("INSTANCE_RATE_LIMIT", "0")
+    monkeypatch.setenv("INSTANCE_FAILURE_THRESHOLD", "2")
+    return Fetcher()
+
+
+@pytest.mark.anyio
+async def test_account_responses_are_read_to_the_end(fetcher: Fetcher) -> None:
+    bodies: tp.List[ChunkedBody] = []
+
+    def _respond(request: httpx.Request) -> httpx.Response:
+        bodies.append(ChunkedBody(json.dumps(ACCOUNT).encode()))
+        return httpx.Response(200, stream=bodies[-1], headers={"etag": '"1"'})
+
+    account: Account = Account(username="user", instance="https://mastodon.example", id="1")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(_respond)) as client:
+        result: FetchResult = await fetcher.fetch_account(client, account)
+
+    assert result.payload == {"statuses_count": 1234, "followers_count": 56789}
+    assert result.validators is not None and result.validators.etag == '"1"'
+    # the connection goes back to the pool only once the whole body is read
+    assert bodies[0].read == len(bodies[0].chunks)
+
+
+@pytest.mark.anyio
+async def test_responses_missing_counters_are_retried(fetcher: Fetcher) -> None:
+    documents: tp.List[bytes] = [b'{"id": "1", "statuses_count": 1}', json.dumps(ACCOUNT).encode()]
+
+    def _respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=documents.pop(0))
+
+    account: Account = Account(username="user", instance="https://mastodon.example", id="1")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(_respond)) as client:
+        result: FetchResult = await fetcher.fetch_account(client, account)
+
+    assert result.ok and not documents
+    stats: tp.Dict[str, tp.Any] = fetcher.get_instance_stats()[account.instance]
+    assert (stats["requests"], stats["failures"], stats["retries"]) == (2, 1, 1)
+
+
+@pytest.mark.anyio
+async def test_malformed_responses_open_the_circuit(fetcher: Fetcher) -> None:
+    def _respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=b"<html>Maintenance</html>")
+
+    account: Account = Account(username="user", instance="https://mastodon.example", id="1")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(_respond)) as client:
+        result: FetchResult = await fetcher.fetch_account(client, account)
+
+    assert result.error is not None and result.error.startswith("MalformedResponse")
+    assert fetcher.get_instance_stats()[account.instance]["circuit"] == "open"
+
+
+@pytest.mark.anyio
+async def test_batches_falling_back_to_single_requests_keep_the_concurrency(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("INSTANCE_RATE_LIMIT", "0")
+    monkeypatch.setenv("INSTANCE_CONCURRENCY", "100")
+    strategy: BatchedFetchStrategy = BatchedFetchStrategy(Fetcher())
+    in_flight: tp.List[int] = [0, 0]
+
+    async def _respond(request: httpx.Request) -> httpx.Response:
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        if request.url.path == "/api/v1/accounts":
+            return httpx.Response(404)
+        return httpx.Response(200, json={**ACCOUNT, "id": request.url.path.rsplit("/", 1)[-1]})
+
+    accounts: tp.List[Account] = [
+        Account(username=f"user{i}", instance="https://mastodon.example", id=str(i)) for i in range(60)
+    ]
+    async with httpx.AsyncClient(transport=httpx.MockTransport(_respond)) as client:
+        jobs: tp.List[FetchJob] = strategy.plan(client, accounts, asyncio.Semaphore(3))
+        results: tp.List[FetchResult] = [result for job in await asyncio.gather(*jobs) for result in job]
+
+    assert len(results) == len(accounts) and all(result.ok for result in results)
+    assert in_flight[1] == 3
@@ -0,0 +1,83 @@
+import typing as tp
+
+import httpx
+import pytest
+
+from mastodon_meter.Account import Account
+from mastodon_meter.AccountCache import AccountCache
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Fetching import Fetcher
+from mastodon_meter.Gatherer import Gatherer
+from mastodon_meter.Importer import AccountImporter, Handle, ImportSummary, parse_handle
+from mastodon_meter.Metering import Metering
+from mastodon_meter.Singleton import SingletonMeta
+from mastodon_meter.WriteBuffer import WriteBuffer
+
+
+@pytest.mark.parametrize(
+    "raw, username, domain",
+    [
+        ("user@mastodon.social", "user", "mastodon.social"),
+        ("@User@Mastodon.Social", "User", "mastodon.social"),
+        ("  first.last-name_1@sub.example.co.uk \n", "first.last-name_1", "sub.example.co.uk"),
+        ("user@localhost.test:3000", "user", "localhost.test:3000"),
+        ("user@xn--80ak6aa92e.com", "user", "xn--80ak6aa92e.com"),
+    ],
+)
+def test_handles_are_parsed(raw: str, username: str, domain: str) -> None:
+    assert parse_handle(raw) == Handle(username, domain)
+
+
+@pytest.mark.parametrize(
+    "raw",
+    ["", "user", "@user", "user@", "user@localhost", "user@@mastodon.social", "user@mastodon.social/path", "a b@c.d"],
+)
+def test_malformed_handles_are_rejected(raw: str) -> None:
+    assert parse_handle(raw) is None
+
+
+def test_handles_are_compared_case_insensitively() -> None:
+    handles: tp.List[tp.Optional[Handle]] = [
+        parse_handle("User@Mastodon.Social"),
+        parse_handle("@user@mastodon.social"),
+    ]
+
+    assert handles[0] is not None and handles[1] is not None
+    assert handles[0].key == handles[1].key == "user@mastodon.social"
+    assert handles[0].acct == "User@mastodon.social"
+    assert handles[0].instance == "https://mastodon.social"
+
+
+@pytest.mark.anyio
+async def test_imported_accounts_keep_their_meterings_when_the_write_fails(
+    database: DatabaseWrapper, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("INSTANCE_RATE_LIMIT", "0")
+    monkeypatch.setitem(SingletonMeta._instances, AccountCache, AccountCache())
+    fetcher: Fetcher = Fetcher()
+
+    def _respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"id": "1", "username": "user", "statuses_count": 10, "followers_count": 20})
+
+    monkeypatch.setattr(fetcher, "get_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(_respond)))
+    add_meterings: tp.Callable[[tp.List[Metering]], tp.Awaitable[None]] = database.add_meterings
+    failures: tp.List[int] = []
+
+    async def _add_meterings(meterings: tp.List[Metering]) -> None:
+        if not failures:
+            failures.append(len(meterings))
+            raise ConnectionError("Database is down")
+        await add_meterings(meterings)
+
+    monkeypatch.setattr(database, "add_meterings", _add_meterings)
+    buffer: WriteBuffer = WriteBuffer(Gatherer._store_results)
+    summary: ImportSummary = await AccountImporter(fetcher, buffer).import_accounts(["user@mastodon.example"])
+
+    assert list(summary.imported) == ["user@mastodon.example"] and not summary.failed
+    account: Account = summary.imported["user@mastodon.example"]
+    assert failures == [1] and await database.count_meterings(account.internal_id) == 0
+
+    # the buffer writes the meterings again with the next flush
+    await buffer.close()
+    [metering] = await database.get_all_meterings(account.internal_id)
+    assert (metering.toot_count, metering.subscribers_count) == (10, 20)
@@ -0,0 +1,80 @@
+import os
+import typing as tp
+from datetime import datetime, timedelta
+from time import monotonic
+
+import pytest
+
+from benchmarks.datasets import DATASET_PRESETS, DatasetOptions, populate_database
+from mastodon_meter.Account import Account
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Rollups import ROLLUP_TIER_NAMES
+from mastodon_meter.database import MongoDbWrapper
+
+pytestmark = [pytest.mark.anyio, pytest.mark.perf]
+
+# the time budgets are generous, so that only a lost index or a query per account fails them on a slow machine
+BUDGET_SCALE: float = float(os.getenv("PERF_BUDGET_SCALE", default=1))
+
+
+class Stopwatch:
+    """measures the block and checks it fits into the time budget"""
+
+    def __init__(self, name: str, budget: float) -> None:
+        self._name: str = name
+        self._budget: float = budget * BUDGET_SCALE
+        self._t0: float = 0
+
+    def __enter__(self) -> None:
+        self._t0 = monotonic()
+
+    def __exit__(self, *_: tp.Any) -> None:
+        elapsed: float = monotonic() - self._t0
+        assert elapsed <= self._budget, f"{self._name} took {elapsed:.2f} s., the budget is {self._budget:.2f} s."
+
+
+@pytest.fixture
+async def dataset(database: DatabaseWrapper) -> tp.Tuple[DatasetOptions, tp.List[Account]]:
+    """the tiny benchmark dataset: 100 accounts with 30 days of daily meterings"""
+    if isinstance(database, MongoDbWrapper) and not os.getenv("MONGO_TEST_CONNECTION_URL"):
+        pytest.skip("timings of the in-memory MongoDB mock say nothing about the server")
+
+    options: DatasetOptions = DATASET_PRESETS["tiny"]
+    with Stopwatch("populating the database", budget=20):
+        accounts: tp.List[Account] = await populate_database(database, options, "http://mastodon.test")
+    return options, accounts
+
+
+async def test_reads_fit_into_budget(
+    database: DatabaseWrapper, dataset: tp.Tuple[DatasetOptions, tp.List[Account]]
+) -> None:
+    options, accounts = dataset
+    ids: tp.List[str] = [account.internal_id for account in accounts]
+
+    with Stopwatch("reading the series of all the accounts", budget=2):
+        series = await database.get_series_for_accounts(ids)
+    assert sum(map(len, series.values())) == options.meterings
+
+    with Stopwatch("reading the daily rollups of all the accounts", budget=2):
+        daily = await database.get_series_for_accounts(ids, ROLLUP_TIER_NAMES["daily"])
+    assert all(len(daily[internal_id]) for internal_id in ids)
+
+    with Stopwatch("reading the states of all the accounts", budget=1):
+        states = await database.get_account_states()
+    assert all(state is not None for _, state in states)
+
+    with Stopwatch("paging through the meterings of every account", budget=5):
+        for internal_id in ids:
+            cursor: tp.Optional[datetime] = None
+            read: int = 0
+            while True:
+                page, cursor = await database.get_meterings_page(internal_id, limit=7, after=cursor)
+                read += len(page)
+                if cursor is None:
+                    break
+            assert read == options.meterings_per_account
+
+    since: datetime = datetime.utcnow() - timedelta(days=7)
+    with Stopwatch("reading the weekly changes of all the accounts", budget=1):
+        changes = await database.get_rollup_changes(ids, ROLLUP_TIER_NAMES["daily"], since)
+    assert len(changes) == len(ids)
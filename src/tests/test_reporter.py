@@ -0,0 +1,37 @@
+import typing as tp
+
+import numpy as np
+import pytest
+
+from mastodon_meter.Reporter import Reporter
+from mastodon_meter.Types import Document
+
+
+def make_changes(counts: np.ndarray) -> tp.List[Document]:
+    return [
+        {
+            "toot_count_first": int(count) - i % 10,
+            "toot_count_last": int(count),
+            "subscribers_count_first": 0,
+            "subscribers_count_last": 0,
+        }
+        for i, count in enumerate(counts)
+    ]
+
+
+@pytest.mark.parametrize("account_count", [10, 1000, 1001, 50000])
+def test_snapshot_size_is_bounded_and_ranks_stay_accurate(account_count: int) -> None:
+    counts: np.ndarray = np.random.default_rng(account_count).integers(0, 10**6, account_count)
+    snapshot: Document = Reporter.get_stats_snapshot(make_changes(counts))
+
+    assert snapshot["account_count"] == account_count
+    assert all(len(values) == min(account_count, 1000) for values in snapshot["metrics"].values())
+    for value in [-1, 10**7, *counts[:100].tolist()]:
+        exact: float = 100 * float(np.mean(counts <= value))
+        rank: tp.Optional[float] = Reporter._percentile_rank(snapshot, "toot_count", value)
+        assert rank is not None and exact - 0.1 <= rank <= exact + 0.01
+
+
+def test_ranks_are_unknown_without_a_snapshot() -> None:
+    assert Reporter._percentile_rank(None, "toot_count", 10) is None
+    assert Reporter._percentile_rank(Reporter.get_stats_snapshot([]), "toot_count", 10) is None
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import typing as tp
+
+import httpx
+import pytest
+
+from mastodon_meter.Fetching import Fetcher, InstanceResponse
+from mastodon_meter.Resilience import (
+    CircuitBreaker,
+    CircuitOpen,
+    MalformedResponse,
+    get_rate_limit_delay,
+    is_retryable,
+)
+
+
+class Clock:
+    """a monotonic clock moved by the test"""
+
+    def __init__(self) -> None:
+        self.now: float = 1000
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock: Clock = Clock()
+    monkeypatch.setattr("mastodon_meter.Resilience.monotonic", clock)
+    return clock
+
+
+def test_circuit_opens_after_consecutive_failures(clock: Clock) -> None:
+    breaker: CircuitBreaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+
+    for _ in range(2):
+        breaker.check()
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_one_trial_request_is_let_through_after_the_cooldown(clock: Clock) -> None:
+    breaker: CircuitBreaker = CircuitBreaker(failure_threshold=1, cooldown=60)
+    breaker.record_failure()
+    clock.now += 61
+
+    assert breaker.state == "half-open"
+    assert breaker.check()
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+    # the failed trial opens the circuit again, the successful one closes it
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 61
+    assert breaker.check()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert not breaker.check()
+
+
+def test_abandoned_trial_lets_the_next_request_try(clock: Clock) -> None:
+    breaker: CircuitBreaker = CircuitBreaker(failure_threshold=1, cooldown=60)
+    breaker.record_failure()
+    clock.now += 61
+
+    assert breaker.check()
+    breaker.abandon_trial()
+    assert breaker.check()
+
+
+@pytest.mark.anyio
+async def test_cancelled_trial_request_is_abandoned(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("INSTANCE_FAILURE_THRESHOLD", "1")
+    monkeypatch.setenv("INSTANCE_COOLDOWN", "0")
+    monkeypatch.setenv("RETRY_ATTEMPTS", "1")
+    fetcher: Fetcher = Fetcher()
+
+    async def _fail() -> InstanceResponse:
+        raise httpx.ConnectError("Connection refused")
+
+    async def _hang() -> InstanceResponse:
+        await asyncio.sleep(60)
+        raise AssertionError("The request must have been cancelled")
+
+    async def _succeed() -> InstanceResponse:
+        return InstanceResponse(httpx.Response(200), {})
+
+    with pytest.raises(httpx.ConnectError):
+        await fetcher._request("https://mastodon.example", _fail)
+
+    trial: "asyncio.Task[InstanceResponse]" = asyncio.create_task(fetcher._request("https://mastodon.example", _hang))
+    await asyncio.sleep(0.01)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+
+    await fetcher._request("https://mastodon.example", _succeed)
+    assert fetcher.get_instance_stats()["https://mastodon.example"]["circuit"] == "closed"
+
+
+@pytest.mark.parametrize(
+    "error, retryable",
+    [
+        (httpx.ConnectError("Connection refused"), True),
+        (httpx.ReadTimeout("Timed out"), True),
+        (json.JSONDecodeError("Expecting value", "<html>", 0), True),
+        (MalformedResponse("Counters are missing"), True),
+        (ValueError("Expected a list"), False),
+        (KeyError("id"), False),
+    ],
+)
+def test_transient_errors_are_retryable(error: Exception, retryable: bool) -> None:
+    assert is_retryable(error) is retryable
+
+
+@pytest.mark.parametrize("status_code, retryable", [(429, True), (503, True), (500, True), (404, False), (401, False)])
+def test_status_codes_are_retryable(status_code: int, retryable: bool) -> None:
+    request: httpx.Request = httpx.Request("GET", "https://mastodon.example/api/v1/accounts/1")
+    response: httpx.Response = httpx.Response(status_code, request=request)
+    error: httpx.HTTPStatusError = httpx.HTTPStatusError("Failed", request=request, response=response)
+
+    assert is_retryable(error) is retryable
+
+
+@pytest.mark.parametrize(
+    "status_code, headers, delay",
+    [
+        (429, {"Retry-After": "30"}, 30),
+        (503, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0),
+        (429, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "2015-10-21T07:28:00.000Z"}, 0),
+        (200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "12"}, 12),
+        (200, {"X-RateLimit-Remaining": "10", "X-RateLimit-Reset": "12"}, None),
+        (200, {}, None),
+    ],
+)
+def test_rate_limit_delays_are_read_from_the_headers(
+    status_code: int, headers: tp.Dict[str, str], delay: tp.Optional[float]
+) -> None:
+    assert get_rate_limit_delay(httpx.Response(status_code, headers=headers)) == delay
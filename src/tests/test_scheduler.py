@@ -0,0 +1,32 @@
+import typing as tp
+from collections import Counter
+
+from mastodon_meter.Scheduler import HashRing
+
+KEYS: tp.List[str] = [f"{i:032x}" for i in range(10000)]
+
+
+def test_hash_ring_spreads_keys_evenly() -> None:
+    workers: tp.List[str] = [f"worker-{i}" for i in range(4)]
+    ring: HashRing = HashRing(workers)
+    shares: tp.Counter[str] = Counter(ring.get_worker(key) for key in KEYS)
+
+    assert set(shares) == set(workers)
+    assert all(share > len(KEYS) / len(workers) * 0.6 for share in shares.values())
+    # the assignment doesn't depend on the order of the workers
+    assert all(HashRing(workers[::-1]).get_worker(key) == ring.get_worker(key) for key in KEYS[:100])
+
+
+def test_hash_ring_moves_only_the_keys_of_the_changed_worker() -> None:
+    workers: tp.List[str] = [f"worker-{i}" for i in range(4)]
+    before: HashRing = HashRing(workers)
+    after: HashRing = HashRing(workers + ["worker-4"])
+    moved: tp.List[str] = [key for key in KEYS if before.get_worker(key) != after.get_worker(key)]
+
+    assert all(after.get_worker(key) == "worker-4" for key in moved)
+    assert len(moved) < len(KEYS) / 5 * 1.5
+
+    without: HashRing = HashRing(workers[1:])
+    assert all(
+        without.get_worker(key) == before.get_worker(key) for key in KEYS if before.get_worker(key) != "worker-0"
+    )
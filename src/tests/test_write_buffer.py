@@ -0,0 +1,133 @@
+import asyncio
+import typing as tp
+from datetime import datetime, timedelta
+
+import pytest
+
+from mastodon_meter.Account import Account
+from mastodon_meter.DatabaseWrapper import DatabaseWrapper
+from mastodon_meter.Gatherer import Gatherer
+from mastodon_meter.Metering import Metering
+from mastodon_meter.Rollups import ROLLUP_TIERS, RollupTier, make_rollups
+from mastodon_meter.WriteBuffer import WriteBatch, WriteBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+class Storage:
+    """keeps the written batches, failing the writes while it is down"""
+
+    def __init__(self, delay: float = 0) -> None:
+        self.delay: float = delay
+        self.down: bool = False
+        self.written: tp.List[str] = []
+        self.attempts: int = 0
+
+    async def write(self, batch: WriteBatch) -> None:
+        self.attempts += 1
+        await asyncio.sleep(self.delay)
+        if self.down:
+            raise ConnectionError("Database is down")
+        self.written += [m.parent_account_internal_id for m in batch.meterings]
+
+
+def metering(account_internal_id: str) -> Metering:
+    return Metering(1, 1, account_internal_id)
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("WRITE_BATCH_SIZE", "3")
+    monkeypatch.setenv("WRITE_FLUSH_INTERVAL", "0.05")
+    monkeypatch.setenv("WRITE_RETRY_LIMIT", "2")
+
+
+async def test_results_are_written_in_batches() -> None:
+    storage: Storage = Storage()
+    buffer: WriteBuffer = WriteBuffer(storage.write)
+
+    for account_internal_id in "abcd":
+        await buffer.add_metering(metering(account_internal_id))
+    assert storage.written == ["a", "b", "c"]
+
+    await buffer.close()
+    assert storage.written == ["a", "b", "c", "d"]
+    assert buffer.stats.as_dict()["documents"] == 4
+
+
+async def test_close_waits_for_the_timer_flush() -> None:
+    storage: Storage = Storage(delay=0.2)
+    buffer: WriteBuffer = WriteBuffer(storage.write)
+
+    await buffer.add_metering(metering("a"))
+    # the timer flush is writing the first result by now
+    await asyncio.sleep(0.1)
+    await buffer.add_metering(metering("b"))
+    await buffer.close()
+
+    assert storage.written == ["a", "b"]
+
+
+async def test_failed_writes_are_retried() -> None:
+    storage: Storage = Storage()
+    buffer: WriteBuffer = WriteBuffer(storage.write)
+    storage.down = True
+
+    await buffer.add_metering(metering("a"))
+    await buffer.flush()
+    await buffer.add_metering(metering("b"))
+    await buffer.flush()
+    storage.down = False
+    await buffer.close()
+
+    assert storage.written == ["a", "b"]
+    assert (buffer.stats.failures, buffer.stats.dropped) == (2, 0)
+
+
+async def test_results_are_dropped_after_the_retry_limit() -> None:
+    storage: Storage = Storage()
+    buffer: WriteBuffer = WriteBuffer(storage.write)
+    storage.down = True
+
+    await buffer.add_metering(metering("a"))
+    for _ in range(3):
+        await buffer.flush()
+    storage.down = False
+    await buffer.add_metering(metering("b"))
+    await buffer.close()
+
+    assert storage.written == ["b"]
+    assert (storage.attempts, buffer.stats.failures, buffer.stats.dropped) == (4, 3, 1)
+
+
+async def test_retried_writes_skip_the_steps_done(database: DatabaseWrapper, monkeypatch: pytest.MonkeyPatch) -> None:
+    account: Account = Account(username="user", instance="https://mastodon.example", id="1")
+    await database.add_tracked_account(account)
+    start: datetime = datetime(2022, 1, 3, 10, 0)
+    meterings: tp.List[Metering] = [
+        Metering(100 + i, 1000 + i, account.internal_id, start + timedelta(minutes=20 * i)) for i in range(6)
+    ]
+    update_rollups: tp.Callable[..., tp.Awaitable[None]] = database.update_rollups
+    failed: tp.List[str] = []
+
+    async def _update_rollups(meterings: tp.List[Metering], tiers: tp.Sequence[RollupTier]) -> None:
+        # the daily rollups fail once, after the meterings and the hourly rollups are written
+        if tiers[0].name == "daily" and not failed:
+            failed.append(tiers[0].name)
+            raise ConnectionError("Database is down")
+        await update_rollups(meterings, tiers=tiers)
+
+    monkeypatch.setattr(database, "update_rollups", _update_rollups)
+    buffer: WriteBuffer = WriteBuffer(Gatherer._store_results)
+    for metering in meterings:
+        await buffer.add_metering(metering)
+    await buffer.flush()
+    assert (buffer.stats.failures, failed) == (1, ["daily"])
+    await buffer.close()
+
+    assert await database.count_meterings(account.internal_id) == len(meterings)
+    for tier in ROLLUP_TIERS:
+        assert await database.get_rollups(account.internal_id, tier) == make_rollups(meterings, tier)
+    [(_, state)] = await database.get_account_states([account.internal_id])
+    assert state is not None and state.timestamp == meterings[-1].timestamp
+    assert state.toot_count_delta == 1